@@ -0,0 +1,322 @@
+"""
+Benchmarks for mybitcoin's hot paths
+
+Builds a synthetic chain and mempool, times the node's hot paths and prints
+the results as JSON. Results are compared against an earlier run, by default
+the one stored in benchmark_baseline.json next to this script, and the script
+exits non-zero if anything regressed beyond --tolerance. When a change is meant
+to move the numbers, rerun with --output=benchmark_baseline.json and commit it.
+Timings from one run vary by tens of percent, so each metric reported is the
+median over --runs runs.
+
+Usage:
+  benchmark.py [options]
+
+Options:
+  -h --help              Show this screen.
+  --blocks=<n>           Blocks in the synthetic chain [default: 30]
+  --txns=<n>             Transactions per block [default: 10]
+  --keys=<n>             Distinct keys owning coins [default: 50]
+  --mempool=<n>          Unconfirmed transactions in the mempool [default: 50]
+  --reorg-depths=<list>  Comma separated reorg depths to time [default: 1,3,6]
+  --seed=<n>             Random seed [default: 0]
+  --runs=<n>             Times to run everything, reporting medians [default: 5]
+  --output=<file>        Also write the results to this file
+  --baseline=<file>      Compare against results from an earlier run instead
+                         of the stored baseline
+  --tolerance=<pct>      Allowed regression in percent [default: 20]
+"""
+
+import concurrent.futures, copy, json, logging, multiprocessing, os, platform, random, socket, statistics, sys, threading, time
+from docopt import docopt
+
+import mybitcoin
+from mybitcoin import Block, Node, SigningKey, SECP256k1, prepare_coinbase, prepare_tx
+
+BENCHMARK_BITS = 8 # low enough that building chains is cheap
+MINING_BITS = 12 # difficulty used to time mine_block
+BLOCK_SPACING = 2 # seconds between synthetic blocks, slow enough that difficulty falls
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+class ChainBuilder:
+    # Mines valid blocks onto a node, spending coins between a set of keys
+    def __init__(self, node, keys, rng):
+        self.node = node
+        self.keys = keys
+        self.rng = rng
+        self.owned = {i: [] for i in range(len(keys))} # key index -> spendable tx_outs
+        self.key_index = {mybitcoin.public_key_bytes(key.get_verifying_key()): i for i, key in enumerate(keys)}
+
+    def genesis(self):
+        public_key = self.keys[0].get_verifying_key()
+        coinbase = prepare_coinbase(public_key, self.node.get_block_subsidy())
+        block = Block(txns=[coinbase], prev_id=None, nonce=0, bits=BENCHMARK_BITS,
+                      timestamp=time.time() - 10**6)
+        self.node.connect_block(mybitcoin.mine_block(block))
+        self.track(block)
+
+    def track(self, block):
+        for tx in block.txns:
+            for tx_out in tx.tx_outs:
+                self.owned[self.key_index[tx_out.public_key]].append(tx_out)
+
+    def random_tx(self):
+        sender = self.rng.choice([i for i, utxos in self.owned.items() if utxos])
+        tx_out = self.owned[sender].pop(self.rng.randrange(len(self.owned[sender])))
+        recipient = self.keys[self.rng.randrange(len(self.keys))].get_verifying_key()
+        fee = self.rng.randint(1, 1000)
+        amount = (tx_out.amount - fee) // 2
+        change = tx_out.amount - fee - amount
+        return prepare_tx([tx_out], self.keys[sender], [(recipient, amount)], change)
+
+    def next_block(self, txns_per_block, coinbase_key=None):
+        txns = [self.random_tx() for _ in range(txns_per_block)]
+        miner = coinbase_key or self.keys[self.rng.randrange(len(self.keys))]
+        fees = self.node.calculate_fees(txns)
+        coinbase = prepare_coinbase(miner.get_verifying_key(), self.node.get_block_subsidy() + fees)
+        tip = self.node.blocks[-1]
+        block = Block(
+            txns=[coinbase] + txns,
+            prev_id=tip.id,
+            nonce=0,
+            bits=self.node.get_next_bits(tip.id),
+            timestamp=tip.timestamp + BLOCK_SPACING,
+        )
+        return mybitcoin.mine_block(block)
+
+    def extend(self, count, txns_per_block):
+        blocks = []
+        for _ in range(count):
+            block = self.next_block(txns_per_block)
+            self.node.connect_block(block)
+            self.track(block)
+            blocks.append(block)
+        return blocks
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def replay_chain(blocks):
+    node = Node(address=("benchmark", mybitcoin.PORT))
+    for block in blocks:
+        node.connect_block(block)
+    return node
+
+
+def bench_mining(results, rounds=20):
+    hashes, elapsed = 0, 0
+    for i in range(rounds):
+        block = Block(txns=[prepare_coinbase(SigningKey.from_secret_exponent(1, curve=SECP256k1).get_verifying_key(), 1)],
+                      prev_id=None, nonce=i << 32, bits=MINING_BITS, timestamp=time.time())
+        duration, mined = timed(mybitcoin.mine_block, block)
+        hashes += mined.nonce - (i << 32) + 1
+        elapsed += duration
+    results["mine_block_hashes_per_sec"] = metric(hashes / elapsed, "hashes/s", higher_is_better=True)
+
+
+def bench_verify(results, key, rounds=50):
+    # verify_input against a key seen for the first time, then against one
+    # that's hot enough to have a precomputed table
+    public_key = key.get_verifying_key().to_string("compressed")
+    tx_id = mybitcoin.new_tx_id()
+    tx = mybitcoin.Tx(tx_id, [mybitcoin.TxIn(mybitcoin.new_tx_id(), 0)], [mybitcoin.TxOut(tx_id, 0, 1, public_key)])
+    tx.sign_input(0, key)
+    duration = 0
+    for _ in range(rounds):
+        mybitcoin.key_cache.clear()
+        duration += timed(tx.verify_input, 0, public_key)[0]
+    results["verify_input_cold_secs"] = metric(duration / rounds, "s")
+    for _ in range(mybitcoin.KEY_CACHE_HOT_LOOKUPS):
+        tx.verify_input(0, public_key)
+    duration, _ = timed(lambda: [tx.verify_input(0, public_key) for _ in range(rounds)])
+    results["verify_input_hot_secs"] = metric(duration / rounds, "s")
+
+
+def bench_chain(results, args, keys, rng):
+    node = Node(address=("benchmark", mybitcoin.PORT))
+    builder = ChainBuilder(node, keys, rng)
+    builder.genesis()
+    # Spread coins across keys before the measured blocks
+    builder.extend(args["txns"], 0)
+    blocks = builder.extend(args["blocks"], args["txns"])
+
+    # validate_block on the tip, against the chain just below it
+    parent = replay_chain(node.blocks[:-1])
+    duration, _ = timed(parent.validate_block, node.blocks[-1], True)
+    results["validate_block_secs"] = metric(duration, "s")
+
+    # connect_block over the whole chain
+    duration, _ = timed(replay_chain, node.blocks)
+    results["connect_block_secs"] = metric(duration / len(node.blocks), "s")
+
+    # fetch_balance for every key
+    public_keys = [key.get_verifying_key() for key in keys]
+    duration, _ = timed(lambda: [node.fetch_balance(pk) for pk in public_keys])
+    results["fetch_balance_secs"] = metric(duration / len(public_keys), "s")
+    duration, _ = timed(node.fetch_balances, public_keys) # One pass for every key
+    results["fetch_balances_batch_secs"] = metric(duration / len(public_keys), "s")
+
+    # serialize / deserialize whole blocks
+    serialized = [mybitcoin.serialize(block) for block in blocks]
+    size = sum(len(data) for data in serialized)
+    duration, _ = timed(lambda: [mybitcoin.serialize(block) for block in blocks])
+    results["serialize_bytes_per_sec"] = metric(size / duration, "bytes/s", higher_is_better=True)
+    duration, _ = timed(lambda: [mybitcoin.deserialize(data) for data in serialized])
+    results["deserialize_bytes_per_sec"] = metric(size / duration, "bytes/s", higher_is_better=True)
+
+    bench_read_message(results, blocks)
+    bench_reject_junk(results, node, blocks)
+    bench_sync(results, node, blocks)
+    bench_mempool(results, args, builder)
+    bench_reorgs(results, args, node, keys, rng)
+
+
+def bench_reject_junk(results, node, blocks):
+    # A "blocks" message whose first header lacks proof-of-work, turned away
+    # before any body is parsed
+    unmined = copy.deepcopy(blocks[0])
+    while unmined.proof < unmined.target:
+        unmined.nonce += 1
+    encoded = [mybitcoin.encode_block(block) for block in [unmined] + blocks[1:]]
+    size = sum(len(data) for data in encoded)
+    def reject():
+        headers = [mybitcoin.BlockHeader.from_bytes(data[:mybitcoin.HEADER_SIZE]) for data in encoded]
+        assert mybitcoin.decode_blocks(node, headers, encoded) == []
+    duration, _ = timed(reject)
+    results["reject_junk_blocks_bytes_per_sec"] = metric(size / duration, "bytes/s", higher_is_better=True)
+
+
+def bench_sync(results, node, blocks):
+    # connect_blocks on the measured blocks as one sync batch, connected one
+    # after another, then with workers checking blocks ahead of the connects
+    below = node.blocks[:len(node.blocks) - len(blocks)]
+    duration, _ = timed(mybitcoin.connect_blocks, replay_chain(below), blocks)
+    results["sync_batch_serial_secs"] = metric(duration / len(blocks), "s")
+    with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver")) as pool:
+        mybitcoin.sync_pool = pool
+        mybitcoin.connect_blocks(replay_chain(below), blocks) # Starts the workers
+        duration, _ = timed(mybitcoin.connect_blocks, replay_chain(below), blocks)
+        mybitcoin.sync_pool = None
+    results["sync_batch_pipelined_secs"] = metric(duration / len(blocks), "s")
+    mybitcoin.mining_interrupt.clear() # Set by each connected block, and mine_block gives up on it
+
+
+def bench_mempool(results, args, builder):
+    txns = [builder.random_tx() for _ in range(args["mempool"])]
+    duration, _ = timed(lambda: [builder.node.handle_tx(tx) for tx in txns])
+    results["handle_tx_secs"] = metric(duration / len(txns), "s")
+    duration, _ = timed(builder.node.calculate_fees, [entry.tx for entry in builder.node.mempool.values()])
+    results["calculate_fees_mempool_secs"] = metric(duration, "s")
+
+
+def bench_read_message(results, blocks, rounds=20):
+    # One message per connection, as on the wire
+    message = mybitcoin.prepare_message("blocks", [mybitcoin.encode_block(block) for block in blocks])
+    duration = 0
+    for _ in range(rounds):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            thread = threading.Thread(target=sender.sendall, args=[message])
+            start = time.perf_counter()
+            thread.start()
+            mybitcoin.read_message(receiver)
+            duration += time.perf_counter() - start
+            thread.join()
+    results["read_message_bytes_per_sec"] = metric(len(message) * rounds / duration, "bytes/s", higher_is_better=True)
+
+
+def bench_reorgs(results, args, node, keys, rng):
+    for depth in args["reorg_depths"]:
+        if depth >= len(node.blocks) - 1:
+            continue
+        chain = replay_chain(node.blocks)
+        # A competing branch one block longer, built on a copy of the fork point
+        fork = replay_chain(node.blocks[:-depth])
+        builder = ChainBuilder(fork, keys, random.Random(rng.random()))
+        for block in fork.blocks:
+            builder.track(block)
+        for tx_outs in builder.owned.values(): # only spend what's still unspent
+            tx_outs[:] = [tx_out for tx_out in tx_outs if tx_out.outpoint in fork.utxo_set]
+        branch = builder.extend(depth + 1, args["txns"])
+        for block in branch[:-1]:
+            chain.handle_block(block)
+        duration, _ = timed(chain.handle_block, branch[-1])
+        assert chain.blocks[-1] == branch[-1], "Reorg didn't happen"
+        results[f"reorg_depth_{depth}_secs"] = metric(duration, "s")
+
+
+def metric(value, unit, higher_is_better=False):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def compare(results, baseline, tolerance):
+    # Percent change for every metric, and the ones that got worse
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]["value"], result["value"]
+        change = (new - old) / old * 100 if old else 0
+        worse = -change if result["higher_is_better"] else change
+        result["baseline"] = old
+        result["change_pct"] = round(change, 2)
+        if worse > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(args):
+    logging.getLogger().setLevel("WARNING")
+    args = {
+        "blocks": int(args["--blocks"]),
+        "txns": int(args["--txns"]),
+        "keys": int(args["--keys"]),
+        "mempool": int(args["--mempool"]),
+        "reorg_depths": [int(depth) for depth in args["--reorg-depths"].split(",")],
+        "seed": int(args["--seed"]),
+        "runs": int(args["--runs"]),
+        "output": args["--output"],
+        "baseline": args["--baseline"] or (BASELINE_FILE if os.path.exists(BASELINE_FILE) else None),
+        "tolerance": float(args["--tolerance"]),
+    }
+    runs = []
+    for _ in range(args["runs"]):
+        rng = random.Random(args["seed"])
+        keys = [SigningKey.from_secret_exponent(rng.randrange(1, 2**128), curve=SECP256k1)
+                for _ in range(args["keys"])]
+        results = {}
+        bench_mining(results)
+        bench_verify(results, keys[0])
+        bench_chain(results, args, keys, rng)
+        runs.append(results)
+    for name, result in results.items():
+        result["value"] = statistics.median([run[name]["value"] for run in runs])
+
+    report = {
+        "params": {k: args[k] for k in ["blocks", "txns", "keys", "mempool", "reorg_depths", "seed"]},
+        "python": platform.python_version(),
+        "results": results,
+    }
+    regressions = []
+    if args["baseline"]:
+        with open(args["baseline"]) as f:
+            baseline = json.load(f)
+        if baseline["params"] != report["params"]:
+            logging.warning("Baseline was run with different parameters: %s", baseline["params"])
+        regressions = compare(results, baseline["results"], args["tolerance"])
+        report["regressions"] = regressions
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args["output"]:
+        with open(args["output"], "w") as f:
+            f.write(output + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(docopt(__doc__)))
@@ -0,0 +1,769 @@
+import concurrent.futures, json, multiprocessing, socketserver, threading
+from copy import deepcopy
+from contextlib import contextmanager
+import pytest
+from ecdsa import BadSignatureError, SigningKey, SECP256k1
+
+import mybitcoin
+from mybitcoin import BlockHeader
+from blockfilter import build_filter, filter_key, match_any
+from merkle import MerkleTree, hash_leaf, merkle_root, verify_proof
+from simulator import Simulator
+from capture import CaptureWriter
+from blockstore import BlockStore
+from fees import FeeEstimator
+from metrics import Counter, Histogram
+from replay import replay
+import benchmark
+
+bob_private_key = SigningKey.generate(curve=SECP256k1)
+alice_private_key = SigningKey.generate(curve=SECP256k1)
+bob_public_key = bob_private_key.get_verifying_key()
+alice_public_key = alice_private_key.get_verifying_key()
+
+
+def test_merkle_tree_incremental_updates():
+    leaves = [hash_leaf(bytes([i])) for i in range(13)]
+    tree = MerkleTree()
+    for index, leaf in enumerate(leaves):
+        tree.append(leaf)
+        assert tree.root == merkle_root(leaves[:index+1])
+
+    # Replacing and removing leaves matches a tree built from scratch
+    leaves[0] = hash_leaf(b"coinbase")
+    tree.update(0, leaves[0])
+    assert tree.root == merkle_root(leaves)
+    del leaves[4]
+    tree.remove(4)
+    assert tree.root == merkle_root(leaves)
+
+
+def test_merkle_proofs():
+    leaves = [hash_leaf(bytes([i])) for i in range(7)]
+    tree = MerkleTree(leaves)
+    for index, leaf in enumerate(leaves):
+        assert verify_proof(leaf, tree.proof(index), tree.root)
+    assert not verify_proof(hash_leaf(b"forged"), tree.proof(3), tree.root)
+
+
+def make_chain(monkeypatch, length):
+    monkeypatch.setattr(mybitcoin, "INITIAL_DIFFICULTY_BITS", 4)
+    monkeypatch.setattr(mybitcoin, "mining_interrupt", mybitcoin.threading.Event())
+    node = mybitcoin.Node(address=("test", mybitcoin.PORT))
+    monkeypatch.setattr(mybitcoin, "node", node)
+    mybitcoin.mine_genesis_block(node, alice_public_key)
+    node.template = mybitcoin.BlockTemplate(node, bob_public_key)
+    for _ in range(length):
+        node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+    return node
+
+
+def test_light_client_verifies_utxo_proofs(monkeypatch):
+    node = make_chain(monkeypatch, 3)
+    client = mybitcoin.LightClient(address=None)
+    client.add_headers([BlockHeader.from_bytes(header) for header in node.fetch_headers([])])
+    assert [header.id for header in client.headers] == [block.id for block in node.blocks]
+
+    assert node.fetch_utxo_proofs(bob_public_key) is None # Not without a tx index
+    node.tx_index = {tx.id: (block.id, index) for block in node.blocks for index, tx in enumerate(block.txns)}
+    proofs = node.fetch_utxo_proofs(bob_public_key)
+    assert len(proofs) == 3
+    headers = client.headers_by_id()
+    for utxo_proof in proofs:
+        client.verify_utxo_proof(bob_public_key, utxo_proof, headers)
+
+    # A tx that was never confirmed is rejected
+    forged = mybitcoin.prepare_coinbase(bob_public_key, 10**12)
+    proofs[0]["tx"] = forged
+    with pytest.raises(AssertionError):
+        client.verify_utxo_proof(bob_public_key, proofs[0], headers)
+
+
+def test_block_filters_match_touched_keys(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    block = node.blocks[-1]
+    block_filter = node.filters[block.id]
+    key = filter_key(block.id)
+    assert match_any(key, block_filter, [mybitcoin.public_key_bytes(bob_public_key)])
+    assert not match_any(key, block_filter, [mybitcoin.public_key_bytes(alice_public_key)])
+
+    items = [bytes([i]) * 33 for i in range(200)]
+    block_filter = build_filter(key, items)
+    assert all(match_any(key, block_filter, [item]) for item in items)
+
+
+def test_coin_selection_avoids_change():
+    tx_id = mybitcoin.new_tx_id()
+    utxos = [mybitcoin.TxOut(tx_id, i, amount, alice_public_key)
+             for i, amount in enumerate([500, 3000, 1200, 7000, 250])]
+    selected = mybitcoin.select_coins(utxos, 4450)
+    assert sorted(tx_out.amount for tx_out in selected) == [250, 1200, 3000]
+    # Without an exact match it still covers the target
+    selected = mybitcoin.select_coins(utxos, 7100)
+    assert sum(tx_out.amount for tx_out in selected) >= 7100
+    with pytest.raises(AssertionError):
+        mybitcoin.select_coins(utxos, 20000)
+
+
+def test_utxo_set_packs_entries():
+    utxos = mybitcoin.UtxoSet()
+    tx_outs = [mybitcoin.TxOut(mybitcoin.new_tx_id(), i, 1000 * i, [alice_public_key, bob_public_key][i % 2])
+               for i in range(6)]
+    for tx_out in tx_outs:
+        utxos[tx_out.outpoint] = tx_out
+    assert utxos.public_keys == [mybitcoin.public_key_bytes(alice_public_key), mybitcoin.public_key_bytes(bob_public_key)]
+    assert utxos[tx_outs[3].outpoint] == tx_outs[3]
+    assert utxos.owned_by(bob_public_key) == sorted(tx_outs[1::2], key=lambda tx_out: tx_out.outpoint) # Outpoint order
+
+    assert utxos.pop(tx_outs[0].outpoint) == tx_outs[0]
+    assert tx_outs[0].outpoint not in utxos and len(utxos) == 5
+    utxos[tx_outs[0].outpoint] = tx_outs[0] # Reuses the freed slot
+    assert len(utxos.amounts) == 6 and sorted(utxos.values(), key=lambda tx_out: tx_out.index) == tx_outs
+
+    negative = mybitcoin.TxOut(tx_outs[0].tx_id, 0, -1, alice_public_key)
+    assert not mybitcoin.Tx(tx_outs[0].tx_id, [], [negative]).well_formed
+
+def test_key_cache_precomputes_hot_keys():
+    cache = mybitcoin.KeyCache(size=2, hot_size=1, hot_lookups=3)
+    keys = [key.get_verifying_key().to_string("compressed") for key in (alice_private_key, bob_private_key)]
+    parsed = cache.get(keys[0])
+    assert cache.get(keys[0]) is parsed and not cache.hot
+    hot = cache.get(keys[0])
+    assert list(cache.hot) == [keys[0]] and cache.get(keys[0]) is hot
+
+    # The rebuilt key still tells good signatures from bad ones
+    assert hot.to_string("compressed") == keys[0]
+    assert hot.verify(alice_private_key.sign(b"message"), b"message")
+    with pytest.raises(BadSignatureError):
+        hot.verify(bob_private_key.sign(b"message"), b"message")
+
+    # Both tiers are bounded
+    for key in keys[1:] + [SigningKey.generate(curve=SECP256k1).get_verifying_key().to_string("compressed")
+                           for _ in range(3)]:
+        cache.get(key)
+    assert len(cache.keys) == 2 and len(cache.hot) == 1
+
+def test_wallet_batches_payments(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    wallet = mybitcoin.Wallet(bob_private_key, address=None)
+    for block in node.blocks:
+        wallet.apply_block(block)
+    assert wallet.balance == node.fetch_balance(bob_public_key)
+
+    payments = [(alice_public_key, 1000), (alice_public_key, 2000)]
+    tx = wallet.prepare_payments(payments, fee=100)
+    assert len(tx.tx_ins) == 1 and len(tx.tx_outs) == 3
+    node.handle_tx(tx)
+    assert node.template.fees == 100
+
+
+def test_wallet_rescan_explains_missing_blocks(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    node.blocks.prune_depth = 2
+    for _ in range(3):
+        node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+
+    def ask(address, command, data, response=False):
+        replies = []
+        respond = lambda command, data: replies.append({"command": command, "data": data})
+        mybitcoin.handle_message(node, command, data, ("wallet", mybitcoin.PORT), respond)
+        return replies[0]
+    monkeypatch.setattr(mybitcoin, "send_message", ask)
+    wallet = mybitcoin.Wallet(bob_private_key, address=None)
+    with pytest.raises(Exception, match="doesn't have block"): # Pruned
+        wallet.sync()
+
+def test_mempool_chains_and_conflicts(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    coin = node.fetch_utxos(bob_public_key)[0]
+    parent = mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 1100)
+    child = mybitcoin.prepare_tx([parent.tx_outs[1]], bob_private_key, [(alice_public_key, 1000)],
+                                 parent.tx_outs[1].amount - 1500)
+    with pytest.raises(AssertionError):
+        node.handle_tx(child) # Parent not seen yet
+    node.handle_tx(parent)
+    node.handle_tx(child)
+    assert node.mempool_descendants(parent) == {child.id}
+
+    double_spend = mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 5000)], 0)
+    with pytest.raises(AssertionError, match="Conflicts"):
+        node.handle_tx(double_spend)
+
+    # Parent and child are mined together, parent first
+    block = mybitcoin.mine_template(node.template, nonce=0)
+    assert [tx.id for tx in block.txns[1:]] == [parent.id, child.id]
+    assert block.txns[0].tx_outs[0].amount == node.get_block_subsidy() + 600
+    node.handle_block(block)
+    assert not node.mempool and not node.spenders
+
+
+def test_template_prefers_ancestor_fee_rate(monkeypatch):
+    node = make_chain(monkeypatch, 3)
+    coins = node.fetch_utxos(bob_public_key)
+    pay = lambda coin, fee: mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)],
+                                                 coin.amount - 1000 - fee)
+    cheap_parent, rich = pay(coins[0], 10), pay(coins[1], 300)
+    child = pay(cheap_parent.tx_outs[1], 1000) # Pays for its parent
+    for tx in [cheap_parent, rich, child]:
+        node.handle_tx(tx)
+
+    monkeypatch.setattr(mybitcoin, "TEMPLATE_MAX_BYTES", node.mempool[cheap_parent.id].size + node.mempool[child.id].size)
+    node.template.select()
+    assert list(node.template.txns) == [cheap_parent.id, child.id]
+
+def test_template_tracks_mempool_incrementally(monkeypatch):
+    node = make_chain(monkeypatch, 3)
+    template = node.template
+    coins = node.fetch_utxos(bob_public_key)
+    pay = lambda coin, fee: mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)],
+                                                 coin.amount - 1000 - fee)
+    def check(expected, fees):
+        block = template.block(0)
+        assert list(template.txns) == [tx.id for tx in expected]
+        assert template.fees == fees and template.size == sum(node.mempool[tx.id].size for tx in expected)
+        assert block.txns[0].tx_outs[0].amount == node.get_block_subsidy() + fees
+        assert block.merkle_root == mybitcoin.compute_merkle_root(block.txns)
+
+    first, second = pay(coins[0], 100), pay(coins[1], 200)
+    version = template.version
+    node.handle_tx(first)
+    assert template.version > version
+    check([first], 100)
+    version = template.version
+    node.handle_tx(second)
+    assert template.version > version
+    check([first, second], 300)
+
+    # Conflicting with first evicts it from the mempool and the template
+    version = template.version
+    node.connect_tx(pay(coins[0], 50))
+    assert template.version > version
+    check([second], 200)
+
+def test_template_drops_a_blocks_txns_in_one_pass(monkeypatch):
+    node = make_chain(monkeypatch, 4)
+    coins = node.fetch_utxos(bob_public_key)
+    pay = lambda coin, fee: mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)],
+                                                 coin.amount - 1000 - fee)
+    txns = [pay(coin, 100 * (i + 1)) for i, coin in enumerate(coins[:3])]
+    for tx in txns[:2]:
+        node.handle_tx(tx)
+    block = mybitcoin.mine_template(node.template, nonce=0)
+    node.handle_tx(txns[2]) # Arrives while the block is on its way
+    removals = []
+    monkeypatch.setattr(mybitcoin.MerkleTree, "remove", lambda tree, index: removals.append(index))
+    node.handle_block(block)
+    assert not removals # No per-tx tree surgery
+    template = node.template.block(0)
+    assert template.txns[1:] == [txns[2]] and template.txns[0].tx_outs[0].amount == node.get_block_subsidy() + 300
+    assert template.merkle_root == mybitcoin.compute_merkle_root(template.txns)
+
+def test_full_template_only_reselects_for_better_packages(monkeypatch):
+    node = make_chain(monkeypatch, 4)
+    template = node.template
+    coins = node.fetch_utxos(bob_public_key)
+    pay = lambda coin, fee: mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)],
+                                                 coin.amount - 1000 - fee)
+    middle, cheap, rich = pay(coins[0], 200), pay(coins[1], 100), pay(coins[2], 300)
+    node.handle_tx(middle)
+    monkeypatch.setattr(mybitcoin, "TEMPLATE_MAX_BYTES", template.size) # Full
+    selects, select = [], template.select
+    monkeypatch.setattr(template, "select", lambda: selects.append(1) or select())
+
+    node.handle_tx(cheap) # Wouldn't make the cut anyway
+    assert not selects and template.dirty and list(template.txns) == [middle.id]
+    node.handle_tx(rich) # Outbids middle
+    assert len(selects) == 1 and list(template.txns) == [rich.id]
+
+    # Anything left out waiting gets another look once the interval passes
+    node.remove_from_mempool(rich.id)
+    template.refresh()
+    assert len(selects) == 1 and not template.txns
+    monkeypatch.setattr(template, "selected_at", template.selected_at - mybitcoin.TEMPLATE_RESELECT_INTERVAL)
+    template.refresh()
+    assert len(selects) == 2 and list(template.txns) == [middle.id]
+
+def test_mempool_survives_restart(monkeypatch, tmp_path):
+    node = make_chain(monkeypatch, 2)
+    coin = node.fetch_utxos(bob_public_key)[0]
+    parent = mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 1100)
+    child = mybitcoin.prepare_tx([parent.tx_outs[1]], bob_private_key, [(alice_public_key, 1000)],
+                                 parent.tx_outs[1].amount - 1500)
+    node.handle_tx(parent)
+    node.handle_tx(child)
+    forged = mybitcoin.prepare_tx([node.fetch_utxos(bob_public_key)[1]], alice_private_key, [(alice_public_key, 1)], 0)
+    node.add_to_mempool(forged, 0) # Slipped past validation somehow
+    path = str(tmp_path / "mempool.dat")
+    assert mybitcoin.dump_mempool(node, path) == 3
+
+    restarted = mybitcoin.Node(address=("restarted", mybitcoin.PORT))
+    for block in node.blocks:
+        restarted.connect_block(block)
+    contexts, executor = [], concurrent.futures.ProcessPoolExecutor
+    monkeypatch.setattr(mybitcoin.concurrent.futures, "ProcessPoolExecutor",
+                        lambda **kwargs: contexts.append(kwargs.get("mp_context")) or executor(**kwargs))
+    assert mybitcoin.load_mempool(restarted, path) == 2
+    assert [context.get_start_method() for context in contexts] == ["forkserver"] # Safe with threads running
+    assert list(restarted.mempool) == [parent.id, child.id]
+    assert restarted.mempool[child.id].time == node.mempool[child.id].time
+    assert restarted.mempool[child.id].fee == 500
+
+def test_assume_valid_skips_signatures_of_ancestors_only(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    coin = node.fetch_utxos(bob_public_key)[0]
+    forged = mybitcoin.prepare_tx([coin], alice_private_key, [(alice_public_key, coin.amount)], 0)
+    node.add_to_mempool(forged, 0) # Skips validation
+    bad_block = mybitcoin.mine_template(node.template, nonce=0)
+
+    def replay_onto(assume_valid):
+        fresh = mybitcoin.Node(address=("fresh", mybitcoin.PORT))
+        fresh.connect_block(node.blocks[0])
+        fresh.assume_valid = assume_valid
+        fresh.learn_headers(node.blocks + [bad_block])
+        for block in node.blocks[1:] + [bad_block]:
+            fresh.handle_block(block)
+        return fresh
+
+    assert replay_onto(bad_block.id).blocks[-1] == bad_block
+    with pytest.raises(BadSignatureError):
+        replay_onto(node.blocks[-1].id) # bad_block is past it
+
+def test_snapshot_bootstrap(monkeypatch, tmp_path):
+    node = make_chain(monkeypatch, 3)
+    coin = node.fetch_utxos(bob_public_key)[0]
+    node.handle_tx(mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 1100))
+    node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+    path = str(tmp_path / "utxos.dat")
+    info = mybitcoin.dump_snapshot(node, path)
+    assert info["height"] == 4 and info["utxos"] == len(node.utxo_set)
+
+    fresh = mybitcoin.Node(address=("fresh", mybitcoin.PORT))
+    fresh.connect_block(node.blocks[0])
+    mybitcoin.load_snapshot(fresh, path)
+    assert fresh.blocks[-1].id == node.blocks[-1].id
+    assert fresh.fetch_balance(alice_public_key) == node.fetch_balance(alice_public_key)
+
+    # Mines on top right away, then swaps in the validated history
+    fresh.template = mybitcoin.BlockTemplate(fresh, alice_public_key)
+    fresh.handle_block(mybitcoin.mine_template(fresh.template, nonce=0))
+    monkeypatch.setattr(mybitcoin, "send_message", lambda peer, command, data, response: {"data": node.fetch_blocks(data)})
+    assert mybitcoin.validate_snapshot(fresh, peers=[("peer", mybitcoin.PORT)])
+    assert fresh.blocks[:5] == node.blocks and all(isinstance(block, mybitcoin.Block) for block in fresh.blocks)
+    assert fresh.snapshot is None
+
+    with open(path, "r+b") as f: # Flip a bit in the utxos
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 1]))
+    fresh = mybitcoin.Node(address=("fresh", mybitcoin.PORT))
+    fresh.connect_block(node.blocks[0])
+    with pytest.raises(AssertionError, match="hash"):
+        mybitcoin.load_snapshot(fresh, path)
+
+def test_snapshot_requests_only_write_to_the_snapshot_directory(monkeypatch, tmp_path):
+    node = make_chain(monkeypatch, 1)
+    monkeypatch.setattr(mybitcoin, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    responses = []
+    respond = lambda command, data: responses.extend(data) # Runs the deferred dump
+    for name in ["../escaped.dat", "/tmp/escaped.dat", ".hidden", ""]:
+        with pytest.raises(AssertionError, match="Snapshot names"):
+            mybitcoin.handle_message(node, "dumptxoutset", name, ("client", mybitcoin.PORT), respond)
+    mybitcoin.handle_message(node, "dumptxoutset", "utxos.dat", ("client", mybitcoin.PORT), respond)
+    assert responses[0]["path"] == str(tmp_path / "snapshots" / "utxos.dat")
+    assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == ["utxos.dat"]
+
+def test_block_store_caches_and_reclaims_segments():
+    store = BlockStore(cache_bytes=100, segment_bytes=150)
+    for i in range(6):
+        store.put(i, bytes(60) + bytes([i]))
+    assert store.cached_bytes <= 100 and len(store.segments) == 3
+    assert store.get(0) == bytes(60) + bytes([0]) and store.misses == 1 # Read back from disk
+    store.discard(0)
+    assert 0 not in store and len(store.segments) == 3
+    store.discard(1) # The first segment is now empty
+    assert len(store.segments) == 2 and store.get(2)[-1] == 2
+
+
+def test_pruning_keeps_headers_and_undo(monkeypatch):
+    monkeypatch.setattr(mybitcoin, "STALE_BRANCH_DEPTH", 3)
+    node = make_chain(monkeypatch, 2)
+    rival = mybitcoin.Node(address=("rival", mybitcoin.PORT))
+    for block in node.blocks[:-1]:
+        rival.connect_block(block)
+    fork = mybitcoin.mine_template(mybitcoin.BlockTemplate(rival, alice_public_key), nonce=0)
+    node.handle_block(fork)
+    assert len(node.branches) == 1
+
+    node.blocks.prune_depth = 3
+    for _ in range(4):
+        node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+    assert node.branches == [] # Its tip fell 3 blocks behind ours
+
+    # Genesis and the last 3 bodies are kept, the rest are headers
+    assert [isinstance(block, mybitcoin.Block) for block in node.blocks] == [True, False, False, False, True, True, True]
+    assert node.fetch_blocks([node.blocks.headers[1].id]) == [None]
+    assert all(header.id in node.undo for header in node.blocks.headers)
+    assert len(node.fetch_headers([])) == 7 and node.find_tx(node.blocks[-1].txns[0].id)[0] == node.blocks[-1]
+
+    # Nothing is disconnected when a reorg would go below the pruned blocks
+    with pytest.raises(AssertionError, match="pruned"):
+        node.reorg([fork], 0)
+    assert len(node.blocks) == 7
+
+def test_tx_and_history_indexes_follow_reorgs(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    coin = node.fetch_utxos(bob_public_key)[0]
+    tx = mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 1100)
+    node.handle_tx(tx)
+    node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+
+    def indexed(blocks):
+        fresh = mybitcoin.Node(address=("fresh", mybitcoin.PORT))
+        fresh.tx_index, fresh.history = {}, {}
+        fresh.connect_block(blocks[0])
+        for block in blocks[1:]:
+            fresh.handle_block(block)
+        return fresh
+
+    fresh = indexed(node.blocks)
+    found = fresh.fetch_tx(tx.id)
+    assert (found["tx"].id, found["height"], found["index"], found["confirmations"]) == (tx.id, 3, 1, 1)
+    page = fresh.fetch_history(bob_public_key, start=0, limit=2)
+    assert [entry["height"] for entry in page["entries"]] == [1, 2] and page["next"] == 2
+    page = fresh.fetch_history(bob_public_key, start=page["next"], limit=3) # Coinbase, spend, change
+    assert [(entry["height"], entry["spent"]) for entry in page["entries"]] == [(3, False), (3, True), (3, False)]
+    assert page["entries"][1]["outpoint"] == coin.outpoint and page["next"] is None
+
+    # Reorg away the block with tx; the indexes match ones built from scratch
+    rival = mybitcoin.Node(address=("rival", mybitcoin.PORT))
+    for block in node.blocks[:-1]:
+        rival.connect_block(block)
+    rival.template = mybitcoin.BlockTemplate(rival, alice_public_key)
+    for _ in range(2):
+        rival.handle_block(mybitcoin.mine_template(rival.template, nonce=0))
+    for block in rival.blocks[3:]:
+        fresh.handle_block(block)
+    assert fresh.blocks.headers[-1].id == rival.blocks.headers[-1].id
+    assert fresh.fetch_tx(tx.id)["confirmations"] == 0 # Back in the mempool
+    rebuilt = indexed(rival.blocks)
+    assert fresh.tx_index == rebuilt.tx_index and fresh.history == rebuilt.history
+
+@contextmanager
+def serving():
+    # The node in mybitcoin.node, listening on a free local port
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), mybitcoin.TCPHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, args=[0.05], daemon=True).start()
+    try:
+        yield server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_pipelined_batches_over_one_connection(monkeypatch):
+    node = make_chain(monkeypatch, 3)
+    monkeypatch.setattr(mybitcoin, "PIPELINE_DEPTH", 2)
+    keys = [alice_public_key, bob_public_key, SigningKey.generate(curve=SECP256k1).get_verifying_key()]
+    threads, handle_message = set(), mybitcoin.handle_message
+    monkeypatch.setattr(mybitcoin, "handle_message",
+                        lambda *args: threads.add(threading.current_thread().name) or handle_message(*args))
+    with serving() as address, mybitcoin.Connection(address) as connection:
+        responses = connection.pipeline([("balance", keys), ("utxos", keys), ("balance", bob_public_key)] * 3)
+    assert threads == {"handler"} and "handler" in mybitcoin.PROFILE_THREAD_NAMES # Sampled by the profiler
+
+    assert [response["id"] for response in responses] == list(range(9))
+    assert responses[0]["data"] == [node.fetch_balance(key) for key in keys] == [50 * 10**8, 150 * 10**8, 0]
+    assert responses[1]["data"] == [node.fetch_utxos(key) for key in keys]
+    assert responses[8]["data"] == 150 * 10**8
+
+def test_metric_labels_stay_bounded(monkeypatch):
+    node = make_chain(monkeypatch, 1)
+    command_seconds, peer_bytes = Histogram("commands", ""), Counter("bytes", "")
+    monkeypatch.setattr(mybitcoin, "command_seconds", command_seconds)
+    monkeypatch.setattr(mybitcoin, "peer_bytes", peer_bytes)
+    with serving() as address, mybitcoin.Connection(address) as connection:
+        for command in ["made-up-1", "made-up-2", ["not", "hashable"]]:
+            connection._send(command, None)
+        stats = connection.request("stats", None)["data"]
+        node.peers.append(("127.0.0.1", mybitcoin.PORT))
+        connection.request("ping", None)
+    assert stats["powcoin_mempool_bytes"] == {"": 0}
+    assert command_seconds.values[(("command", "other"),)]["count"] == 3
+    assert {dict(key)["command"] for key in command_seconds.values} <= {"other", "stats", "ping"}
+    assert {dict(key)["peer"] for key in peer_bytes.values} == {"other", "127.0.0.1"} # Once it's a peer
+
+    # Gauges wait for the node lock rather than read a changing mempool
+    gauge = mybitcoin.registry.metrics["powcoin_mempool_bytes"]
+    with mybitcoin.lock:
+        reader = threading.Thread(target=gauge.snapshot)
+        reader.start()
+        reader.join(0.1)
+        assert reader.is_alive()
+    reader.join()
+
+def test_utxo_pages_survive_changes_and_stream(monkeypatch):
+    utxos = mybitcoin.UtxoSet()
+    tx_outs = [mybitcoin.TxOut(mybitcoin.new_tx_id(), 0, amount, alice_public_key) for amount in range(7)]
+    for tx_out in tx_outs:
+        utxos[tx_out.outpoint] = tx_out
+    ordered = sorted(tx_outs, key=lambda tx_out: tx_out.outpoint)
+
+    page, cursor = utxos.page(alice_public_key, limit=3)
+    assert page == ordered[:3]
+    del utxos[ordered[4].outpoint] # Spent between pages
+    added = mybitcoin.TxOut(mybitcoin.new_tx_id(), 0, 7, alice_public_key)
+    utxos[added.outpoint] = added
+    walked = page
+    while cursor is not None:
+        page, cursor = utxos.page(alice_public_key, cursor, limit=3)
+        walked += page
+    survivors = ordered[:4] + ordered[5:]
+    assert [tx_out for tx_out in walked if tx_out != added] == survivors
+
+    node = make_chain(monkeypatch, 5)
+    with serving() as address, mybitcoin.Connection(address) as connection:
+        request = {"public_key": bob_public_key, "stream": True, "limit": 2}
+        pages = list(connection.stream("utxos", request, last=lambda page: page["next"] is None))
+    assert [len(page["utxos"]) for page in pages] == [2, 2, 1]
+    streamed = [tx_out for page in pages for tx_out in page["utxos"]]
+    assert streamed == sorted(node.fetch_utxos(bob_public_key), key=lambda tx_out: tx_out.outpoint)
+
+def test_subscribers_are_pushed_payments_and_tips(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    subscriber = mybitcoin.Subscriber([alice_public_key], tips=True)
+    node.subscribe(subscriber)
+    coin = node.fetch_utxos(bob_public_key)[0]
+    tx = mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 1100)
+    node.handle_tx(tx)
+    node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+    events = subscriber.next_notification()["events"]
+    assert [event["event"] for event in events] == ["received", "confirmed", "tip"]
+    assert events[1]["tx_id"] == tx.id and events[1]["amount"] == 1000 and events[1]["height"] == 3
+
+    # Reorged out, then back in the mempool
+    rival = mybitcoin.Node(address=("rival", mybitcoin.PORT))
+    for block in node.blocks[:-1]:
+        rival.connect_block(block)
+    rival.template = mybitcoin.BlockTemplate(rival, bob_public_key)
+    for _ in range(2):
+        rival.handle_block(mybitcoin.mine_template(rival.template, nonce=0))
+    for block in rival.blocks[3:]:
+        node.handle_block(block)
+    events = subscriber.next_notification()["events"]
+    assert [event["event"] for event in events] == ["reorged", "received", "tip", "tip"]
+    assert events[0]["tx_id"] == tx.id and events[0]["height"] == 3
+    node.unsubscribe(subscriber)
+    assert not node.subscribers and not node.watchers
+
+def test_slow_subscribers_miss_the_oldest_events(monkeypatch):
+    monkeypatch.setattr(mybitcoin, "SUBSCRIBER_BUFFER", 3)
+    subscriber = mybitcoin.Subscriber(tips=True)
+    for height in range(5):
+        subscriber.push({"event": "tip", "height": height})
+    notification = subscriber.next_notification()
+    assert [event["height"] for event in notification["events"]] == [2, 3, 4]
+    assert notification["missed"] == 2
+    monkeypatch.setattr(mybitcoin, "SUBSCRIBER_HEARTBEAT", 0.01)
+    assert subscriber.next_notification() == {"events": [], "missed": 0} # Heartbeat
+
+def test_subscriptions_over_a_connection(monkeypatch):
+    node = make_chain(monkeypatch, 1)
+    monkeypatch.setattr(mybitcoin, "SUBSCRIBER_HEARTBEAT", 0.05)
+    with serving() as address:
+        with mybitcoin.Connection(address) as connection:
+            notifications = connection.stream("subscribe", {"tips": True})
+            assert next(notifications) == {"events": [], "missed": 0} # Subscribed
+            assert len(node.subscribers) == 1
+            block = mybitcoin.mine_template(node.template, nonce=0)
+            with mybitcoin.lock:
+                node.handle_block(block)
+            notification = next(notification for notification in notifications if notification["events"])
+            assert notification["events"] == [{"event": "tip", "block_id": node.blocks[-1].id, "height": 2}]
+        # The next heartbeat fails to send and the handler unsubscribes
+        for _ in range(100):
+            if not node.subscribers:
+                break
+            mybitcoin.time.sleep(0.05)
+        assert not node.subscribers
+
+def test_sync_batches_are_prechecked_in_workers(monkeypatch):
+    node = make_chain(monkeypatch, 2)
+    for _ in range(3):
+        for coin in node.fetch_utxos(bob_public_key)[:2]:
+            node.handle_tx(mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 1100))
+        node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+    batch = node.blocks[1:]
+
+    def fresh():
+        fresh = mybitcoin.Node(address=("fresh", mybitcoin.PORT))
+        fresh.connect_block(node.blocks[0])
+        fresh.peers = [("peer", mybitcoin.PORT)]
+        fresh.sent = []
+        fresh.send = lambda peer, command, data: fresh.sent.append((command, data, len(fresh.blocks)))
+        fresh.propagate_block = lambda block: None
+        return fresh
+
+    verified = []
+    verify_input = mybitcoin.Tx.verify_input
+    monkeypatch.setattr(mybitcoin.Tx, "verify_input", lambda tx, *args: verified.append(tx) or verify_input(tx, *args))
+    monkeypatch.setattr(mybitcoin, "GET_BLOCKS_CHUNK", len(batch))
+    context = multiprocessing.get_context("forkserver")
+    with concurrent.futures.ProcessPoolExecutor(2, mp_context=context) as pool:
+        monkeypatch.setattr(mybitcoin, "sync_pool", pool)
+        synced = fresh()
+        encoded = [mybitcoin.encode_block(block) for block in batch]
+        mybitcoin.handle_message(synced, "blocks", encoded, ("peer", mybitcoin.PORT), None)
+        # The next batch was asked for before this one was connected
+        assert synced.sent == [("sync", [node.blocks[0].id] + [block.id for block in batch], 1)]
+        assert synced.blocks.headers[-1].id == node.blocks[-1].id
+        assert synced.utxo_set.owned_by(alice_public_key) == node.utxo_set.owned_by(alice_public_key)
+        assert verified == [] # Every signature was checked by the workers
+
+        # A block failing its precheck is rejected, and its descendants are
+        # dropped rather than each asking peers for the missing parent
+        rejected = fresh()
+        bad = deepcopy(batch[3])
+        bad.txns = bad.txns[:1] # No longer matches the merkle root
+        encoded[3] = mybitcoin.encode_block(bad)
+        mybitcoin.handle_message(rejected, "blocks", encoded, ("peer", mybitcoin.PORT), None)
+        assert rejected.blocks.headers[-1].id == batch[2].id
+        assert [command for command, data, height in rejected.sent] == ["sync"]
+
+    # Workers aren't given keys to check for assumed valid blocks
+    assumed = fresh()
+    assumed.assumed_valid = {block.id for block in batch[:3]}
+    keys = mybitcoin.spent_keys(assumed, batch)
+    assert keys[2] and all(key is None for tx_keys in keys[2] for key in tx_keys)
+    assert all(key is not None for tx_keys in keys[3] for key in tx_keys)
+
+def test_block_headers_are_checked_before_bodies(monkeypatch):
+    node = make_chain(monkeypatch, 3)
+    fresh = mybitcoin.Node(address=("fresh", mybitcoin.PORT))
+    fresh.connect_block(node.blocks[0])
+    decoded = []
+    decode_block = mybitcoin.decode_block
+    monkeypatch.setattr(mybitcoin, "decode_block", lambda header, encoded: decoded.append(header) or decode_block(header, encoded))
+
+    def junk(block, **changes):
+        header = mybitcoin.BlockHeader(block.prev_id, block.merkle_root, block.nonce, block.bits, block.timestamp)
+        for name, value in changes.items():
+            setattr(header, name, value)
+        while header.proof < header.target and "nonce" not in changes: # Make sure it's unmined
+            header.nonce += 1
+        return header.header + b"junk"
+
+    # No proof-of-work, or difficulty too low for its parent: bodies never parsed
+    for encoded in [junk(node.blocks[1]), junk(node.blocks[1], bits=0, nonce=0)]:
+        mybitcoin.handle_message(fresh, "blocks", [encoded], ("peer", mybitcoin.PORT), None)
+    assert decoded == [] and len(fresh.blocks) == 1
+
+    # Headers passing but not linked to the previous one end the batch
+    encoded = [mybitcoin.encode_block(block) for block in node.blocks[1:]]
+    mybitcoin.handle_message(fresh, "blocks", [encoded[0], encoded[2]], ("peer", mybitcoin.PORT), None)
+    assert len(decoded) == 1 and fresh.blocks.headers[-1].id == node.blocks[1].id
+    mybitcoin.handle_message(fresh, "blocks", encoded[1:], ("peer", mybitcoin.PORT), None)
+    assert fresh.blocks.headers[-1].id == node.blocks[-1].id
+
+def test_fee_estimates_follow_confirmation_times():
+    estimator = FeeEstimator()
+    for height in range(30): # 10 sat/byte txns confirm in the next block, 2 sat/byte ones in 5
+        estimator.decay()
+        for i in range(4):
+            estimator.confirmed_at(("fast", height - 1, i), height)
+            estimator.confirmed_at(("slow", height - 5, i), height)
+            estimator.track(("fast", height, i), 10, height)
+            estimator.track(("slow", height, i), 2, height)
+    fast, slow = estimator.boundaries[estimator.bucket(10)], estimator.boundaries[estimator.bucket(2)]
+    assert estimator.estimate(1, 29) == estimator.estimate(4, 29) == fast
+    assert estimator.estimate(5, 29) == estimator.estimate(10, 29) == slow
+    estimator.forget(("slow", 29, 0))
+    assert ("slow", 29, 0) not in estimator.tracked
+    assert FeeEstimator().estimate(1, 29) is None
+
+def test_node_estimates_fees_from_its_mempool(monkeypatch):
+    node = make_chain(monkeypatch, 3)
+    for coin in node.fetch_utxos(bob_public_key):
+        node.handle_tx(mybitcoin.prepare_tx([coin], bob_private_key, [(alice_public_key, 1000)], coin.amount - 51000))
+    fee_rates = [entry.fee / entry.size for entry in node.mempool.values()]
+    assert len(node.fee_estimator.tracked) == 3
+    node.handle_block(mybitcoin.mine_template(node.template, nonce=0))
+    assert not node.fee_estimator.tracked
+    responses = []
+    mybitcoin.handle_message(node, "estimatefee", 1, ("client", mybitcoin.PORT),
+                             lambda command, data: responses.append(data))
+    assert responses == [node.fee_estimator.boundaries[node.fee_estimator.bucket(min(fee_rates))]]
+
+def test_handshake_when_both_nodes_dial_at_once():
+    queue = []
+    nodes = [mybitcoin.Node(address=(name, mybitcoin.PORT)) for name in ["a", "b"]]
+    for node in nodes:
+        node.send = lambda peer, command, data, node=node: queue.append((node.address, peer, command, data))
+    by_address = {node.address: node for node in nodes}
+    nodes[0].connect(nodes[1].address)
+    nodes[1].connect(nodes[0].address) # Before either "connect" arrives
+    while queue:
+        sender, receiver, command, data = queue.pop(0)
+        mybitcoin.handle_message(by_address[receiver], command, data, sender, None)
+    assert nodes[0].peers == [nodes[1].address] and nodes[1].peers == [nodes[0].address]
+    assert not nodes[0].pending_peers and not nodes[1].pending_peers
+
+def test_owned_outpoints_stay_sorted(monkeypatch):
+    monkeypatch.setattr(mybitcoin, "OWNED_CHUNK", 2)
+    rng = mybitcoin.random.Random(0)
+    owned, expected = mybitcoin.Owned(), set()
+    for _ in range(500):
+        if expected and rng.random() < 0.4:
+            packed = rng.choice(sorted(expected))
+            owned.remove(packed)
+            expected.discard(packed)
+        else:
+            packed = rng.randbytes(36)
+            owned.add(packed)
+            expected.add(packed)
+        assert list(owned) == sorted(expected)
+        after = rng.choice([None] + sorted(expected)) if expected else None
+        assert owned.following(after, 3) == [packed for packed in sorted(expected) if after is None or packed > after][:3]
+    assert all(0 < len(chunk) <= 4 for chunk in owned.chunks)
+
+    utxos = mybitcoin.UtxoSet()
+    with pytest.raises(AssertionError, match="at least one"):
+        utxos.page(alice_public_key, limit=0)
+
+def test_benchmarks_compare_against_the_stored_baseline():
+    with open(benchmark.BASELINE_FILE) as f:
+        baseline = json.load(f)["results"]
+    results = deepcopy(baseline)
+    results["validate_block_secs"]["value"] *= 1.5
+    results["mine_block_hashes_per_sec"]["value"] *= 1.5 # Faster is fine
+    assert benchmark.compare(results, baseline, tolerance=20) == ["validate_block_secs"]
+
+def test_simulated_network_converges():
+    args = {"nodes": 4, "peers": 2, "duration": 60, "block_interval": 10, "tx_rate": 0,
+            "latency": "fixed:0.1", "bandwidth": 10**6, "loss": 0, "partitions": [], "seed": 1}
+    report = Simulator(args).run()
+    assert report["blocks_mined"] > 0
+    assert report["nodes_in_consensus"] == 4
+
+
+def test_genesis_block_is_loaded_not_mined():
+    node = mybitcoin.Node(address=("test", mybitcoin.PORT))
+    genesis = mybitcoin.load_genesis_block(node, mybitcoin.lookup_public_key("alice"))
+    assert genesis.proof < genesis.target
+    assert node.blocks == [genesis]
+
+
+def test_capture_replays_into_fresh_node(monkeypatch, tmp_path):
+    chain = make_chain(monkeypatch, 3)
+    path = tmp_path / "capture.log"
+    writer = CaptureWriter(path)
+    for block in chain.blocks[1:]:
+        writer.record(0.0, "peer", mybitcoin.prepare_message("blocks", [mybitcoin.encode_block(block)])[4:])
+    writer.close()
+
+    monkeypatch.setattr(mybitcoin, "load_genesis_block", lambda node, key: node.connect_block(chain.blocks[0]))
+    report = replay(path)
+    assert report["height"] == 3
+    assert report["commands"]["blocks"]["count"] == 3
+    assert report["commands"]["blocks"]["errors"] == 0
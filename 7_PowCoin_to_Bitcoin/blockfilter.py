@@ -0,0 +1,111 @@
+"""
+Golomb-coded set filters for blocks
+
+A filter answers "might this block touch any of these items?" with no false
+negatives and a false positive rate of about 1/M per item. Items are hashed
+into the range [0, N * M) with a key taken from the block id, sorted, and the
+gaps between them are Golomb-Rice coded with parameter P.
+"""
+
+import hashlib
+
+P = 19
+M = 784931
+
+
+def hash_to_range(key, item, f):
+    digest = hashlib.blake2b(item, digest_size=8, key=key).digest()
+    return (int.from_bytes(digest, "big") * f) >> 64
+
+
+def hashed_set(key, items, n):
+    return sorted(set(hash_to_range(key, item, n * M) for item in items))
+
+
+class BitWriter:
+    def __init__(self):
+        self.bits = []
+
+    def write(self, value, count):
+        for i in range(count - 1, -1, -1):
+            self.bits.append((value >> i) & 1)
+
+    def write_unary(self, value):
+        self.bits.extend([1] * value)
+        self.bits.append(0)
+
+    def to_bytes(self):
+        data = bytearray((len(self.bits) + 7) // 8)
+        for i, bit in enumerate(self.bits):
+            if bit:
+                data[i // 8] |= 0x80 >> (i % 8)
+        return bytes(data)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read_bit(self):
+        byte = self.data[self.position // 8]
+        bit = (byte >> (7 - self.position % 8)) & 1
+        self.position += 1
+        return bit
+
+    def read(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.read_bit()
+        return value
+
+    def read_unary(self):
+        value = 0
+        while self.read_bit():
+            value += 1
+        return value
+
+
+def build_filter(key, items):
+    items = set(items)
+    n = len(items)
+    writer = BitWriter()
+    last = 0
+    for value in hashed_set(key, items, n):
+        delta = value - last
+        writer.write_unary(delta >> P)
+        writer.write(delta & ((1 << P) - 1), P)
+        last = value
+    return n.to_bytes(4, "big") + writer.to_bytes()
+
+
+def decode_filter(block_filter):
+    # Yields the sorted hashed values in the filter
+    n = int.from_bytes(block_filter[:4], "big")
+    reader = BitReader(block_filter[4:])
+    value = 0
+    for _ in range(n):
+        delta = (reader.read_unary() << P) | reader.read(P)
+        value += delta
+        yield value
+
+
+def match_any(key, block_filter, items):
+    n = int.from_bytes(block_filter[:4], "big")
+    if n == 0 or not items:
+        return False
+    # Walk the two sorted lists together
+    wanted = iter(hashed_set(key, items, n))
+    target = next(wanted)
+    for value in decode_filter(block_filter):
+        while target < value:
+            target = next(wanted, None)
+            if target is None:
+                return False
+        if target == value:
+            return True
+    return False
+
+
+def filter_key(block_id):
+    return bytes.fromhex(block_id)[:16]
@@ -0,0 +1,99 @@
+"""
+On-disk store of per-block records with an LRU cache in front
+
+Values are encoded into anonymous temporary segment files and found again
+through an in-memory index of (segment, offset, length). The most recently
+used values are kept decoded, up to cache_bytes of their encoded size.
+Discarding a value only drops it from the index, but once every value in a
+segment is gone the segment is closed and its disk space handed back, so
+pruning oldest first keeps the files from growing without bound.
+"""
+
+import pickle, tempfile, threading
+from collections import OrderedDict
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+
+
+class BlockStore:
+    def __init__(self, cache_bytes, encode=pickle.dumps, decode=pickle.loads, segment_bytes=SEGMENT_BYTES):
+        self.cache_bytes = cache_bytes
+        self.encode = encode
+        self.decode = decode
+        self.segment_bytes = segment_bytes
+        self.index = {} # key -> (segment, offset, length)
+        self.segments = {} # segment -> file
+        self.live = {} # segment -> values in it still indexed
+        self.segment = -1 # the one being appended to
+        self.cache = OrderedDict() # key -> (value, length), least recently used first
+        self.cached_bytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def put(self, key, value):
+        data = self.encode(value)
+        with self.lock:
+            self._discard(key)
+            if self.segment not in self.segments or self.segments[self.segment].tell() >= self.segment_bytes:
+                self.segment += 1
+                self.segments[self.segment] = tempfile.TemporaryFile()
+                self.live[self.segment] = 0
+            f = self.segments[self.segment]
+            self.index[key] = (self.segment, f.tell(), len(data))
+            f.write(data)
+            self.live[self.segment] += 1
+            self._cache(key, value, len(data)) # Just written, likely read again soon
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key][0]
+            if key not in self.index:
+                return default
+            self.misses += 1
+            segment, offset, length = self.index[key]
+            f = self.segments[segment]
+            f.seek(offset)
+            value = self.decode(f.read(length))
+            f.seek(0, 2) # Appends carry on at the end
+            self._cache(key, value, length)
+            return value
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.discard(key)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        if key in self.cache:
+            self.cached_bytes -= self.cache.pop(key)[1]
+        if key not in self.index:
+            return
+        segment, _, _ = self.index.pop(key)
+        self.live[segment] -= 1
+        if not self.live[segment] and segment != self.segment:
+            self.segments.pop(segment).close()
+            del self.live[segment]
+
+    def _cache(self, key, value, length):
+        self.cache[key] = (value, length)
+        self.cached_bytes += length
+        while self.cached_bytes > self.cache_bytes and self.cache:
+            self.cached_bytes -= self.cache.popitem(last=False)[1][1]
+
+    @property
+    def disk_bytes(self):
+        with self.lock:
+            return sum([f.seek(0, 2) for f in self.segments.values()])
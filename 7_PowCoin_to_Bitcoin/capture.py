@@ -0,0 +1,45 @@
+"""
+Append-only log of the messages a node received
+
+Each record is a fixed header (arrival time, length of the peer name, length
+of the message) followed by the peer name and the message exactly as it came
+off the wire, without the length prefix. Messages are not unpickled or
+re-encoded, so capturing costs one write per message.
+"""
+
+import struct, threading
+
+RECORD_HEADER = ">dHI" # timestamp, peer length, message length
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        self.lock = threading.Lock()
+
+    def record(self, timestamp, peer, raw_message):
+        peer = peer.encode()
+        header = struct.pack(RECORD_HEADER, timestamp, len(peer), len(raw_message))
+        with self.lock:
+            self.file.write(header + peer + raw_message)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    # Yields (timestamp, peer, raw message), stopping at a truncated record
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                return
+            timestamp, peer_length, message_length = struct.unpack(RECORD_HEADER, header)
+            peer = f.read(peer_length)
+            raw_message = f.read(message_length)
+            if len(raw_message) < message_length:
+                return
+            yield timestamp, peer.decode(), raw_message
@@ -0,0 +1,77 @@
+"""
+Fee estimation from how long mempool txns took to confirm
+
+Every tx entering the mempool is tracked with its fee rate (satoshis per
+encoded byte) and the height it arrived at. When it confirms, its fee-rate
+bucket counts one more tx, and one more confirmed within each number of
+blocks at least as many as it waited. Counts decay every block, so recent
+blocks outweigh old ones. Txns still waiting longer than a target count
+against it, so a backlog raises the estimate before anything confirms.
+
+An estimate for a target walks the buckets from the highest fee rate down,
+pooling buckets until there are enough txns to judge. It returns the lowest
+fee rate at which enough of them confirmed in time, or None without data.
+"""
+
+import bisect
+
+BUCKET_MIN = 1.0 # satoshis per byte at the bottom of the lowest bucket
+BUCKET_SPACING = 1.2 # ratio between successive bucket boundaries
+BUCKET_COUNT = 60 # reaches about 45,000 satoshis per byte
+MAX_TARGET = 48 # furthest confirmation target, in blocks
+DECAY = 0.99 # weight kept by past observations each block
+SUCCESS_THRESHOLD = 0.85 # share of txns that must confirm within the target
+MIN_SAMPLES = 1.0 # decayed txns a group of buckets needs before it's judged
+
+
+class FeeEstimator:
+    def __init__(self):
+        self.boundaries = [BUCKET_MIN * BUCKET_SPACING ** i for i in range(BUCKET_COUNT)]
+        self.total = [0.0] * BUCKET_COUNT # bucket -> decayed txns confirmed
+        self.confirmed = [[0.0] * BUCKET_COUNT for _ in range(MAX_TARGET + 1)] # blocks -> bucket -> within them
+        self.tracked = {} # tx id -> (bucket, height it entered the mempool at)
+
+    def bucket(self, fee_rate):
+        # The highest bucket whose boundary fee_rate reaches, or 0
+        return max(bisect.bisect_right(self.boundaries, fee_rate) - 1, 0)
+
+    def track(self, tx_id, fee_rate, height):
+        self.tracked[tx_id] = (self.bucket(fee_rate), height)
+
+    def forget(self, tx_id):
+        # Left the mempool without confirming
+        self.tracked.pop(tx_id, None)
+
+    def confirmed_at(self, tx_id, height):
+        if tx_id not in self.tracked:
+            return
+        bucket, entered = self.tracked.pop(tx_id)
+        blocks = max(height - entered, 1)
+        self.total[bucket] += 1
+        for target in range(blocks, MAX_TARGET + 1):
+            self.confirmed[target][bucket] += 1
+
+    def decay(self):
+        # Once per connected block
+        for bucket in range(BUCKET_COUNT):
+            self.total[bucket] *= DECAY
+            for target in range(1, MAX_TARGET + 1):
+                self.confirmed[target][bucket] *= DECAY
+
+    def estimate(self, target, height):
+        # Fee rate to confirm within `target` blocks of arriving at `height`
+        assert 1 <= target <= MAX_TARGET, f"Targets go from 1 to {MAX_TARGET} blocks"
+        waiting = [0] * BUCKET_COUNT # still in the mempool after more than target blocks
+        for bucket, entered in self.tracked.values():
+            if height - entered >= target:
+                waiting[bucket] += 1
+        best, confirmed, total = None, 0.0, 0.0
+        for bucket in reversed(range(BUCKET_COUNT)):
+            confirmed += self.confirmed[target][bucket]
+            total += self.total[bucket] + waiting[bucket]
+            if total < MIN_SAMPLES:
+                continue
+            if confirmed / total < SUCCESS_THRESHOLD:
+                break
+            best, confirmed, total = self.boundaries[bucket], 0.0, 0.0
+        return best
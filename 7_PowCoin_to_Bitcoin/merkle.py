@@ -0,0 +1,108 @@
+"""
+Merkle tree over a block's transactions
+
+Leaves and interior nodes are hashed with different prefixes so a leaf can
+never be passed off as an interior node. A node without a sibling is promoted
+to the next level unchanged rather than being paired with itself, which keeps
+two different transaction lists from sharing a root.
+
+Every level of the tree is cached, so appending or replacing a leaf only
+rehashes the path from that leaf to the root.
+"""
+
+import hashlib
+
+EMPTY_ROOT = bytes(32)
+
+
+def hash_leaf(data):
+    return hashlib.sha256(b"\x00" + data).digest()
+
+
+def hash_node(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+class MerkleTree:
+    def __init__(self, leaves=()):
+        self.levels = [list(leaves)]
+        self._rebuild()
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @property
+    def root(self):
+        if not self.levels[0]:
+            return EMPTY_ROOT
+        return self.levels[-1][0]
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        self._update_path(len(self.levels[0]) - 1)
+
+    def update(self, index, leaf):
+        self.levels[0][index] = leaf
+        self._update_path(index)
+
+    def remove(self, index):
+        # Everything to the right of the leaf shifts, so rebuild from there
+        leaves = self.levels[0]
+        del leaves[index]
+        self.levels = [leaves[:index]]
+        self._rebuild()
+        for leaf in leaves[index:]:
+            self.append(leaf)
+
+    def _rebuild(self):
+        level = self.levels[0]
+        while len(level) > 1:
+            level = [self._parent(level, i) for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    def _parent(self, level, index):
+        # Hash of the node above level[index]
+        left = index - index % 2
+        if left + 1 < len(level):
+            return hash_node(level[left], level[left + 1])
+        return level[left]
+
+    def _update_path(self, index):
+        depth = 0
+        while len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[depth + 1]
+            parent_index = index // 2
+            parent = self._parent(level, index)
+            if parent_index < len(parents):
+                parents[parent_index] = parent
+            else:
+                parents.append(parent)
+            index = parent_index
+            depth += 1
+
+    def proof(self, index):
+        # List of (sibling hash, sibling is on the left) from leaf to root
+        path = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                path.append((level[sibling], sibling < index))
+            index //= 2
+        return path
+
+
+def merkle_root(leaves):
+    return MerkleTree(leaves).root
+
+
+def verify_proof(leaf, proof, root):
+    node = leaf
+    for sibling, sibling_is_left in proof:
+        if sibling_is_left:
+            node = hash_node(sibling, node)
+        else:
+            node = hash_node(node, sibling)
+    return node == root
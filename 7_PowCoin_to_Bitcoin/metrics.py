@@ -0,0 +1,188 @@
+"""
+Counters, gauges and histograms for a running node
+
+Every metric keeps one value per combination of label values, e.g.
+histogram.observe(0.2, phase="pow"). A Registry renders everything either as
+a dict, for the "stats" command, or in the Prometheus text format for
+scraping. Updates take a per-metric lock, which is cheap next to anything
+worth measuring.
+"""
+
+import bisect, http.server, threading, time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            return {format_labels(key) or "": value for key, value in self.values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, func=None):
+        super().__init__(name, help)
+        self.func = func # computed when read, so it costs nothing until then
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+    def snapshot(self):
+        if self.func:
+            return {"": self.func()}
+        return super().snapshot()
+
+    def render(self):
+        if self.func:
+            return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                    f"{self.name} {self.func()}"]
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0, "count": 0}
+            entry = self.values[key]
+            entry["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {format_labels(key) or "": {"count": entry["count"], "sum": entry["sum"],
+                                                "buckets": dict(zip(self.buckets + ("+Inf",), entry["counts"]))}
+                    for key, entry in self.values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, entry in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), entry["counts"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{format_labels(key)} {entry['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, func=None):
+        return self.register(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedLock:
+    # A lock that records how long callers waited for it and held it
+    def __init__(self, name, wait, hold):
+        self.name = name
+        self.lock = threading.Lock()
+        self.wait = wait
+        self.hold = hold
+        self.acquired_at = None
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.wait.observe(self.acquired_at - start, lock=self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.hold.observe(time.perf_counter() - self.acquired_at, lock=self.name)
+        self.lock.release()
+
+
+def serve_metrics(registry, port):
+    # Plain-text scrape endpoint
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.serve_forever()
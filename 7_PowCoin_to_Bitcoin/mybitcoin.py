@@ -2,24 +2,64 @@
 POWCoin
 
 Usage:
-  powcoin.py serve
+  powcoin.py serve [--metrics-port=<port>] [--profile=<dir>] [--capture=<file>] [--assume-valid=<id>] [--snapshot=<file>] [--prune=<depth>] [--txindex] [--addressindex]
   powcoin.py ping [--node <node>]
-  powcoin.py tx <from> <to> <amount> [--node <node>]
-  powcoin.py balance <name> [--node <node>]
+  powcoin.py stats [--node <node>]
+  powcoin.py dumptxoutset <file> [--node <node>]
+  powcoin.py tx <from> (<to> <amount>)... [--node <node>] [--target=<blocks>]
+  powcoin.py estimatefee <blocks> [--node <node>]
+  powcoin.py balance <name>... [--node <node>] [--spv]
+  powcoin.py gettx <tx_id> [--node <node>]
+  powcoin.py utxos <name> [--node <node>]
+  powcoin.py subscribe [<name>...] [--tips] [--node <node>]
+  powcoin.py history <name> [--start=<n>] [--limit=<n>] [--node <node>]
 
 Options:
-  -h --help      Show this screen.
-  --node=<node>  Hostname of node [default: node0]
+  -h --help              Show this screen.
+  --node=<node>          Hostname of node [default: node0]
+  --spv                  Check the node's answer against a local header chain
+                         (needs a node serving with --txindex)
+  --metrics-port=<port>  Also serve metrics as plain text over HTTP
+  --profile=<dir>        Write stack samples and phase traces to <dir>
+                         (or set POWCOIN_PROFILE)
+  --capture=<file>       Append every inbound message to <file> for replay.py
+                         (or set POWCOIN_CAPTURE)
+  --assume-valid=<id>    Skip signature checks in this block and its ancestors
+                         (or set POWCOIN_ASSUME_VALID)
+  --snapshot=<file>      Start from a utxo snapshot written by dumptxoutset,
+                         validating the history behind it in the background
+  --prune=<depth>        Only keep the bodies of the last <depth> blocks; headers
+                         and undo data are kept (or set POWCOIN_PRUNE)
+  --txindex              Index confirmed txns by id for gettx
+                         (or set POWCOIN_TXINDEX)
+  --addressindex         Index every key's receipts and spends for history
+                         (or set POWCOIN_ADDRESSINDEX)
+  --tips                 Also be notified of each new chain tip
+  --target=<blocks>      Pay a fee to confirm within this many blocks [default: 2]
+  --start=<n>            History entries to skip [default: 0]
+  --limit=<n>            History entries per page [default: 100]
 """
 
-import uuid, socketserver, socket, sys, argparse, time, os, logging, threading, hashlib, random, re, pickle
+import socketserver, socket, sys, argparse, time, os, logging, threading, hashlib, random, re, pickle, struct, json, atexit, io, heapq, signal, math, bisect
+import concurrent.futures, functools, inspect, multiprocessing
+from array import array
+from collections import OrderedDict, deque
 from docopt import docopt
 from copy import deepcopy
-from ecdsa import SigningKey, SECP256k1
+from ecdsa import SigningKey, VerifyingKey, SECP256k1
+from ecdsa.ellipticcurve import PointJacobi
+from merkle import MerkleTree, hash_leaf, merkle_root, verify_proof
+from blockfilter import build_filter, filter_key, match_any
+from metrics import InstrumentedLock, Registry, serve_metrics
+from profiling import SamplingProfiler, Tracer
+from capture import CaptureWriter
+from blockstore import BlockStore
+from fees import FeeEstimator
 
 PORT = 10000
 node = None
-lock = threading.Lock()
+capture = None # CaptureWriter when inbound messages are being recorded
+sync_pool = None # worker processes checking synced blocks ahead of connect_block, when serving
 mining_interrupt = threading.Event()
 
 SATOSHIS_PER_COIN = 100_000_000
@@ -27,25 +67,202 @@ GET_BLOCKS_CHUNK = 10
 HALVENING_INTERVAL = 60 * 24 # daily (assuming 1 minute blocks)
 
 INITIAL_DIFFICULTY_BITS = 17
+GENESIS_NONCE = 14521 # found by mine_genesis_block
+GENESIS_BLOCK_ID = "00006601f1914997a8941f21c322985784c91cfacd55fbe7a1bf4dd5d05053d4"
 BLOCK_TIME_IN_SECS = 1
 
+COMMANDS = ("connect", "connect-response", "peers", "peers-response", "ping", "sync", "blocks", "tx",
+            "balance", "utxos", "subscribe", "gettx", "history", "headers", "filters", "getblocks",
+            "estimatefee", "stats", "dumptxoutset", "utxo-proofs") # anything else is timed as "other"
+
 BLOCKS_PER_DIFFICULTY_PERIOD = 5
 DIFFICULTY_PERIOD_IN_SECS = BLOCK_TIME_IN_SECS * BLOCKS_PER_DIFFICULTY_PERIOD
 
+HEADER_FORMAT = ">32s32sdiQ" # prev_id, merkle_root, timestamp, bits, nonce
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_HEADERS = 2000 # headers served per "headers" request
+SPV_HEADERS_FILE = "headers.dat" # where the light client keeps its header chain
+RESCAN_CHUNK = 500 # filters requested at a time during a rescan
+
+COIN_SELECTION_TRIES = 100_000 # search steps before coin selection settles
+WALLET_COST_OF_CHANGE = 1000 # leftover satoshis given to the fee instead of a change output
+WALLET_PENDING_TIMEOUT = 60 * 60 # seconds before an unconfirmed spend is released
+WALLET_FILE = "wallet-{}.dat"
+
+KEY_CACHE_SIZE = 10_000 # parsed verifying keys kept
+KEY_CACHE_HOT_SIZE = 256 # keys that also keep a precomputed multiplication table
+KEY_CACHE_HOT_LOOKUPS = 8 # lookups before a key gets its table
+
+BLOCK_CACHE_BYTES = 16 * 1024 * 1024 # encoded blocks kept in memory, most recently used first
+UNDO_CACHE_BYTES = 4 * 1024 * 1024 # same for undo data
+STALE_BRANCH_DEPTH = 100 # blocks a branch's tip can fall behind ours before it's dropped
+
+UTXO_PAGE_SIZE = 1000 # utxos per page or streamed chunk
+OWNED_CHUNK = 512 # outpoints per sorted chunk of a key's utxo index, split at twice this
+MAX_BATCH_KEYS = 1000 # public keys in one balance or utxos request
+PIPELINE_DEPTH = 32 # requests a Connection sends before waiting for responses
+SUBSCRIBER_BUFFER = 1000 # events held for a subscriber before the oldest are dropped
+SUBSCRIBER_HEARTBEAT = 30 # seconds without events before an empty notification
+HISTORY_MAX_PAGE = 1000 # history entries returned per request
+
+SNAPSHOT_MAGIC = b"powutxo1"
+SNAPSHOT_DIR = "snapshots" # where dumptxoutset requests write, under the node's working directory
+SNAPSHOT_WRITE_CHUNK = 10_000 # utxos encoded per write when dumping a snapshot
+SNAPSHOT_RETRY_INTERVAL = 5 # seconds before asking peers again for snapshot history
+
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+PROFILE_FLUSH_INTERVAL = 10 # seconds between writes of profile output
+PROFILE_THREAD_NAMES = ("main", "miner", "server", "handler", "relay") # prefixes of the threads sampled
+
+STARTUP_SYNC_TIMEOUT = 5 # seconds to wait for initial sync before mining
+
+MEMPOOL_MAX_ANCESTORS = 25 # unconfirmed txns in a chain, counting the tx itself
+MEMPOOL_FILE = "mempool-{}.dat"
+MEMPOOL_DUMP_INTERVAL = 60 # seconds between mempool dumps
+MEMPOOL_LOAD_BATCH = 200 # txns revalidated together when reloading the mempool
+DEFAULT_FEE_RATE = 1 # satoshis per byte paid while the node has no estimate
+
+TEMPLATE_MAX_BYTES = 100_000 # encoded txns the miner puts in a template
+TEMPLATE_POLL_INTERVAL = 1000 # nonces between checks for a newer template
+TEMPLATE_TIMESTAMP_INTERVAL = 1 # seconds before the template timestamp is refreshed
+TEMPLATE_RESELECT_INTERVAL = 5 # seconds a template may leave out better-paying txns
+
 
 logging.basicConfig(level="INFO", format='%(threadName)-6s | %(message)s')
 logger = logging.getLogger(__name__)
 
+registry = Registry()
+hashes_total = registry.counter("powcoin_hashes_total", "Nonces tried by the miner")
+hash_rate = registry.gauge("powcoin_hash_rate", "Nonces per second over the last template poll")
+block_validation_seconds = registry.histogram("powcoin_block_validation_seconds", "Time spent validating blocks, by phase")
+reorg_depth = registry.histogram("powcoin_reorg_depth", "Blocks disconnected per reorg", buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+lock_wait_seconds = registry.histogram("powcoin_lock_wait_seconds", "Time spent waiting for the node lock")
+lock_hold_seconds = registry.histogram("powcoin_lock_hold_seconds", "Time the node lock was held")
+peer_bytes = registry.counter("powcoin_peer_bytes_total", "Bytes sent to and received from each peer")
+command_seconds = registry.histogram("powcoin_command_seconds", "Time spent handling each command")
+key_cache_lookups = registry.counter("powcoin_key_cache_lookups_total", "Verifying key lookups, by whether the key was parsed, cached or hot")
+assumed_valid_blocks = registry.counter("powcoin_assumed_valid_blocks_total", "Blocks connected without checking signatures")
+registry.gauge("powcoin_mempool_txns", "Transactions in the mempool",
+               func=lambda: locked(lambda: len(node.mempool)) if node else 0)
+registry.gauge("powcoin_mempool_bytes", "Encoded size of the transactions in the mempool",
+               func=lambda: locked(lambda: sum([entry.size for entry in node.mempool.values()])) if node else 0)
+registry.gauge("powcoin_utxos", "Entries in the utxo set",
+               func=lambda: locked(lambda: len(node.utxo_set)) if node else 0)
+registry.gauge("powcoin_block_cache_bytes", "Encoded size of the blocks cached in memory",
+               func=lambda: node.blocks.store.cached_bytes if node else 0)
+registry.gauge("powcoin_block_store_bytes", "Size of the block store's files on disk",
+               func=lambda: node.blocks.store.disk_bytes if node else 0)
+registry.gauge("powcoin_subscribers", "Clients subscribed to chain and mempool events",
+               func=lambda: len(node.subscribers) if node else 0)
+registry.gauge("powcoin_height", "Height of the chain tip",
+               func=lambda: len(node.blocks) - 1 if node else -1)
+
+lock = InstrumentedLock("node", lock_wait_seconds, lock_hold_seconds)
+message_lock = threading.Lock() # inbound messages are handled one at a time
+tracer = Tracer()
+
+
+def locked(func):
+    # For gauges, which are read by the stats command and metrics scrapes
+    # while other threads change the node
+    with lock:
+        return func()
+
+def peer_label(host):
+    # Metric label for a host; anyone can connect, so only peers get their own
+    return host if node and (host, PORT) in node.peers else "other"
+
+
+def new_tx_id():
+    return os.urandom(32)
+
+def public_key_bytes(public_key):
+    # Outputs hold keys as 33-byte compressed points; callers may pass either form
+    if isinstance(public_key, VerifyingKey):
+        return public_key.to_string("compressed")
+    return public_key
+
+def load_public_key(public_key):
+    # Only done when a signature is checked
+    if isinstance(public_key, VerifyingKey):
+        return public_key
+    return key_cache.get(public_key)
+
+class KeyCache:
+    # Parsed verifying keys by their compressed bytes, least recently used
+    # first. A key looked up hot_lookups times is rebuilt with a precomputed
+    # multiplication table, which roughly halves the time to verify against
+    # it. Building a table costs a couple of verifications and keeping one
+    # costs tens of KB, so only the hot_size most recently used keys have one.
+    def __init__(self, size=KEY_CACHE_SIZE, hot_size=KEY_CACHE_HOT_SIZE, hot_lookups=KEY_CACHE_HOT_LOOKUPS):
+        self.size = size
+        self.hot_size = hot_size
+        self.hot_lookups = hot_lookups
+        self.keys = OrderedDict() # key bytes -> [verifying key, lookups]
+        self.hot = OrderedDict() # key bytes -> verifying key with a table
+        self.lock = threading.Lock()
+
+    def get(self, public_key):
+        with self.lock:
+            if public_key in self.hot:
+                self.hot.move_to_end(public_key)
+                key_cache_lookups.inc(result="hot")
+                return self.hot[public_key]
+            entry = self.keys.get(public_key)
+            if entry is not None:
+                self.keys.move_to_end(public_key)
+                entry[1] += 1
+        if entry is None:
+            key_cache_lookups.inc(result="parsed")
+            verifying_key = VerifyingKey.from_string(public_key, curve=SECP256k1)
+            with self.lock:
+                self.keys[public_key] = [verifying_key, 1]
+                while len(self.keys) > self.size:
+                    self.keys.popitem(last=False)
+            return verifying_key
+        key_cache_lookups.inc(result="cached")
+        if entry[1] < self.hot_lookups or not self.hot_size:
+            return entry[0]
+
+        # Built outside the lock; if two threads race the second table wins
+        verifying_key = precompute_key(entry[0])
+        with self.lock:
+            self.keys.pop(public_key, None)
+            self.hot[public_key] = verifying_key
+            while len(self.hot) > self.hot_size:
+                self.hot.popitem(last=False)
+        return verifying_key
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.hot.clear()
+
+def precompute_key(verifying_key):
+    # VerifyingKey.precompute() asserts on keys parsed from bytes, whose
+    # point doesn't carry the curve order, so build the point with it
+    point = verifying_key.pubkey.point
+    point = PointJacobi(SECP256k1.curve, point.x(), point.y(), 1, SECP256k1.order, generator=True)
+    verifying_key = VerifyingKey.from_public_point(point, curve=SECP256k1)
+    point * 2 # builds the table now rather than on the first verify
+    return verifying_key
+
+key_cache = KeyCache()
 
 class Tx:
+    __slots__ = ("id", "tx_ins", "tx_outs")
+
     def __init__(self, id, tx_ins, tx_outs):
         self.id = id
         self.tx_ins = tx_ins
         self.tx_outs = tx_outs
 
     def spend_message(self, tx, index):
+        # The outpoint being spent and every output, as plain values so the
+        # message is the same whichever module the classes were loaded from
         outpoint = tx.tx_ins[index].outpoint
-        return serialize(outpoint) + serialize(tx.tx_outs)
+        tx_outs = [(tx_out.tx_id, tx_out.index, tx_out.amount, tx_out.public_key) for tx_out in tx.tx_outs]
+        return pickle.dumps((outpoint, tx_outs), protocol=4)
 
     def sign_input(self, index, private_key):
         message = self.spend_message(self, index)
@@ -55,16 +272,31 @@ class Tx:
     def verify_input(self, index, public_key):
         tx_in = self.tx_ins[index]
         message = self.spend_message(self, index)
-        return public_key.verify(tx_in.signature, message)
+        return load_public_key(public_key).verify(tx_in.signature, message)
+
+    @property
+    def well_formed(self):
+        # A 32-byte id and outputs numbered from 0 under it, with amounts
+        # that fit UtxoSet's array
+        return isinstance(self.id, bytes) and len(self.id) == 32 and all(
+            tx_out.outpoint == (self.id, index) and 0 <= tx_out.amount < 2**64
+            for index, tx_out in enumerate(self.tx_outs))
 
     @property
     def is_coinbase(self):
         return self.tx_ins[0].tx_id is None
 
+    @property
+    def hash(self):
+        # Merkle leaf committing to everything in the tx, signatures included
+        return hash_leaf(encode_tx(self))
+
     def __eq__(self, other):
         return self.id == other.id
 
 class TxIn:
+    __slots__ = ("tx_id", "index", "signature")
+
     def __init__(self, tx_id, index, signature=None):
         self.tx_id = tx_id
         self.index = index
@@ -75,27 +307,47 @@ class TxIn:
         return (self.tx_id, self.index)
 
 class TxOut:
+    # Treated as immutable; UtxoSet hands out a fresh one on every lookup
+    __slots__ = ("tx_id", "index", "amount", "public_key")
+
     def __init__(self, tx_id, index, amount, public_key):
         self.tx_id = tx_id
         self.index = index
         self.amount = amount
-        self.public_key = public_key
+        self.public_key = public_key_bytes(public_key)
 
     @property
     def outpoint(self):
         return (self.tx_id, self.index)
 
-class Block:
-    def __init__(self, txns, prev_id, nonce, bits, timestamp):
-        self.txns = txns
+    def __eq__(self, other):
+        return (self.outpoint, self.amount, self.public_key) == (other.outpoint, other.amount, other.public_key)
+
+    def __hash__(self):
+        return hash(self.outpoint)
+
+class BlockHeader:
+    __slots__ = ("prev_id", "merkle_root", "nonce", "bits", "timestamp")
+
+    def __init__(self, prev_id, merkle_root, nonce, bits, timestamp):
         self.prev_id = prev_id
+        self.merkle_root = merkle_root
         self.nonce = nonce
         self.bits = bits
         self.timestamp = timestamp
 
+    @classmethod
+    def from_bytes(cls, header):
+        prev_id, merkle_root, timestamp, bits, nonce = struct.unpack(HEADER_FORMAT, header)
+        prev_id = prev_id.hex() if any(prev_id) else None
+        return cls(prev_id, merkle_root, nonce, bits, timestamp)
+
     @property
     def header(self):
-        return serialize(self)
+        # Only the header is hashed; the merkle root commits to the txns
+        prev_id = bytes.fromhex(self.prev_id) if self.prev_id else bytes(32)
+        return struct.pack(HEADER_FORMAT, prev_id, self.merkle_root,
+                           self.timestamp, self.bits, self.nonce)
 
     @property
     def id(self):
@@ -114,112 +366,567 @@ class Block:
 
     def __repr__(self):
         prev_id = self.prev_id[:10] if self.prev_id else None
-        return f"Block(prev_id={prev_id}... id={self.id[:10]}...)"
+        return f"{type(self).__name__}(prev_id={prev_id}... id={self.id[:10]}...)"
+
+class Block(BlockHeader):
+    __slots__ = ("txns",)
+
+    def __init__(self, txns, prev_id, nonce, bits, timestamp, merkle_root=None):
+        if merkle_root is None:
+            merkle_root = compute_merkle_root(txns)
+        super().__init__(prev_id, merkle_root, nonce, bits, timestamp)
+        self.txns = txns
+
+class MempoolEntry:
+    # An unconfirmed tx along with what the miner ranks it by
+    __slots__ = ("tx", "fee", "size", "time")
+
+    def __init__(self, tx, fee, size, time):
+        self.tx = tx
+        self.fee = fee
+        self.size = size
+        self.time = time
+
+def pack_outpoint(outpoint):
+    tx_id, index = outpoint
+    return tx_id + index.to_bytes(4, "big")
+
+class Owned:
+    # One key's packed outpoints in order, as sorted chunks, so adding or
+    # removing one only shifts its chunk and a page starts with a bisect
+    # rather than a scan of everything the key owns
+    def __init__(self):
+        self.chunks = [] # sorted lists, none empty
+        self.lasts = [] # last outpoint of each chunk
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def add(self, packed):
+        if not self.chunks:
+            self.chunks.append([packed])
+            self.lasts.append(packed)
+            return
+        index = min(bisect.bisect_left(self.lasts, packed), len(self.chunks) - 1)
+        chunk = self.chunks[index]
+        bisect.insort(chunk, packed)
+        self.lasts[index] = chunk[-1]
+        if len(chunk) > 2 * OWNED_CHUNK:
+            self.chunks[index:index+1] = [chunk[:OWNED_CHUNK], chunk[OWNED_CHUNK:]]
+            self.lasts[index:index+1] = [chunk[OWNED_CHUNK-1], chunk[-1]]
+
+    def remove(self, packed):
+        index = bisect.bisect_left(self.lasts, packed)
+        chunk = self.chunks[index]
+        del chunk[bisect.bisect_left(chunk, packed)]
+        if chunk:
+            self.lasts[index] = chunk[-1]
+        else:
+            del self.chunks[index], self.lasts[index]
+
+    def following(self, after, limit):
+        # Up to `limit` outpoints after `after`, or from the first if None
+        index = 0 if after is None else bisect.bisect_right(self.lasts, after)
+        found = []
+        while index < len(self.chunks) and len(found) < limit:
+            chunk = self.chunks[index]
+            start = 0 if after is None else bisect.bisect_right(chunk, after)
+            found += chunk[start:start + limit - len(found)]
+            index += 1
+        return found
+
+    def copy(self):
+        other = Owned()
+        other.chunks = [list(chunk) for chunk in self.chunks]
+        other.lasts = list(self.lasts)
+        return other
+
+class UtxoSet:
+    # A dict of outpoint -> TxOut that stores entries packed rather than as
+    # objects: each outpoint as 36 bytes mapping to a slot, amounts in an
+    # array and each distinct public key once. TxOuts are built on lookup,
+    # and each key's outpoints are indexed in order. Keys are never
+    # forgotten, which is fine while there are far fewer keys than utxos.
+    def __init__(self):
+        self.slots = {} # packed outpoint -> slot
+        self.amounts = array("Q")
+        self.key_ids = array("I") # slot -> index into public_keys
+        self.public_keys = []
+        self.key_index = {} # public key -> index into public_keys
+        self.free = [] # slots of spent entries, reused first
+        self.owners = {} # key id -> Owned packed outpoints
+
+    def _tx_out(self, packed, slot):
+        tx_id, index = packed[:32], int.from_bytes(packed[32:], "big")
+        return TxOut(tx_id, index, self.amounts[slot], self.public_keys[self.key_ids[slot]])
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, outpoint):
+        return pack_outpoint(outpoint) in self.slots
+
+    def __getitem__(self, outpoint):
+        packed = pack_outpoint(outpoint)
+        return self._tx_out(packed, self.slots[packed])
+
+    def get(self, outpoint, default=None):
+        return self[outpoint] if outpoint in self else default
+
+    def __setitem__(self, outpoint, tx_out):
+        packed = pack_outpoint(outpoint)
+        if packed in self.slots:
+            slot = self.slots[packed]
+            self._disown(packed, slot)
+        elif self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.amounts)
+            self.amounts.append(0)
+            self.key_ids.append(0)
+        if tx_out.public_key not in self.key_index:
+            self.key_index[tx_out.public_key] = len(self.public_keys)
+            self.public_keys.append(tx_out.public_key)
+        self.amounts[slot] = tx_out.amount
+        self.key_ids[slot] = self.key_index[tx_out.public_key]
+        self.slots[packed] = slot
+        self.owners.setdefault(self.key_ids[slot], Owned()).add(packed)
+
+    def pop(self, outpoint):
+        tx_out = self[outpoint]
+        packed = pack_outpoint(outpoint)
+        slot = self.slots.pop(packed)
+        self._disown(packed, slot)
+        self.free.append(slot)
+        return tx_out
+
+    def _disown(self, packed, slot):
+        owned = self.owners[self.key_ids[slot]]
+        owned.remove(packed)
+        if not owned:
+            del self.owners[self.key_ids[slot]]
+
+    def __delitem__(self, outpoint):
+        self.pop(outpoint)
+
+    def values(self):
+        for packed, slot in self.slots.items():
+            yield self._tx_out(packed, slot)
+
+    def owned_by(self, public_key):
+        key_id = self.key_index.get(public_key_bytes(public_key))
+        return [self._tx_out(packed, self.slots[packed]) for packed in self.owners.get(key_id, ())]
+
+    def owned_by_many(self, public_keys):
+        return [self.owned_by(public_key) for public_key in public_keys]
+
+    def balances(self, public_keys):
+        # Sums amounts straight from the array, without building TxOuts
+        return [sum([self.amounts[self.slots[packed]] for packed in self.owners.get(key_id, ())])
+                for key_id in self._key_ids(public_keys)]
+
+    def page(self, public_key, after=None, limit=UTXO_PAGE_SIZE):
+        # Up to `limit` of a key's utxos in outpoint order, starting after the
+        # packed outpoint `after`, and the cursor for the next page (None on
+        # the last). Outputs that exist throughout a walk are each returned
+        # once, however the set changes between pages.
+        assert limit >= 1, "Pages hold at least one utxo"
+        key_id = self.key_index.get(public_key_bytes(public_key))
+        packed_outpoints = self.owners[key_id].following(after, limit + 1) if key_id in self.owners else []
+        more = len(packed_outpoints) > limit
+        packed_outpoints = packed_outpoints[:limit]
+        tx_outs = [self._tx_out(packed, self.slots[packed]) for packed in packed_outpoints]
+        return tx_outs, packed_outpoints[-1] if more else None
+
+    def _key_ids(self, public_keys):
+        return [self.key_index.get(public_key_bytes(public_key)) for public_key in public_keys]
+
+    def copy(self):
+        other = UtxoSet()
+        other.slots = dict(self.slots)
+        other.amounts = array("Q", self.amounts)
+        other.key_ids = array("I", self.key_ids)
+        other.public_keys = list(self.public_keys)
+        other.key_index = dict(self.key_index)
+        other.free = list(self.free)
+        other.owners = {key_id: owned.copy() for key_id, owned in self.owners.items()}
+        return other
+
+class UtxoView:
+    # The utxo set as seen partway through a block, optionally with the
+    # mempool's outputs on top, without copying either. Double spends within
+    # the mempool are caught by Node.spenders, not here.
+    def __init__(self, utxo_set, mempool=None):
+        self.utxo_set = utxo_set
+        self.mempool = mempool if mempool is not None else {}
+        self.created = {}
+        self.spent = set()
+
+    def get(self, outpoint):
+        if outpoint in self.spent:
+            return None
+        if outpoint in self.created:
+            return self.created[outpoint]
+        if outpoint in self.utxo_set:
+            return self.utxo_set[outpoint]
+        tx_id, index = outpoint
+        if tx_id in self.mempool and index < len(self.mempool[tx_id].tx.tx_outs):
+            return self.mempool[tx_id].tx.tx_outs[index]
+
+    def __contains__(self, outpoint):
+        return self.get(outpoint) is not None
+
+    def __getitem__(self, outpoint):
+        tx_out = self.get(outpoint)
+        if tx_out is None:
+            raise KeyError(outpoint)
+        return tx_out
+
+    def apply(self, tx):
+        for tx_in in tx.tx_ins:
+            self.spent.add(tx_in.outpoint)
+        for tx_out in tx.tx_outs:
+            self.created[tx_out.outpoint] = tx_out
+
+class Chain:
+    # The main chain, indexable like a list of blocks. Headers stay in
+    # memory; bodies live in a BlockStore and come back through its cache.
+    # With prune_depth set, bodies that far below the tip are dropped. Where
+    # there's no body, indexing gives the header, as below a snapshot.
+    def __init__(self, prune_depth=None):
+        self.headers = []
+        self.heights = {} # block id -> height
+        self.store = BlockStore(BLOCK_CACHE_BYTES, encode=serialize, decode=deserialize)
+        self.prune_depth = prune_depth
+        self.pruned = 1 # bodies below this height have been dropped, except genesis
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __contains__(self, block):
+        return block.id in self.heights
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._load(header) for header in self.headers[index]]
+        return self._load(self.headers[index])
+
+    def __iter__(self):
+        return map(self._load, list(self.headers))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def _load(self, header):
+        return self.store.get(header.id, header)
+
+    def height(self, block_id):
+        return self.heights.get(block_id)
+
+    def body(self, block_id):
+        # The full block if it's on our chain and hasn't been pruned
+        return self.store.get(block_id)
+
+    def append(self, block):
+        block_id = block.id
+        self.heights[block_id] = len(self.headers)
+        self.headers.append(BlockHeader.from_bytes(block.header))
+        if isinstance(block, Block):
+            self.store.put(block_id, block)
+        self.prune()
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def pop(self):
+        header = self.headers.pop()
+        del self.heights[header.id]
+        block = self.store.pop(header.id, header)
+        return block
+
+    def fill(self, blocks):
+        # Bodies for the first len(blocks) headers, e.g. once the history
+        # behind a snapshot has been downloaded
+        for height, block in enumerate(blocks):
+            assert self.headers[height].id == block.id, "Block isn't on our chain"
+            if height >= self.pruned:
+                self.store.put(block.id, block)
+
+    def prune(self):
+        if self.prune_depth is None:
+            return
+        while self.pruned < len(self.headers) - self.prune_depth:
+            self.store.discard(self.headers[self.pruned].id)
+            self.pruned += 1
 
 class Node:
-    def __init__(self, address):
-        self.blocks = []
+    def __init__(self, address, clock=time.time):
+        self.blocks = Chain()
         self.branches = []
-        self.utxo_set = {}
-        self.mempool = []
+        self.utxo_set = UtxoSet()
+        self.mempool = {} # tx.id -> MempoolEntry, in arrival order
+        self.spenders = {} # outpoint -> id of the mempool tx spending it
         self.peers = []
         self.pending_peers = []
         self.address = address
+        self.clock = clock
+        self.synced = threading.Event() # set once a peer says we've caught up
+        self.template = None
+        self.filters = {} # block id -> compact filter of the keys it touches
+        self.assume_valid = None # id of a block whose history we trust to be signed correctly
+        self.assumed_valid = set() # ids of that block and its ancestors, once we've seen their headers
+        self.undo = BlockStore(UNDO_CACHE_BYTES, encode=serialize, decode=deserialize) # block id -> for each tx, the utxos it spent
+        self.snapshot = None # (block id, utxo set hash) until the history behind a snapshot is validated
+        self.tx_index = None # tx id -> (block id, position), if enabled
+        self.history = None # public key -> (height, tx id, outpoint, amount, spent) entries, if enabled
+        self.subscribers = set()
+        self.watchers = {} # public key -> subscribers to its payments
+        self.fee_estimator = FeeEstimator()
 
     def connect(self, peer):
         if peer not in self.peers and peer != self.address:
             logger.info(f'(handshake) Sent "connect" to {peer[0]}')
+            self.pending_peers.append(peer) # Before sending, the reply may beat us back
             try:
-                send_message(peer, "connect", None)
-                self.pending_peers.append(peer)
+                self.send(peer, "connect", None)
             except:
+                self.pending_peers.remove(peer)
                 logger.info(f'(handshake) Node {peer[0]} offline')
 
-    def sync(self):
-        blocks = self.blocks[-GET_BLOCKS_CHUNK:]
-        block_ids = [block.id for block in blocks]
+    def send(self, peer, command, data):
+        send_message(peer, command, data)
+
+    def propagate_block(self, block):
         for peer in self.peers:
-            send_message(peer, "sync", block_ids)
+            disrupt(func=self.send, args=[peer, "blocks", [encode_block(block)]])
+
+    def sync(self, after=()):
+        with tracer.span("sync"):
+            for peer in self.peers:
+                self.sync_with(peer, after)
+
+    def sync_with(self, peer, after=()):
+        # `after` are blocks received but not connected yet, so the peer
+        # sends the ones following them rather than those again
+        block_ids = [header.id for header in self.blocks.headers[-GET_BLOCKS_CHUNK:]]
+        block_ids += [block.id for block in after]
+        self.send(peer, "sync", block_ids)
 
     def fetch_utxos(self, public_key):
-        return [tx_out for tx_out in self.utxo_set.values()
-                if tx_out.public_key == public_key]
+        return self.utxo_set.owned_by(public_key)
 
     def connect_tx(self, tx):
-        # Remove utxos that were just spent
+        # Remove utxos that were just spent, returning them for undo data
+        spent = []
         if not tx.is_coinbase:
             for tx_in in tx.tx_ins:
-                del self.utxo_set[tx_in.outpoint]
+                spent.append(self.utxo_set.pop(tx_in.outpoint))
 
         # Save utxos which were just created
         for tx_out in tx.tx_outs:
             self.utxo_set[tx_out.outpoint] = tx_out
 
-        # Clean up mempool
-        if tx in self.mempool:
-            self.mempool.remove(tx)
-
-    def disconnect_tx(self, tx):
-        # given a set of blocks, find a tx_in in its tx output, helper
-        def tx_in_to_tx_out(tx_in, blocks):
-            for block in blocks:
-                for tx in block.txns:
-                    if tx.id == tx_in.tx_id:
-                        return tx.tx_outs[tx_in.index]
-
-        # Add back UTXOs spent by this transaction
+        # Clean up mempool, evicting txns that this one double spends
         if not tx.is_coinbase:
             for tx_in in tx.tx_ins:
-                tx_out = tx_in_to_tx_out(tx_in, self.blocks)
-                self.utxo_set[tx_out.outpoint] = tx_out
-
+                spender = self.spenders.get(tx_in.outpoint)
+                if spender is not None and spender != tx.id:
+                    self.evict_from_mempool(spender)
+        if tx.id in self.mempool:
+            self.fee_estimator.confirmed_at(tx.id, len(self.blocks) - 1)
+            self.remove_from_mempool(tx.id)
+        return spent
+
+    def disconnect_tx(self, tx, spent):
         # Remove UTXOs created by this transaction
         for tx_out in tx.tx_outs:
             del self.utxo_set[tx_out.outpoint]
 
-        # Put it back in mempool
-        if tx not in self.mempool and not tx.is_coinbase:
-            self.mempool.append(tx)
-            logging.info(f"Added tx to mempool")
+        # Add back UTXOs spent by this transaction, from the block's undo data
+        for tx_out in spent:
+            self.utxo_set[tx_out.outpoint] = tx_out
 
     def fetch_balance(self, public_key):
         utxos = self.fetch_utxos(public_key) # utxos at this public key
         return sum([tx_out.amount for tx_out in utxos]) # Sum the amounts
 
-    def validate_tx(self, tx):
+    def fetch_balances(self, public_keys):
+        assert len(public_keys) <= MAX_BATCH_KEYS, "Too many keys in one request"
+        return self.utxo_set.balances(public_keys)
+
+    def fetch_many_utxos(self, public_keys):
+        assert len(public_keys) <= MAX_BATCH_KEYS, "Too many keys in one request"
+        return self.utxo_set.owned_by_many(public_keys)
+
+    def fetch_utxo_page(self, public_key, cursor=None, limit=UTXO_PAGE_SIZE):
+        # Pass `next` back as the cursor for the following page
+        tx_outs, cursor = self.utxo_set.page(public_key, cursor, min(limit, UTXO_PAGE_SIZE))
+        return {"utxos": tx_outs, "next": cursor}
+
+    def validate_tx(self, tx, utxos=None, check_signatures=True, checked_keys=None):
+        # Returns the fee. Pass a UtxoView as `utxos` to allow spending outputs
+        # of earlier txns in a block, or of the mempool. `checked_keys` are
+        # the keys tx's signatures were already verified against, if any.
+        utxos = self.utxo_set if utxos is None else utxos
+        assert tx.well_formed, "Malformed tx ids or amounts"
+        outpoints = {tx_in.outpoint for tx_in in tx.tx_ins}
+        assert len(outpoints) == len(tx.tx_ins), "Trying to spend a utxo twice"
         in_sum, out_sum = 0, 0
         for index, tx_in in enumerate(tx.tx_ins):
-            assert tx_in.outpoint in self.utxo_set, "Trying to spend a non-existant utxo"
-            tx_out = self.utxo_set[tx_in.outpoint] # Get the tx_out
-            assert tx.verify_input(index, tx_out.public_key), "Invalid tx signature"
+            assert tx_in.outpoint in utxos, "Trying to spend a non-existant utxo"
+            tx_out = utxos[tx_in.outpoint] # Get the tx_out
+            if check_signatures and not (checked_keys and checked_keys[index] == tx_out.public_key):
+                assert tx.verify_input(index, tx_out.public_key), "Invalid tx signature"
             in_sum += tx_out.amount
         for tx_out in tx.tx_outs:
             out_sum += tx_out.amount
         assert in_sum >= out_sum, "Unauthorized value was created from the tx ins and outs"
+        return in_sum - out_sum
 
     def validate_coinbase(self, block):
         tx = block.txns[0]
         assert len(tx.tx_ins) == len(tx.tx_outs) == 1, "Invalid coinbase tx numbers"
+        assert tx.well_formed, "Malformed coinbase ids or amounts"
         fees = self.calculate_fees(block.txns[1:])
         assert tx.tx_outs[0].amount == self.get_block_subsidy() + fees, "Invalid coinbase amounts"
 
+    def accept_tx(self, tx, check_signatures=True, arrived=None):
+        # Txns may spend outputs of txns still in the mempool, but not
+        # outputs another mempool tx already spends
+        for tx_in in tx.tx_ins:
+            assert tx_in.outpoint not in self.spenders, "Conflicts with a mempool tx"
+        fee = self.validate_tx(tx, UtxoView(self.utxo_set, self.mempool), check_signatures)
+        assert len(self.mempool_ancestors(tx)) < MEMPOOL_MAX_ANCESTORS, "Too many unconfirmed ancestors"
+        self.add_to_mempool(tx, fee, arrived)
+        self.notify_payments("received", tx)
+
     def handle_tx(self, tx):
-        if tx not in self.mempool:
-            self.validate_tx(tx)
-            self.mempool.append(tx)
+        if tx.id not in self.mempool:
+            self.accept_tx(tx)
             for peer in self.peers: # Propagate transaction
-                send_message(peer, "tx", tx)
-
-    def validate_block(self, block, validate_txns=False):
-        assert block.proof < block.target, "Insufficient Proof-of-Work"
+                self.send(peer, "tx", tx)
+
+    def add_to_mempool(self, tx, fee, arrived=None):
+        arrived = self.clock() if arrived is None else arrived
+        self.mempool[tx.id] = MempoolEntry(tx, fee, len(encode_tx(tx)), arrived)
+        self.fee_estimator.track(tx.id, fee / self.mempool[tx.id].size, len(self.blocks) - 1)
+        for tx_in in tx.tx_ins:
+            self.spenders[tx_in.outpoint] = tx.id
+        if self.template:
+            self.template.add_tx(tx)
+
+    def remove_from_mempool(self, tx_id):
+        if self.template: # Before the entry goes, the template needs its size
+            self.template.remove_tx(self.mempool[tx_id].tx)
+        entry = self.mempool.pop(tx_id)
+        for tx_in in entry.tx.tx_ins:
+            del self.spenders[tx_in.outpoint]
+        self.fee_estimator.forget(tx_id) # Unless it just confirmed
+
+    def evict_from_mempool(self, tx_id):
+        # Drops a tx along with everything built on it
+        for descendant in self.mempool_descendants(self.mempool[tx_id].tx):
+            self.remove_from_mempool(descendant)
+        self.remove_from_mempool(tx_id)
+
+    def mempool_parents(self, tx):
+        return {tx_in.tx_id for tx_in in tx.tx_ins if tx_in.tx_id in self.mempool}
+
+    def mempool_children(self, tx):
+        return {self.spenders[tx_out.outpoint] for tx_out in tx.tx_outs
+                if tx_out.outpoint in self.spenders}
+
+    def mempool_ancestors(self, tx):
+        return self._walk_mempool(tx, self.mempool_parents)
+
+    def mempool_descendants(self, tx):
+        return self._walk_mempool(tx, self.mempool_children)
+
+    def sorted_mempool(self):
+        # Entries by fee rate, best first, but never ahead of their parents
+        ordered = {}
+        def visit(tx_id):
+            if tx_id not in ordered:
+                for parent in self.mempool_parents(self.mempool[tx_id].tx):
+                    visit(parent)
+                ordered[tx_id] = self.mempool[tx_id]
+        for tx_id in sorted(self.mempool, key=lambda tx_id: -self.mempool[tx_id].fee / self.mempool[tx_id].size):
+            visit(tx_id)
+        return list(ordered.values())
+
+    def _walk_mempool(self, tx, neighbours):
+        # Ids of every mempool tx reachable from tx, not counting tx
+        found, todo = set(), [tx]
+        while todo:
+            for tx_id in neighbours(todo.pop()):
+                if tx_id not in found:
+                    found.add(tx_id)
+                    todo.append(self.mempool[tx_id].tx)
+        return found
+
+    def validate_block(self, block, validate_txns=False, checked=None):
+        # `checked` is what precheck_block found, if it already ran
+        with block_validation_seconds.time(phase="pow"):
+            assert block.proof < block.target, "Insufficient Proof-of-Work"
+        if checked is None:
+            with block_validation_seconds.time(phase="merkle"):
+                assert block.merkle_root == compute_merkle_root(block.txns), "Invalid merkle root"
         if validate_txns:
-            assert block.timestamp - time.time() < DIFFICULTY_PERIOD_IN_SECS, "Block too far in the future"
+            assert block.timestamp - self.clock() < DIFFICULTY_PERIOD_IN_SECS, "Block too far in the future"
             height = max(len(self.blocks) - BLOCKS_PER_DIFFICULTY_PERIOD, 0)
-            assert block.timestamp > self.blocks[height].timestamp, "Block periods can't go backwards in time"
+            assert block.timestamp > self.blocks.headers[height].timestamp, "Block periods can't go backwards in time"
             assert block.bits == self.get_next_bits(block.prev_id, log=True), "Invalid difficulty"
-            self.validate_coinbase(block) # Validate coinbase separately
-            for tx in block.txns[1:]: # Check the transactions are valid
-                self.validate_tx(tx)
+            with block_validation_seconds.time(phase="coinbase"):
+                self.validate_coinbase(block) # Validate coinbase separately
+            check_signatures = block.id not in self.assumed_valid
+            if not check_signatures:
+                assumed_valid_blocks.inc()
+            with block_validation_seconds.time(phase="txns"):
+                utxos = UtxoView(self.utxo_set) # Txns may spend earlier txns in the block
+                for index, tx in enumerate(block.txns[1:]): # Check the transactions are valid
+                    self.validate_tx(tx, utxos, check_signatures, checked and checked[index])
+                    utxos.apply(tx)
+
+    def learn_headers(self, headers):
+        # Given a checked header chain (see LightClient), note which blocks
+        # are the assume-valid block or its ancestors. Everything else,
+        # including blocks on other branches, keeps full validation.
+        ids = [header.id for header in headers]
+        if self.assume_valid in ids:
+            self.assumed_valid = set(ids[:ids.index(self.assume_valid) + 1])
+
+    def check_headers(self, headers):
+        # How many of `headers`, a chain of them, pass what can be checked
+        # without their blocks' bodies: linkage, proof-of-work and, where
+        # the first one's parent is on our chain or a branch, difficulty
+        if not headers:
+            return 0
+        height = self.blocks.height(headers[0].prev_id)
+        branch, _, branch_height = self.find_in_branch(headers[0].prev_id)
+        if height is not None:
+            chain = self.blocks.headers[:height+1]
+        elif branch:
+            chain = self.blocks.headers[:self.blocks.heights[branch[0].prev_id]+1] + branch[:branch_height+1]
+        else:
+            chain = [] # Unknown parent, handle_block asks for it
+        for passed, header in enumerate(headers):
+            if passed and header.prev_id != headers[passed-1].id:
+                return passed
+            if chain and header.bits != next_bits(chain, len(chain) - 1):
+                return passed
+            if header.proof >= header.target:
+                return passed
+            if chain:
+                chain.append(header)
+        return len(headers)
 
     def find_in_branch(self, block_id):
         # if a block exists in any branch, return it's info, otherwise None
@@ -229,24 +936,31 @@ class Node:
                     return branch, branch_index, height
         return None, None, None
 
-    def handle_block(self, block):
-        # Ignore if we've already seen it
-        found_in_chain = block in self.blocks
-        found_in_branch = self.find_in_branch(block.id)[0] is not None
-        if found_in_chain or found_in_branch:
-            raise Exception("Received duplicate block")
-
-        # Look up previous block and associated conditions, then validate
-        branch, branch_index, height = self.find_in_branch(block.prev_id)
-        extends_chain = block.prev_id == self.blocks[-1].id
-        forks_chain = not extends_chain and block.prev_id in [block.id for block in self.blocks]
-        extends_branch = branch and height == len(branch) - 1
-        forks_branch = branch and height != len(branch) - 1
-        self.validate_block(block, validate_txns=extends_chain)
+    def handle_block(self, block, checked=None):
+        with tracer.span("handle_block", block=block.id[:10]):
+            self._handle_block(block, checked)
+
+    def _handle_block(self, block, checked=None):
+        with tracer.span("handle_block.lookup"):
+            # Ignore if we've already seen it
+            found_in_chain = block in self.blocks
+            found_in_branch = self.find_in_branch(block.id)[0] is not None
+            if found_in_chain or found_in_branch:
+                raise Exception("Received duplicate block")
+
+            # Look up previous block and associated conditions
+            branch, branch_index, height = self.find_in_branch(block.prev_id)
+            extends_chain = block.prev_id == self.blocks.headers[-1].id
+            forks_chain = not extends_chain and self.blocks.height(block.prev_id) is not None
+            extends_branch = branch and height == len(branch) - 1
+            forks_branch = branch and height != len(branch) - 1
+        with tracer.span("handle_block.validate"):
+            self.validate_block(block, validate_txns=extends_chain, checked=checked)
 
         # Handle the block according to its condition
         if extends_chain:
-            self.connect_block(block)
+            with tracer.span("handle_block.connect"):
+                self.connect_block(block)
             logger.info(f"Extended chain to height {len(self.blocks)-1}")
         elif forks_chain:
             self.branches.append([block])
@@ -255,9 +969,8 @@ class Node:
             branch.append(block)
             logger.info(f"Extended branch {branch_index} to {len(branch)}")
             # Check for a reorg and handle it accordingly
-            chain_ids = [block.id for block in self.blocks]
-            fork_height = chain_ids.index(branch[0].prev_id)
-            chain_since_fork = self.blocks[fork_height+1:]
+            fork_height = self.blocks.heights[branch[0].prev_id]
+            chain_since_fork = self.blocks.headers[fork_height+1:]
             # Check which branch has more total work, reorg accordingly
             total_work = lambda blocks: sum([2**block.bits for block in blocks])
             if total_work(branch) > total_work(chain_since_fork):
@@ -270,95 +983,302 @@ class Node:
             self.sync()
             raise Exception("Encountered block with unknown parent. Syncing.")
 
-        # Progagate the block
-        for peer in self.peers:
-            disrupt(func=send_message, args=[peer, "blocks", [block]])
+        with tracer.span("handle_block.propagate"):
+            self.propagate_block(block)
+        self.evict_stale_branches()
+
+    def evict_stale_branches(self):
+        # Drop branches whose tip has fallen STALE_BRANCH_DEPTH blocks behind
+        # ours, or that fork from a block no longer on our chain, which
+        # _handle_block couldn't reorg to anyway
+        tip_height = len(self.blocks) - 1
+        def live(branch):
+            fork_height = self.blocks.height(branch[0].prev_id)
+            return fork_height is not None and fork_height + len(branch) > tip_height - STALE_BRANCH_DEPTH
+        self.branches = [branch for branch in self.branches if live(branch)]
 
     def reorg(self, branch, branch_index):
+        with tracer.span("reorg", depth=len(branch)):
+            self._reorg(branch, branch_index)
+
+    def _reorg(self, branch, branch_index):
         # Disconnect to fork block, preserving as a branch
         disconnected_blocks = []
-        while self.blocks[-1].id != branch[0].prev_id:
-            block = self.blocks.pop()
-            for tx in block.txns:
-                self.disconnect_tx(tx)
-            disconnected_blocks.insert(0, block)
+        fork_height = self.blocks.heights[branch[0].prev_id]
+        for header in self.blocks.headers[fork_height+1:]: # Check before touching anything
+            assert header.id in self.undo, "Can't reorg below a snapshot"
+            assert header.id in self.blocks.store, "Can't reorg below pruned blocks"
+        with tracer.span("reorg.disconnect"):
+            while self.blocks.headers[-1].id != branch[0].prev_id:
+                block = self.blocks[-1]
+                undo = self.undo.pop(block.id)
+                for tx, spent in reversed(list(zip(block.txns, undo))): # Children before their parents
+                    self.disconnect_tx(tx, spent)
+                    self.notify_payments("reorged", tx, block.id, len(self.blocks) - 1)
+                self.unindex_block(block, undo, len(self.blocks) - 1)
+                self.blocks.pop()
+                disconnected_blocks.insert(0, block)
+            self.readd_txns(disconnected_blocks)
+        reorg_depth.observe(len(disconnected_blocks))
         # Replace branch with newly disconnected blocks
         self.branches[branch_index] = disconnected_blocks
         for block in branch:
             try:
-                self.validate_block(block, validate_txns=True)
-                self.connect_block(block)
+                with tracer.span("reorg.connect", block=block.id[:10]):
+                    self.validate_block(block, validate_txns=True)
+                    self.connect_block(block)
             except:
                 self.reorg(disconnected_blocks, branch_index)
                 logger.info(f"Reorg failed, and has been rolled back")
                 return
 
+    def readd_txns(self, blocks):
+        # Put disconnected txns back in the mempool, parents first. Whatever
+        # no longer validates is dropped, along with mempool txns spending it
+        for block in blocks:
+            for tx in block.txns[1:]:
+                try:
+                    self.accept_tx(tx)
+                except Exception:
+                    for child in self.mempool_children(tx):
+                        if child in self.mempool:
+                            self.evict_from_mempool(child)
+
     def connect_block(self, block):
+        if block.id not in self.filters: # Needs the utxos this block spends
+            self.filters[block.id] = self.build_block_filter(block)
         self.blocks.append(block) # Add the block to our chain
-        for tx in block.txns: # update UTXO set / mempool
-            self.connect_tx(tx)
+        self.fee_estimator.decay()
+        if self.template:
+            self.template.remove_confirmed(block)
+        undo = [self.connect_tx(tx) for tx in block.txns] # update UTXO set / mempool
+        self.undo.put(block.id, undo)
+        self.index_block(block, undo, len(self.blocks) - 1)
+        for tx in block.txns:
+            self.notify_payments("confirmed", tx, block.id, len(self.blocks) - 1)
+        self.notify({"event": "tip", "block_id": block.id, "height": len(self.blocks) - 1})
+        if self.template: # Point the miner at the new tip
+            self.template.update_tip()
+
+    def index_block(self, block, undo, height):
+        # Keeps the optional indexes in step with the chain. Entries are
+        # appended in chain order, so history lists stay sorted by height.
+        if self.tx_index is not None:
+            for position, tx in enumerate(block.txns):
+                self.tx_index[tx.id] = (block.id, position)
+        if self.history is not None:
+            for tx, spent in zip(block.txns, undo):
+                for tx_out in spent:
+                    self.history.setdefault(tx_out.public_key, []).append(
+                        (height, tx.id, tx_out.outpoint, tx_out.amount, True))
+                for tx_out in tx.tx_outs:
+                    self.history.setdefault(tx_out.public_key, []).append(
+                        (height, tx.id, tx_out.outpoint, tx_out.amount, False))
+
+    def unindex_block(self, block, undo, height):
+        # The block was our tip, so its history entries are the last ones
+        if self.tx_index is not None:
+            for tx in block.txns:
+                self.tx_index.pop(tx.id, None)
+        if self.history is not None:
+            public_keys = {tx_out.public_key for tx, spent in zip(block.txns, undo)
+                           for tx_out in spent + tx.tx_outs}
+            for public_key in public_keys:
+                entries = self.history[public_key]
+                while entries and entries[-1][0] == height:
+                    entries.pop()
+                if not entries:
+                    del self.history[public_key]
+
+    def subscribe(self, subscriber):
+        self.subscribers.add(subscriber)
+        for public_key in subscriber.public_keys:
+            self.watchers.setdefault(public_key, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        for public_key in subscriber.public_keys:
+            self.watchers[public_key].discard(subscriber)
+            if not self.watchers[public_key]:
+                del self.watchers[public_key]
+
+    def notify(self, event):
+        # Chain tips go to whoever asked for them
+        for subscriber in self.subscribers:
+            if subscriber.tips:
+                subscriber.push(event)
+
+    def notify_payments(self, event, tx, block_id=None, height=None):
+        # An event per output of tx paying a watched key: "received" into the
+        # mempool, "confirmed" in a block or "reorged" out of one
+        if not self.watchers:
+            return
+        for tx_out in tx.tx_outs:
+            for subscriber in self.watchers.get(tx_out.public_key, ()):
+                subscriber.push({"event": event, "tx_id": tx.id, "outpoint": tx_out.outpoint, "amount": tx_out.amount,
+                                 "public_key": tx_out.public_key, "block_id": block_id, "height": height})
+
+    def build_block_filter(self, block):
+        # Covers the keys paid by the block and the keys whose utxos it spends
+        public_keys, utxos = [], UtxoView(self.utxo_set)
+        for tx in block.txns:
+            if not tx.is_coinbase:
+                for tx_in in tx.tx_ins:
+                    public_keys.append(utxos[tx_in.outpoint].public_key)
+                utxos.apply(tx)
+            public_keys.extend(tx_out.public_key for tx_out in tx.tx_outs)
+        return build_filter(filter_key(block.id), public_keys)
+
+    def fetch_filters(self, block_ids):
+        return [self.filters.get(block_id) for block_id in block_ids]
+
+    def fetch_blocks(self, block_ids):
+        # Pruned blocks, and those below a snapshot until its history is
+        # validated, are only headers and come back as None
+        return [self.blocks.body(block_id) for block_id in block_ids]
 
     def get_block_subsidy(self):
         halvenings = len(self.blocks) // HALVENING_INTERVAL
         return (50 * SATOSHIS_PER_COIN) // (2 ** halvenings)
 
     def calculate_fees(self, txns, fees=0):
+        utxos = UtxoView(self.utxo_set) # Txns may spend earlier txns in the list
         for txn in txns:
             inputs = outputs = 0
             for tx_in in txn.tx_ins:
-                inputs += self.utxo_set[tx_in.outpoint].amount
+                inputs += utxos[tx_in.outpoint].amount
             for tx_out in txn.tx_outs:
                 outputs += tx_out.amount
             fees += inputs - outputs
+            utxos.apply(txn)
         return fees
 
     def get_next_bits(self, block_id, log=False):
-        # only change bits if were entering a new period
-        height = [block.id for block in self.blocks].index(block_id)
-        block = self.blocks[height]
-        next_height = height + 1
-        next_block_period = next_height // BLOCKS_PER_DIFFICULTY_PERIOD
-        next_block_period_height = next_height % BLOCKS_PER_DIFFICULTY_PERIOD
-        if next_block_period_height != 0:
-            return block.bits
-
-        # how long this period lasted, to calculate the next bits difficulty
-        one_period_ago_index = max(height - BLOCKS_PER_DIFFICULTY_PERIOD, 0)
-        one_period_ago_block = self.blocks[one_period_ago_index]
-        period_duration = block.timestamp - one_period_ago_block.timestamp
-        if period_duration <= DIFFICULTY_PERIOD_IN_SECS:
-            next_bits = block.bits + 1
+        height = self.blocks.heights[block_id]
+        return next_bits(self.blocks.headers, height, log=log)
+
+    def find_tx(self, tx_id):
+        # Return the block confirming a tx and the tx's position in it
+        if self.tx_index is not None:
+            block_id, index = self.tx_index.get(tx_id, (None, None))
+            block = self.blocks.body(block_id)
+            return (block, index) if block else (None, None)
+        for header in self.blocks.headers[::-1]:
+            block = self.blocks.body(header.id) # Pruned blocks and headers below a snapshot have none
+            for index, tx in enumerate(block.txns if block else []):
+                if tx.id == tx_id:
+                    return block, index
+        return None, None
+
+    def fetch_tx(self, tx_id):
+        # A tx in the mempool or on our chain, with where it was confirmed.
+        # With the tx index, a tx in a pruned block is still located but
+        # comes back as None.
+        if tx_id in self.mempool:
+            return {"tx": self.mempool[tx_id].tx, "block_id": None, "height": None, "index": None, "confirmations": 0}
+        if self.tx_index is not None:
+            block_id, index = self.tx_index.get(tx_id, (None, None))
+            block = self.blocks.body(block_id)
         else:
-            next_bits = block.bits - 1
-        if log:
-            logger.info(
-                "(difficulty adjustment) "
-                f"period={next_block_period} "
-                f"target={DIFFICULTY_PERIOD_IN_SECS} "
-                f"duration={period_duration} "
-                f"bits={block.bits}->{next_bits} "
-            )
-        return next_bits
-
-def prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, fee):
-    # Construct tx.tx_ins
-    tx_ins = []
-    tx_in_sum = 0
-    for tx_out in utxos:
-        tx_ins.append(TxIn(tx_id=tx_out.tx_id, index=tx_out.index, signature=None))
-        tx_in_sum += tx_out.amount
-        if tx_in_sum > amount + fee:
-            break
-    assert tx_in_sum >= amount + fee, "Sender can not afford this tx"
-
-    # Construct tx.tx_outs
-    tx_id = uuid.uuid4()
-    change = tx_in_sum - (amount+fee)
-    sender_public_key = sender_private_key.get_verifying_key()
-    tx_outs = [
-        TxOut(tx_id=tx_id, index=0, amount=amount, public_key=recipient_public_key),
-        TxOut(tx_id=tx_id, index=1, amount=change, public_key=sender_public_key),
-    ]
+            block, index = self.find_tx(tx_id)
+            block_id = block.id if block else None
+        if block_id is None:
+            return None
+        height = self.blocks.heights[block_id]
+        return {
+            "tx": block.txns[index] if block else None,
+            "block_id": block_id,
+            "height": height,
+            "index": index,
+            "confirmations": len(self.blocks) - height,
+        }
+
+    def fetch_history(self, public_key, start=0, limit=HISTORY_MAX_PAGE):
+        # A page of a key's receipts and spends, oldest first. `next` is the
+        # start of the following page, or None on the last one.
+        if self.history is None:
+            return None
+        entries = self.history.get(public_key_bytes(public_key), [])
+        end = start + min(limit, HISTORY_MAX_PAGE)
+        page = [{
+            "height": height,
+            "block_id": self.blocks.headers[height].id,
+            "tx_id": tx_id,
+            "outpoint": outpoint,
+            "amount": amount,
+            "spent": spent,
+        } for height, tx_id, outpoint, amount, spent in entries[start:end]]
+        return {"entries": page, "next": end if end < len(entries) else None, "total": len(entries)}
+
+    def fetch_headers(self, locator):
+        # Headers following the most recent block of ours the peer knows
+        # about, or from genesis if it knows none of them
+        start = 0
+        for height in range(len(self.blocks) - 1, -1, -1):
+            if self.blocks.headers[height].id in locator:
+                start = height + 1
+                break
+        return [header.header for header in self.blocks.headers[start:start+MAX_HEADERS]]
+
+    def fetch_utxo_proofs(self, public_key):
+        # For each utxo: the tx that created it, and a merkle proof that
+        # the tx was confirmed in a block on our chain. Needs the tx index,
+        # as finding each tx by scanning the chain would hold the lock for
+        # as long as any client cared to ask about.
+        if self.tx_index is None:
+            return None
+        proofs = []
+        trees = {}
+        for tx_out in self.fetch_utxos(public_key):
+            block, index = self.find_tx(tx_out.tx_id)
+            if block is None: # Created below a snapshot we haven't validated yet
+                continue
+            if block.id not in trees:
+                trees[block.id] = MerkleTree([tx.hash for tx in block.txns])
+            proofs.append({
+                "tx": block.txns[index],
+                "index": tx_out.index,
+                "block_id": block.id,
+                "proof": trees[block.id].proof(index),
+            })
+        return proofs
+
+def next_bits(blocks, height, log=False):
+    # only change bits if were entering a new period
+    block = blocks[height]
+    next_height = height + 1
+    next_block_period = next_height // BLOCKS_PER_DIFFICULTY_PERIOD
+    next_block_period_height = next_height % BLOCKS_PER_DIFFICULTY_PERIOD
+    if next_block_period_height != 0:
+        return block.bits
+
+    # how long this period lasted, to calculate the next bits difficulty
+    one_period_ago_index = max(height - BLOCKS_PER_DIFFICULTY_PERIOD, 0)
+    one_period_ago_block = blocks[one_period_ago_index]
+    period_duration = block.timestamp - one_period_ago_block.timestamp
+    if period_duration <= DIFFICULTY_PERIOD_IN_SECS:
+        next_bits = block.bits + 1
+    else:
+        next_bits = block.bits - 1
+    if log:
+        logger.info(
+            "(difficulty adjustment) "
+            f"period={next_block_period} "
+            f"target={DIFFICULTY_PERIOD_IN_SECS} "
+            f"duration={period_duration} "
+            f"bits={block.bits}->{next_bits} "
+        )
+    return next_bits
+
+def prepare_tx(utxos, sender_private_key, payments, change):
+    # One output per (public_key, amount) payment, plus change if any
+    tx_id = new_tx_id()
+    tx_ins = [TxIn(tx_id=tx_out.tx_id, index=tx_out.index, signature=None) for tx_out in utxos]
+    tx_outs = [TxOut(tx_id=tx_id, index=index, amount=amount, public_key=public_key)
+               for index, (public_key, amount) in enumerate(payments)]
+    if change > 0:
+        sender_public_key = sender_private_key.get_verifying_key()
+        tx_outs.append(TxOut(tx_id=tx_id, index=len(tx_outs), amount=change, public_key=sender_public_key))
 
     # Construct tx and sign inputs
     tx = Tx(id=tx_id, tx_ins=tx_ins, tx_outs=tx_outs)
@@ -366,9 +1286,87 @@ def prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, f
         tx.sign_input(i, sender_private_key)
     return tx
 
+def prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, fee):
+    selected = select_coins(utxos, amount + fee)
+    change = sum([tx_out.amount for tx_out in selected]) - (amount + fee)
+    return prepare_tx(selected, sender_private_key, [(recipient_public_key, amount)], change)
+
+def select_coins(utxos, target, cost_of_change=0):
+    # Prefer a set of inputs that lands within cost_of_change of the target,
+    # so no change output is needed, then fall back to the smallest
+    # overshoot found by a randomized knapsack search.
+    utxos = sorted(utxos, key=lambda tx_out: tx_out.amount, reverse=True)
+    assert sum([tx_out.amount for tx_out in utxos]) >= target, "Sender can not afford this tx"
+    selected = branch_and_bound(utxos, target, cost_of_change)
+    if selected is None:
+        selected = knapsack(utxos, target)
+    return selected
+
+def branch_and_bound(utxos, target, cost_of_change, max_tries=COIN_SELECTION_TRIES):
+    # Depth-first search over include/exclude decisions on amount-sorted
+    # utxos, pruning branches that overshoot or can no longer reach target
+    remaining = [0] * (len(utxos) + 1)
+    for i in range(len(utxos) - 1, -1, -1):
+        remaining[i] = remaining[i+1] + utxos[i].amount
+    best, best_excess = None, None
+    stack = [(0, 0, [])]
+    tries = 0
+    while stack and tries < max_tries:
+        tries += 1
+        depth, total, included = stack.pop()
+        if total > target + cost_of_change or total + remaining[depth] < target:
+            continue
+        if total >= target:
+            if best is None or total - target < best_excess:
+                best, best_excess = included, total - target
+                if best_excess == 0:
+                    break
+            continue
+        if depth == len(utxos):
+            continue
+        stack.append((depth + 1, total, included))
+        stack.append((depth + 1, total + utxos[depth].amount, included + [depth]))
+    if best is None:
+        return None
+    return [utxos[i] for i in best]
+
+def knapsack(utxos, target, iterations=COIN_SELECTION_TRIES // 100):
+    # Randomly include coins, backing the last one out whenever the target
+    # is reached, and keep the subset with the smallest overshoot
+    best = list(utxos)
+    best_total = sum([tx_out.amount for tx_out in best])
+    for _ in range(iterations):
+        included, total = [], 0
+        for tx_out in utxos:
+            if random.random() < 0.5:
+                continue
+            included.append(tx_out)
+            total += tx_out.amount
+            if total >= target:
+                if total < best_total:
+                    best, best_total = list(included), total
+                included.pop()
+                total -= tx_out.amount
+    return best
+
+def encode_tx(tx):
+    # Canonical encoding of a tx, used for its merkle leaf
+    return pickle.dumps((
+        tx.id,
+        [(tx_in.tx_id, tx_in.index, tx_in.signature) for tx_in in tx.tx_ins],
+        [(tx_out.tx_id, tx_out.index, tx_out.amount, tx_out.public_key) for tx_out in tx.tx_outs],
+    ), protocol=4)
+
+def decode_tx(encoded):
+    tx_id, tx_ins, tx_outs = pickle.loads(encoded)
+    return Tx(tx_id, [TxIn(*tx_in) for tx_in in tx_ins], [TxOut(*tx_out) for tx_out in tx_outs])
+
+def compute_merkle_root(txns):
+    return merkle_root(tx.hash for tx in txns)
+
 def prepare_coinbase(public_key, block_subsidy, tx_id=None):
     if tx_id is None:
-        tx_id = uuid.uuid4()
+        tx_id = new_tx_id()
     return Tx(
         id=tx_id,
         tx_ins=[TxIn(None, None, None)],
@@ -381,6 +1379,165 @@ def prepare_coinbase(public_key, block_subsidy, tx_id=None):
 ##########
 
 
+class BlockTemplate:
+    # The block the miner is working on, kept up to date as transactions
+    # enter and leave the mempool instead of being rebuilt every round.
+    # Leaf 0 of the merkle tree is the coinbase, followed by txns picked by
+    # ancestor fee rate with parents always ahead of their children. A new
+    # tx is appended, after any of its ancestors left out, when they fit. A
+    # full template only reruns the selection for a package that outbids
+    # the cheapest one it holds; the rest wait for the next block or
+    # TEMPLATE_RESELECT_INTERVAL. `version` is bumped on every change so
+    # the miner knows when to refresh.
+    def __init__(self, node, public_key):
+        self.node = node
+        self.public_key = public_key
+        self.version = 0
+        self.txns = {} # tx.id -> (tx, fee), parents first
+        self.fees = 0
+        self.size = 0
+        self.min_rate = math.inf # lowest package fee rate taken
+        self.dirty = False # mempool txns may deserve a place
+        self.tree = None
+        self.update_tip()
+
+    def update_tip(self):
+        tip = self.node.blocks.headers[-1]
+        self.prev_id = tip.id
+        self.bits = self.node.get_next_bits(tip.id)
+        self.subsidy = self.node.get_block_subsidy()
+        self.coinbase_id = new_tx_id()
+        if len(self.txns) < len(self.node.mempool):
+            self.select() # The block may have made room for txns left out
+        else:
+            self.rebuild()
+        self.timestamp = self.node.clock()
+        self.version += 1
+
+    def update_coinbase(self):
+        self.coinbase = prepare_coinbase(self.public_key, self.subsidy + self.fees, tx_id=self.coinbase_id)
+        if self.tree is not None: # Otherwise rebuilt by update_tip
+            self.tree.update(0, self.coinbase.hash)
+
+    def rebuild(self):
+        self.coinbase = prepare_coinbase(self.public_key, self.subsidy + self.fees, tx_id=self.coinbase_id)
+        self.tree = MerkleTree([self.coinbase.hash] + [tx.hash for tx, fee in self.txns.values()])
+
+    def select(self):
+        # Repeatedly take the tx whose package (it plus its ancestors not yet
+        # taken) pays the best fee rate, until the template is full. Taking
+        # a package changes the rate of its descendants' packages, so stale
+        # heap entries are rescored when they come up.
+        mempool = self.node.mempool
+        self.txns, self.fees, self.size = {}, 0, 0
+        self.min_rate, self.dirty = math.inf, False
+        self.selected_at = self.node.clock()
+
+        def package(tx_id):
+            tx_ids = [ancestor for ancestor in self.node.mempool_ancestors(mempool[tx_id].tx)
+                      if ancestor not in self.txns] + [tx_id]
+            fee = sum([mempool[tx_id].fee for tx_id in tx_ids])
+            size = sum([mempool[tx_id].size for tx_id in tx_ids])
+            return -fee / size, size
+
+        def take(tx_id):
+            tx = mempool[tx_id].tx
+            for parent in self.node.mempool_parents(tx):
+                if parent not in self.txns:
+                    take(parent)
+            self.txns[tx_id] = (tx, mempool[tx_id].fee)
+            self.fees += mempool[tx_id].fee
+            self.size += mempool[tx_id].size
+
+        heap = [(package(tx_id)[0], arrival, tx_id) for arrival, tx_id in enumerate(mempool)]
+        heapq.heapify(heap)
+        while heap:
+            rate, arrival, tx_id = heapq.heappop(heap)
+            if tx_id in self.txns:
+                continue
+            new_rate, size = package(tx_id)
+            if new_rate != rate:
+                heapq.heappush(heap, (new_rate, arrival, tx_id))
+            elif self.size + size <= TEMPLATE_MAX_BYTES:
+                take(tx_id)
+                self.min_rate = min(self.min_rate, -rate)
+
+        self.rebuild()
+        self.version += 1
+
+    def add_tx(self, tx):
+        if tx.id in self.txns:
+            return
+        mempool = self.node.mempool
+        package = [tx_id for tx_id in self.node.mempool_ancestors(tx) if tx_id not in self.txns] + [tx.id]
+        fee = sum([mempool[tx_id].fee for tx_id in package])
+        size = sum([mempool[tx_id].size for tx_id in package])
+        if self.size + size > TEMPLATE_MAX_BYTES:
+            if fee / size > self.min_rate:
+                return self.select()
+            self.dirty = True
+            return
+        self.append(tx.id)
+        self.min_rate = min(self.min_rate, fee / size)
+        if self.node.mempool_children(tx): # Left out until now for want of tx
+            self.dirty = True
+        self.update_coinbase()
+        self.version += 1
+
+    def append(self, tx_id):
+        # Parents first, like select's take
+        entry = self.node.mempool[tx_id]
+        for parent in self.node.mempool_parents(entry.tx):
+            if parent not in self.txns:
+                self.append(parent)
+        self.txns[tx_id] = (entry.tx, entry.fee)
+        self.fees += entry.fee
+        self.size += entry.size
+        if self.tree is not None:
+            self.tree.append(entry.tx.hash)
+
+    def remove_tx(self, tx):
+        if tx.id not in self.txns:
+            return
+        if self.tree is not None:
+            self.tree.remove(list(self.txns).index(tx.id) + 1)
+        tx, fee = self.txns.pop(tx.id)
+        self.fees -= fee
+        self.size -= self.node.mempool[tx.id].size
+        self.update_coinbase()
+        self.dirty = True # Room for something left out
+        self.version += 1
+
+    def remove_confirmed(self, block):
+        # Drops a block's txns in one pass, before they leave the mempool
+        # one by one. update_tip rebuilds the tree and coinbase once after.
+        confirmed = [tx.id for tx in block.txns if tx.id in self.txns]
+        if not confirmed:
+            return
+        for tx_id in confirmed:
+            tx, fee = self.txns.pop(tx_id)
+            self.fees -= fee
+            self.size -= self.node.mempool[tx_id].size
+        self.tree = None
+
+    def refresh(self):
+        # Called by the miner between batches of nonces
+        if self.dirty and self.node.clock() - self.selected_at >= TEMPLATE_RESELECT_INTERVAL:
+            self.select()
+        if self.node.clock() - self.timestamp >= TEMPLATE_TIMESTAMP_INTERVAL:
+            self.timestamp = self.node.clock()
+            self.version += 1
+
+    def block(self, nonce):
+        return Block(
+            txns=[self.coinbase] + [tx for tx, fee in self.txns.values()],
+            prev_id=self.prev_id,
+            nonce=nonce,
+            bits=self.bits,
+            timestamp=self.timestamp,
+            merkle_root=self.tree.root
+        )
+
 def mine_block(block):
     while block.proof >= block.target:
         if mining_interrupt.is_set():
@@ -390,29 +1547,64 @@ def mine_block(block):
         block.nonce += 1
     return block
 
+def mine_template(template, nonce):
+    # Like mine_block, but swaps in the latest template every
+    # TEMPLATE_POLL_INTERVAL nonces, carrying on from the current nonce
+    with lock:
+        block = template.block(nonce)
+        version = template.version
+    polled_at = time.perf_counter()
+    while block.proof >= block.target:
+        if mining_interrupt.is_set():
+            logger.info("Mining interrupted")
+            mining_interrupt.clear()
+            return
+        block.nonce += 1
+        if block.nonce % TEMPLATE_POLL_INTERVAL == 0:
+            now = time.perf_counter()
+            hashes_total.inc(TEMPLATE_POLL_INTERVAL)
+            hash_rate.set(TEMPLATE_POLL_INTERVAL / (now - polled_at))
+            polled_at = now
+            with lock:
+                template.refresh()
+                if template.version != version:
+                    block = template.block(block.nonce)
+                    version = template.version
+    return block
+
 def mine_forever(public_key):
     logging.info("Starting miner")
+    with lock:
+        template = node.template = BlockTemplate(node, public_key)
     while True:
-        block_subsidy = node.get_block_subsidy()
-        fees = node.calculate_fees(node.mempool)
-        coinbase = prepare_coinbase(public_key, block_subsidy + fees)
-        unmined_block = Block(
-            txns=[coinbase] + node.mempool,
-            prev_id=node.blocks[-1].id,
-            nonce=random.randint(0, 1000000000),
-            bits=node.get_next_bits(node.blocks[-1].id),
-            timestamp=time.time()
-        )
-        mined_block = mine_block(unmined_block)
+        mined_block = mine_template(template, nonce=random.randint(0, 1000000000))
 
         if mined_block:
             logger.info("")
             logger.info("Mined a block")
+            if capture: # So a replay has the blocks peers build on
+                capture.record(time.time(), "(miner)", serialize({"command": "blocks", "data": [encode_block(mined_block)]}))
             with lock:
                 node.handle_block(mined_block)
 
+def load_genesis_block(node, public_key):
+    # The genesis block is fixed, so rebuild it from its known nonce and
+    # check it rather than mining it again on every start
+    coinbase = prepare_coinbase(public_key, node.get_block_subsidy(), tx_id=bytes(32))
+    block = Block(
+        txns=[coinbase],
+        prev_id=None,
+        nonce=GENESIS_NONCE,
+        bits=INITIAL_DIFFICULTY_BITS,
+        timestamp=1560374099.0134091
+    )
+    assert block.id == GENESIS_BLOCK_ID, "Unexpected genesis block"
+    node.validate_block(block)
+    node.connect_block(block)
+    return block
+
 def mine_genesis_block(node, public_key):
-    coinbase = prepare_coinbase(public_key, node.get_block_subsidy(), tx_id="abc123")
+    coinbase = prepare_coinbase(public_key, node.get_block_subsidy(), tx_id=bytes(32))
     unmined_block = Block(
         txns=[coinbase],
         prev_id=None,
@@ -421,8 +1613,7 @@ def mine_genesis_block(node, public_key):
         timestamp=1560374099.0134091
     )
     mined_block = mine_block(unmined_block)
-    node.blocks.append(mined_block)
-    node.connect_tx(coinbase)
+    node.connect_block(mined_block)
     return mined_block
 
 ##############
@@ -432,32 +1623,64 @@ def mine_genesis_block(node, public_key):
 def serialize(coin):
     return pickle.dumps(coin)
 
+class Unpickler(pickle.Unpickler):
+    # The node and CLI pickle our classes as __main__.*, tools that import
+    # us pickle them as mybitcoin.*. Either way they're ours.
+    def find_class(self, module, name):
+        if module in ("__main__", "mybitcoin"):
+            module = __name__
+        return super().find_class(module, name)
+
 def deserialize(serialized):
-    return pickle.loads(serialized)
+    return Unpickler(io.BytesIO(serialized)).load()
+
+def encode_block(block):
+    # How blocks go over the wire: the fixed size header, then the txns.
+    # A receiver can check a block's proof-of-work before parsing the rest.
+    return block.header + serialize(block.txns)
+
+def decode_block(header, encoded):
+    return Block(txns=deserialize(encoded[HEADER_SIZE:]), prev_id=header.prev_id, nonce=header.nonce,
+                 bits=header.bits, timestamp=header.timestamp, merkle_root=header.merkle_root)
+
+def read_raw_message(s):
+    # Our protocol is: first 4 bytes signify message length. Reads exactly
+    # one message, so the next can follow on the same connection. Returns
+    # b"" if the connection closed before another message started.
+    raw_message_length = s.recv(4)
+    if not raw_message_length:
+        return b""
+    raw_message_length += recv_exactly(s, 4 - len(raw_message_length))
+    return recv_exactly(s, int.from_bytes(raw_message_length, 'big'))
+
+def recv_exactly(s, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = s.recv(min(size - len(data), 65536))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message")
+        data += chunk
+    return bytes(data)
 
 def read_message(s):
-    message = b''
-    # Our protocol is: first 4 bytes signify message length
-    raw_message_length = s.recv(4) or b"\x00"
-    message_length = int.from_bytes(raw_message_length, 'big')
-    while message_length > 0:
-        chunk = s.recv(1024)
-        message += chunk
-        message_length -= len(chunk)
-    return deserialize(message)
-
-def prepare_message(command, data):
+    return deserialize(read_raw_message(s))
+
+def prepare_message(command, data, id=None):
     message = {
         "command": command,
         "data": data,
     }
+    if id is not None: # Correlates pipelined requests with their responses
+        message["id"] = id
     serialized_message = serialize(message)
     length = len(serialized_message).to_bytes(4, 'big')
     return length + serialized_message
 
 def disrupt(func, args):
     if random.randint(0, 10) != 0: # Simulate packet loss
-        threading.Timer(random.random(), func, args).start() # Simulate network latency
+        timer = threading.Timer(random.random(), func, args) # Simulate network latency
+        timer.name = "relay"
+        timer.start()
 
 class TCPHandler(socketserver.BaseRequestHandler):
     def get_canonical_peer_address(self):
@@ -469,97 +1692,843 @@ class TCPHandler(socketserver.BaseRequestHandler):
             hostname = ip
         return (hostname, PORT)
 
-    def respond(self, command, data):
-        response = prepare_message(command, data)
+    def respond(self, command, data, id=None):
+        if inspect.isgenerator(data): # A response per item, sent once message_lock is released
+            self.streams.append((command, data, id))
+            return
+        response = prepare_message(command, data, id)
+        peer_bytes.inc(len(response), peer=peer_label(self.peer[0]), direction="out")
         return self.request.sendall(response)
 
     def handle(self):
-        message = read_message(self.request)
-        command = message["command"]
-        data = message["data"]
-        peer = self.get_canonical_peer_address()
-
-        # Handshake / Authentication
-        if command == "connect":
-            if peer not in node.pending_peers and peer not in node.peers:
+        # Peers send one message and hang up; clients may send many over
+        # one connection, each answered with the id it came with
+        threading.current_thread().name = "handler" # Rather than Thread-N, so the profiler samples it
+        peer = self.peer = self.get_canonical_peer_address()
+        self.streams = []
+        while True:
+            raw_message = read_raw_message(self.request)
+            if not raw_message:
+                return
+            message = deserialize(raw_message)
+            peer_bytes.inc(len(raw_message) + 4, peer=peer_label(peer[0]), direction="in")
+            if capture:
+                capture.record(time.time(), peer[0], raw_message)
+            respond = functools.partial(self.respond, id=message.get("id"))
+            label = message["command"] if message["command"] in COMMANDS else "other"
+            with message_lock, command_seconds.time(command=label):
+                handle_message(node, message["command"], message["data"], peer, respond)
+            try:
+                for command, items, id in self.streams:
+                    for item in items:
+                        self.respond(command, item, id)
+            finally: # Runs the streams' cleanup even if the client went away
+                for _, items, _ in self.streams:
+                    items.close()
+                self.streams = []
+
+def handle_message(node, command, data, peer, respond):
+    # Apply a message from `peer` to `node`; `respond` replies to the sender
+
+    # Handshake / Authentication
+    if command == "connect":
+        # A peer we're also dialing is accepted too, or when two nodes
+        # dial each other at once neither would ever answer
+        if peer not in node.peers:
+            if peer not in node.pending_peers:
                 node.pending_peers.append(peer)
-                logger.info(f'(handshake) Accepted "connect" request from "{peer[0]}"')
-                send_message(peer, "connect-response", None)
-        elif command == "connect-response":
-            if peer in node.pending_peers and peer not in node.peers:
-                node.pending_peers.remove(peer)
-                node.peers.append(peer)
-                logger.info(f'(handshake) Connected to "{peer[0]}"')
-                send_message(peer, "connect-response", None)
-                send_message(peer, "peers", None)# Request their peers
-        # else: # This is commented out so we can interact with the network without being a peer
-        #     assert peer in node.peers, \
-        #         f"Rejecting {command} from unconnected {peer[0]}"
-
-        # Business Logic
-        if command == "peers":
-            send_message(peer, "peers-response", node.peers)
-        if command == "peers-response":
-            for peer in data:
-                node.connect(peer)
-        if command == "ping":
-            self.respond(command="pong", data="")
-        if command == "sync":
-            # Find our most recent block peer doesn't know about,
-            # But which build off a block they do know about.
-            peer_block_ids = data
-            for block in node.blocks[::-1]:
-                if block.id not in peer_block_ids \
-                        and block.prev_id in peer_block_ids:
-                    height = node.blocks.index(block)
-                    blocks = node.blocks[height:height+GET_BLOCKS_CHUNK]
-                    send_message(peer, "blocks", blocks)
-                    logger.info('Served "sync" request')
-                    return
-            logger.info('Could not serve "sync" request')
-        if command == "blocks":
-            for block in data:
-                try:
-                    with lock:
-                        node.handle_block(block)
-                    mining_interrupt.set()
-                except:
-                    logger.info("Rejected block")
-            if len(data) == GET_BLOCKS_CHUNK:
-                node.sync()
-        if command == "tx":
+            logger.info(f'(handshake) Accepted "connect" request from "{peer[0]}"')
+            node.send(peer, "connect-response", None)
+    elif command == "connect-response":
+        if peer in node.pending_peers and peer not in node.peers:
+            node.pending_peers.remove(peer)
+            node.peers.append(peer)
+            logger.info(f'(handshake) Connected to "{peer[0]}"')
+            node.send(peer, "connect-response", None)
+            node.send(peer, "peers", None)# Request their peers
+            node.sync_with(peer) # Start downloading blocks right away
+    # else: # This is commented out so we can interact with the network without being a peer
+    #     assert peer in node.peers, \
+    #         f"Rejecting {command} from unconnected {peer[0]}"
+
+    # Business Logic
+    if command == "peers":
+        node.send(peer, "peers-response", node.peers)
+    if command == "peers-response":
+        for peer in data:
+            node.connect(peer)
+    if command == "ping":
+        respond(command="pong", data="")
+    if command == "sync":
+        # Find our most recent block peer doesn't know about,
+        # But which build off a block they do know about.
+        peer_block_ids = data
+        for height in range(len(node.blocks) - 1, -1, -1):
+            header = node.blocks.headers[height]
+            if header.id not in peer_block_ids \
+                    and header.prev_id in peer_block_ids \
+                    and header.id in node.blocks.store: # Not pruned or a header below a snapshot
+                blocks = node.blocks[height:height+GET_BLOCKS_CHUNK]
+                node.send(peer, "blocks", [encode_block(block) for block in blocks])
+                logger.info('Served "sync" request')
+                return
+        node.send(peer, "blocks", []) # Nothing newer, let them know they're caught up
+        logger.info('Could not serve "sync" request')
+    if command == "blocks":
+        headers = [BlockHeader.from_bytes(encoded[:HEADER_SIZE]) for encoded in data]
+        if len(data) == GET_BLOCKS_CHUNK: # Download the next batch while this one is connected
+            node.sync(after=headers)
+        connect_blocks(node, decode_blocks(node, headers, data))
+        if len(data) < GET_BLOCKS_CHUNK:
+            node.synced.set()
+    if command == "tx": # The miner reads the template this changes under the lock
+        with lock:
             node.handle_tx(data)
-        if command == "balance":
-            balance = node.fetch_balance(data)
-            self.respond(command="balance-response", data=balance)
-        if command == "utxos":
-            utxos = node.fetch_utxos(data)
-            self.respond(command="utxos-response", data=utxos)
+    if command == "balance": # One key, or a list of them answered in one pass
+        with lock:
+            balance = node.fetch_balances(data) if isinstance(data, list) else node.fetch_balance(data)
+        respond(command="balance-response", data=balance)
+    if command == "utxos":
+        if isinstance(data, dict) and data.get("stream"): # Every page from the cursor on
+            pages = stream_utxo_pages(node, data["public_key"], data.get("cursor"), data.get("limit", UTXO_PAGE_SIZE))
+            respond(command="utxos-response", data=pages)
+        elif isinstance(data, dict): # One page
+            with lock:
+                page = node.fetch_utxo_page(data["public_key"], data.get("cursor"), data.get("limit", UTXO_PAGE_SIZE))
+            respond(command="utxos-response", data=page)
+        else:
+            with lock:
+                utxos = node.fetch_many_utxos(data) if isinstance(data, list) else node.fetch_utxos(data)
+            respond(command="utxos-response", data=utxos)
+    if command == "subscribe": # Takes over the connection until the client goes
+        subscriber = Subscriber(data.get("public_keys", ()), data.get("tips", False))
+        respond(command="notification", data=stream_notifications(node, subscriber))
+    if command == "gettx":
+        with lock:
+            found = node.fetch_tx(data)
+        respond(command="gettx-response", data=found)
+    if command == "history":
+        with lock:
+            page = node.fetch_history(data["public_key"], data["start"], data["limit"])
+        respond(command="history-response", data=page)
+    if command == "headers":
+        headers = node.fetch_headers(data)
+        respond(command="headers-response", data=headers)
+    if command == "filters":
+        filters = node.fetch_filters(data)
+        respond(command="filters-response", data=filters)
+    if command == "getblocks":
+        blocks = node.fetch_blocks(data)
+        respond(command="getblocks-response", data=blocks)
+    if command == "estimatefee": # Satoshis per byte to confirm within `data` blocks, or None
+        with lock:
+            fee_rate = node.fee_estimator.estimate(data, len(node.blocks) - 1)
+        respond(command="estimatefee-response", data=fee_rate)
+    if command == "stats":
+        respond(command="stats-response", data=registry.snapshot())
+    if command == "dumptxoutset": # Written once message_lock is released
+        respond(command="dumptxoutset-response", data=later(dump_snapshot, node, snapshot_path(data)))
+    if command == "utxo-proofs":
+        with lock:
+            proofs = node.fetch_utxo_proofs(data)
+        respond(command="utxo-proofs-response", data=proofs)
+
+def later(func, *args):
+    # As a response, func runs after message_lock is released, like a stream
+    yield func(*args)
+
+def decode_blocks(node, headers, encoded_blocks):
+    # Only blocks whose headers pass check_headers have their bodies parsed;
+    # the first that fails, or whose body doesn't parse, ends the batch
+    with lock:
+        passed = node.check_headers(headers)
+    blocks = []
+    for header, encoded in zip(headers[:passed], encoded_blocks):
+        try:
+            blocks.append(decode_block(header, encoded))
+        except Exception:
+            break
+    if len(blocks) < len(encoded_blocks):
+        logger.info(f"Rejected {len(encoded_blocks) - len(blocks)} blocks without parsing them")
+    return blocks
+
+def connect_blocks(node, blocks):
+    # Relayed blocks come one at a time and go straight to handle_block. A
+    # sync batch is pipelined: sync_pool's workers check every block's
+    # merkle root and signatures at once, while this thread
+    # connects them in order as their checks come back, so a batch takes
+    # about as long as the slower stage rather than the sum of both. The
+    # first block rejected ends the batch, as its descendants can't connect.
+    futures = []
+    if len(blocks) > 1 and sync_pool:
+        futures = [sync_pool.submit(precheck_block, block, keys)
+                   for block, keys in zip(blocks, spent_keys(node, blocks))]
+    prev_id = blocks[0].prev_id if blocks else None
+    for index, block in enumerate(blocks):
+        try:
+            assert block.prev_id == prev_id, "Batch isn't a chain"
+            checked = futures[index].result() if futures else None
+            with lock:
+                node.handle_block(block, checked)
+            mining_interrupt.set()
+            prev_id = block.id
+        except:
+            logger.info(f"Rejected block, dropping the {len(blocks) - index - 1} after it")
+            for future in futures[index + 1:]:
+                future.cancel()
+            break
+
+def spent_keys(node, blocks):
+    # For each non-coinbase tx of each block, the keys of the outputs it
+    # spends as far as the utxo set and earlier blocks in the batch tell, or
+    # None. Only hints: validate_tx compares them with the real ones. Assumed
+    # valid blocks get no keys, so the workers skip their signatures too.
+    with lock:
+        utxos = UtxoView(node.utxo_set)
+        keys = []
+        for block in blocks:
+            skip = block.id in node.assumed_valid
+            keys.append([[utxos[tx_in.outpoint].public_key if tx_in.outpoint in utxos and not skip else None
+                          for tx_in in tx.tx_ins] for tx in block.txns[1:]])
+            for tx in block.txns:
+                utxos.apply(tx)
+    return keys
+
+def precheck_block(block, public_keys):
+    # Runs in a sync_pool worker: the checks that don't need the utxo set,
+    # beyond the header's. Returns, per non-coinbase tx, the keys its
+    # signatures verified against, with None where there was no key or the
+    # signature didn't verify.
+    assert block.merkle_root == compute_merkle_root(block.txns), "Invalid merkle root"
+    return [[checked_key(tx, index, public_key) for index, public_key in enumerate(keys)]
+            for tx, keys in zip(block.txns[1:], public_keys)]
+
+def checked_key(tx, index, public_key):
+    try:
+        return public_key if public_key is not None and tx.verify_input(index, public_key) else None
+    except Exception:
+        return None
+
+class Subscriber:
+    # Events waiting to be pushed to one client. The buffer is bounded: a
+    # subscriber that falls SUBSCRIBER_BUFFER events behind loses the oldest,
+    # and its next notification says how many it missed so it can catch up
+    # with a balance or utxos query.
+    def __init__(self, public_keys=(), tips=False):
+        self.public_keys = {public_key_bytes(public_key) for public_key in public_keys}
+        self.tips = tips
+        self.buffer = deque(maxlen=SUBSCRIBER_BUFFER)
+        self.missed = 0
+        self.ready = threading.Condition()
+
+    def push(self, event):
+        with self.ready:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.missed += 1
+            self.buffer.append(event)
+            self.ready.notify()
+
+    def next_notification(self):
+        # Everything buffered, waiting up to SUBSCRIBER_HEARTBEAT for
+        # something. An empty notification doubles as a heartbeat.
+        with self.ready:
+            self.ready.wait_for(lambda: self.buffer, timeout=SUBSCRIBER_HEARTBEAT)
+            events = list(self.buffer)
+            self.buffer.clear()
+            missed, self.missed = self.missed, 0
+        return {"events": events, "missed": missed}
+
+def stream_notifications(node, subscriber):
+    # The first, empty, notification confirms the subscription is live.
+    # Stops once sending fails, i.e. at the latest a heartbeat after the
+    # client has gone.
+    with lock:
+        node.subscribe(subscriber)
+    try:
+        yield {"events": [], "missed": 0}
+        while True:
+            yield subscriber.next_notification()
+    finally:
+        with lock:
+            node.unsubscribe(subscriber)
+
+def stream_utxo_pages(node, public_key, cursor, limit):
+    # Holds the lock for one page at a time, never while the client reads
+    while True:
+        with lock:
+            page = node.fetch_utxo_page(public_key, cursor, limit)
+        yield page
+        cursor = page["next"]
+        if cursor is None:
+            return
 
 def external_address(node):
     i = int(node[-1])
     port = PORT + i
     return ('localhost', port)
 
-def serve():
+def make_server():
+    # Bound and listening as soon as this returns. A thread per connection
+    # lets clients hold theirs open; message_lock still has messages
+    # handled one at a time.
+    server = socketserver.ThreadingTCPServer(("0.0.0.0", PORT), TCPHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.allow_reuse_address = True # Restarts shouldn't wait out TIME_WAIT
+    server.server_bind()
+    server.server_activate()
+    return server
+
+def serve(server=None):
     logger.info("Starting server")
-    server = socketserver.TCPServer(("0.0.0.0", PORT), TCPHandler)
+    server = server or make_server()
     server.serve_forever()
 
 def send_message(address, command, data, response=False):
     message = prepare_message(command, data)
+    peer_bytes.inc(len(message), peer=peer_label(address[0]), direction="out")
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect(address)
         s.sendall(message)
         if response:
             return read_message(s)
 
+class Connection:
+    # Many requests over one connection. Requests carry ids that their
+    # responses echo, so they can be pipelined: up to PIPELINE_DEPTH are
+    # sent before waiting, which keeps neither side blocked on a full buffer.
+    def __init__(self, address):
+        self.address = address
+        self.socket = socket.create_connection(address)
+        self.next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.socket.close()
+
+    def request(self, command, data):
+        return self.pipeline([(command, data)])[0]
+
+    def pipeline(self, requests):
+        # Responses to (command, data) requests, in the same order
+        ids, responses = [], {}
+        for command, data in requests:
+            if len(ids) - len(responses) >= PIPELINE_DEPTH:
+                self._receive(responses)
+            ids.append(self._send(command, data))
+        while len(responses) < len(ids):
+            self._receive(responses)
+        return [responses[id] for id in ids]
+
+    def stream(self, command, data, last=lambda data: False):
+        # Yields the data of each response to a streamed request, up to and
+        # including the `last` one. Nothing else may be in flight meanwhile.
+        id = self._send(command, data)
+        while True:
+            responses = {}
+            self._receive(responses)
+            data = responses[id]["data"]
+            yield data
+            if last(data):
+                return
+
+    def _send(self, command, data):
+        id, self.next_id = self.next_id, self.next_id + 1
+        message = prepare_message(command, data, id)
+        peer_bytes.inc(len(message), peer=peer_label(self.address[0]), direction="out")
+        self.socket.sendall(message)
+        return id
+
+    def _receive(self, responses):
+        raw_message = read_raw_message(self.socket)
+        if not raw_message:
+            raise ConnectionError("Node closed the connection")
+        message = deserialize(raw_message)
+        responses[message["id"]] = message
+
+
+################
+# Light client #
+################
+
+
+class LightClient:
+    # Keeps only the header chain and checks what a full node tells it
+    # against that chain. Proofs show a utxo was created in a block on the
+    # most-work chain; they can't show that it hasn't been spent since.
+    def __init__(self, address, path=None):
+        self.address = address
+        self.path = path
+        self.headers = []
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            size = struct.calcsize(HEADER_FORMAT)
+            self.headers = [BlockHeader.from_bytes(data[i:i+size])
+                            for i in range(0, len(data), size)]
+
+    def save(self):
+        if self.path:
+            with open(self.path, "wb") as f:
+                f.write(b"".join(header.header for header in self.headers))
+
+    def locator(self):
+        ids = [header.id for header in self.headers[-GET_BLOCKS_CHUNK:]]
+        if self.headers:
+            ids.append(self.headers[0].id)
+        return ids
+
+    def sync(self):
+        while True:
+            response = send_message(self.address, "headers", self.locator(), response=True)
+            headers = [BlockHeader.from_bytes(header) for header in response["data"]]
+            if headers:
+                self.add_headers(headers)
+            if len(headers) < MAX_HEADERS:
+                break
+        self.save()
+
+    def add_headers(self, headers):
+        # Find where the new headers attach to our chain
+        if self.headers:
+            ids = [header.id for header in self.headers]
+            assert headers[0].prev_id in ids, "Headers don't connect to our chain"
+            fork_height = ids.index(headers[0].prev_id)
+        else:
+            assert headers[0].prev_id is None, "Expected headers from genesis"
+            fork_height = -1
+        chain = self.headers[:fork_height+1]
+        for header in headers:
+            if chain:
+                assert header.prev_id == chain[-1].id, "Headers aren't linked"
+                assert header.bits == next_bits(chain, len(chain) - 1), "Invalid difficulty"
+            assert header.proof < header.target, "Insufficient Proof-of-Work"
+            chain.append(header)
+        # Follow the branch with the most work
+        total_work = lambda headers: sum([2**header.bits for header in headers])
+        if total_work(chain[fork_height+1:]) > total_work(self.headers[fork_height+1:]):
+            self.headers = chain
+
+    def headers_by_id(self):
+        return {header.id: header for header in self.headers}
+
+    def verify_utxo_proof(self, public_key, utxo_proof, headers):
+        # `headers` is headers_by_id(), built once for all the proofs checked
+        tx, index = utxo_proof["tx"], utxo_proof["index"]
+        assert utxo_proof["block_id"] in headers, "Block not in our header chain"
+        merkle_root = headers[utxo_proof["block_id"]].merkle_root
+        assert verify_proof(tx.hash, utxo_proof["proof"], merkle_root), "Invalid merkle proof"
+        tx_out = tx.tx_outs[index]
+        assert tx_out.public_key == public_key_bytes(public_key), "Output belongs to another key"
+        return tx_out
+
+    def fetch_utxos(self, public_key, headers=None):
+        response = send_message(self.address, "utxo-proofs", public_key, response=True)
+        if response["data"] is None:
+            raise Exception("Node can't prove utxos without its tx index (serve --txindex)")
+        headers = headers or self.headers_by_id()
+        return [self.verify_utxo_proof(public_key, utxo_proof, headers)
+                for utxo_proof in response["data"]]
+
+    def fetch_balances(self, public_keys):
+        headers = self.headers_by_id()
+        return [sum([tx_out.amount for tx_out in self.fetch_utxos(public_key, headers)])
+                for public_key in public_keys]
+
+    def matching_blocks(self, public_keys, start=0):
+        # Test each block's filter locally and only download the blocks that
+        # match. Filters aren't committed to by headers, but the blocks are
+        # checked against them.
+        items = [public_key_bytes(public_key) for public_key in public_keys]
+        for start in range(start, len(self.headers), RESCAN_CHUNK):
+            headers = self.headers[start:start+RESCAN_CHUNK]
+            response = send_message(self.address, "filters", [h.id for h in headers], response=True)
+            matched = [header for header, block_filter in zip(headers, response["data"])
+                       if block_filter is None or match_any(filter_key(header.id), block_filter, items)]
+            if not matched:
+                continue
+            response = send_message(self.address, "getblocks", [h.id for h in matched], response=True)
+            for header, block in zip(matched, response["data"]):
+                if block is None: # Pruned, or below a snapshot it hasn't validated yet
+                    raise Exception(f"Node doesn't have block {header.id[:10]} to rescan, "
+                                    "try one that keeps every block")
+                assert block.id == header.id, "Node sent the wrong block"
+                assert compute_merkle_root(block.txns) == header.merkle_root, "Invalid merkle root"
+                yield block
+
+    def rescan(self, public_keys):
+        # Every confirmed tx that pays or spends from one of the keys
+        txns = []
+        our_outpoints = set()
+        public_keys = [public_key_bytes(public_key) for public_key in public_keys]
+        for block in self.matching_blocks(public_keys):
+            for tx in block.txns:
+                pays_us = any(tx_out.public_key in public_keys for tx_out in tx.tx_outs)
+                spends_ours = any(tx_in.outpoint in our_outpoints for tx_in in tx.tx_ins)
+                if pays_us or spends_ours:
+                    txns.append(tx)
+                for tx_out in tx.tx_outs:
+                    if tx_out.public_key in public_keys:
+                        our_outpoints.add(tx_out.outpoint)
+        return txns
+
+
+##########
+# Wallet #
+##########
+
+
+class Wallet:
+    # A key's utxos, cached locally and synced block by block from the
+    # header chain and compact filters, so only new blocks that touch the
+    # key are downloaded. Outputs spent by our own unconfirmed txns are
+    # held back as pending so they aren't selected twice.
+    def __init__(self, private_key, address, path=None):
+        self.private_key = private_key
+        self.public_key = public_key_bytes(private_key.get_verifying_key())
+        self.client = LightClient(address)
+        self.path = path
+        self.utxos = {} # outpoint -> tx_out
+        self.pending = {} # outpoint -> time our unconfirmed tx spent it
+        self.undo = {} # height -> (outpoints created, tx_outs spent)
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                state = deserialize(f.read())
+            self.client.headers = [BlockHeader.from_bytes(header) for header in state["headers"]]
+            self.utxos, self.pending, self.undo = state["utxos"], state["pending"], state["undo"]
+
+    def save(self):
+        if self.path:
+            state = {
+                "headers": [header.header for header in self.client.headers],
+                "utxos": self.utxos,
+                "pending": self.pending,
+                "undo": self.undo,
+            }
+            with open(self.path, "wb") as f:
+                f.write(serialize(state))
+
+    def sync(self):
+        old_ids = [header.id for header in self.client.headers]
+        self.client.sync()
+        new_ids = [header.id for header in self.client.headers]
+
+        # Undo blocks that were reorged out
+        fork_height = 0
+        while fork_height < min(len(old_ids), len(new_ids)) \
+                and old_ids[fork_height] == new_ids[fork_height]:
+            fork_height += 1
+        for height in sorted(self.undo, reverse=True):
+            if height < fork_height:
+                break
+            created, spent = self.undo.pop(height)
+            for outpoint in created:
+                self.utxos.pop(outpoint, None)
+            for tx_out in spent:
+                self.utxos[tx_out.outpoint] = tx_out
+
+        # Apply new blocks that touch our key
+        heights = {block_id: height for height, block_id in enumerate(new_ids)}
+        for block in self.client.matching_blocks([self.public_key], start=fork_height):
+            self.undo[heights[block.id]] = self.apply_block(block)
+
+        # Give up on spends that never confirmed
+        for outpoint, spent_at in list(self.pending.items()):
+            if time.time() - spent_at > WALLET_PENDING_TIMEOUT:
+                del self.pending[outpoint]
+        self.save()
+
+    def apply_block(self, block):
+        created, spent = [], []
+        for tx in block.txns:
+            for tx_in in tx.tx_ins:
+                if tx_in.outpoint in self.utxos:
+                    tx_out = self.utxos.pop(tx_in.outpoint)
+                    self.pending.pop(tx_in.outpoint, None)
+                    if tx_in.outpoint in created: # Created and spent within the block
+                        created.remove(tx_in.outpoint)
+                    else:
+                        spent.append(tx_out)
+            for tx_out in tx.tx_outs:
+                if tx_out.public_key == self.public_key:
+                    self.utxos[tx_out.outpoint] = tx_out
+                    created.append(tx_out.outpoint)
+        return created, spent
+
+    @property
+    def spendable(self):
+        return [tx_out for outpoint, tx_out in self.utxos.items()
+                if outpoint not in self.pending]
+
+    @property
+    def balance(self):
+        return sum([tx_out.amount for tx_out in self.spendable])
+
+    def prepare_payments(self, payments, fee):
+        # Batch many (public_key, amount) payments into one tx
+        target = sum([amount for public_key, amount in payments]) + fee
+        selected = select_coins(self.spendable, target, cost_of_change=WALLET_COST_OF_CHANGE)
+        change = sum([tx_out.amount for tx_out in selected]) - target
+        if change <= WALLET_COST_OF_CHANGE:
+            change = 0 # Cheaper to give it to the miner
+        return prepare_tx(selected, self.private_key, payments, change)
+
+    def fee_for(self, payments, fee_rate):
+        # The fee at fee_rate for the tx these payments take. Its size hardly
+        # depends on the fee, so one trial tx gives it.
+        size = len(encode_tx(self.prepare_payments(payments, 0)))
+        return math.ceil(fee_rate * size)
+
+    def send(self, payments, fee):
+        tx = self.prepare_payments(payments, fee)
+        send_message(self.client.address, "tx", tx)
+        for tx_in in tx.tx_ins:
+            self.pending[tx_in.outpoint] = time.time()
+        self.save()
+        return tx
+
+
+###########
+# Mempool #
+###########
+
+
+def dump_mempool(node, path):
+    # Written to a temporary file first so a crash mid-write keeps the last dump
+    with lock:
+        entries = [(encode_tx(entry.tx), entry.fee, entry.time) for entry in node.sorted_mempool()]
+    with open(path + ".tmp", "wb") as f:
+        f.write(serialize(entries))
+    os.replace(path + ".tmp", path)
+    return len(entries)
+
+def dump_mempool_forever(node, path):
+    while True:
+        time.sleep(MEMPOOL_DUMP_INTERVAL)
+        dump_mempool(node, path)
+
+def verify_tx_signatures(tx, public_keys):
+    # Runs in a worker process; public_keys are those of the outputs tx spends
+    try:
+        return all(public_key is not None and tx.verify_input(index, public_key)
+                   for index, public_key in enumerate(public_keys))
+    except Exception:
+        return False
+
+def load_mempool(node, path):
+    # Revalidates a dump against the current utxo set, a batch at a time.
+    # Each batch's signatures are checked across worker processes, then the
+    # txns that passed go through accept_tx in file order, parents first.
+    try:
+        with open(path, "rb") as f:
+            entries = deserialize(f.read())
+    except FileNotFoundError:
+        return 0
+    accepted = 0
+    # Forked from a clean process, as the server threads hold locks by now
+    context = multiprocessing.get_context("forkserver")
+    with concurrent.futures.ProcessPoolExecutor(mp_context=context) as pool:
+        for start in range(0, len(entries), MEMPOOL_LOAD_BATCH):
+            batch = [(decode_tx(encoded), fee, arrived)
+                     for encoded, fee, arrived in entries[start:start + MEMPOOL_LOAD_BATCH]]
+            with lock:
+                utxos = UtxoView(node.utxo_set, node.mempool)
+                public_keys = []
+                for tx, fee, arrived in batch:
+                    public_keys.append([utxos[tx_in.outpoint].public_key if tx_in.outpoint in utxos else None
+                                        for tx_in in tx.tx_ins])
+                    utxos.apply(tx)
+            chunksize = max(1, len(batch) // (os.cpu_count() or 1))
+            signed = pool.map(verify_tx_signatures, [tx for tx, fee, arrived in batch], public_keys,
+                              chunksize=chunksize)
+            with lock:
+                for (tx, fee, arrived), ok in zip(batch, signed):
+                    if ok and tx.id not in node.mempool:
+                        try:
+                            node.accept_tx(tx, check_signatures=False, arrived=arrived)
+                            accepted += 1
+                        except Exception:
+                            pass
+    return accepted
+
+
+#############
+# Snapshots #
+#############
+
+# A snapshot file is SNAPSHOT_MAGIC, the sha256 of the utxo records, the
+# number of headers and of utxos (">II"), the headers from genesis to the
+# snapshot block, then one pickled (tx_id, index, amount, public key bytes)
+# record per utxo in canonical order. Equal utxo sets give equal records,
+# so the hash can be checked against a utxo set rebuilt from full blocks.
+
+
+def utxo_records(utxo_set):
+    for tx_out in sorted(utxo_set.values(), key=lambda tx_out: tx_out.outpoint):
+        yield pickle.dumps((tx_out.tx_id, tx_out.index, tx_out.amount, tx_out.public_key), protocol=4)
+
+def hash_utxo_set(utxo_set):
+    digest = hashlib.sha256()
+    for record in utxo_records(utxo_set):
+        digest.update(record)
+    return digest.digest()
+
+def snapshot_path(name):
+    # Clients name the file, but it always goes in SNAPSHOT_DIR
+    assert re.fullmatch(r"\w[\w.-]*", name), "Snapshot names are letters, digits, '_', '-' and '.'"
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    return os.path.join(SNAPSHOT_DIR, name)
+
+def dump_snapshot(node, path):
+    # Only the copy happens under the lock; sorting and writing come after
+    with lock:
+        headers = [header.header for header in node.blocks.headers]
+        utxo_set = node.utxo_set.copy()
+    digest = hashlib.sha256()
+    with open(path + ".tmp", "wb") as f:
+        f.write(SNAPSHOT_MAGIC + bytes(32) + struct.pack(">II", len(headers), len(utxo_set)))
+        f.write(b"".join(headers))
+        chunk = []
+        for record in utxo_records(utxo_set):
+            chunk.append(record)
+            if len(chunk) == SNAPSHOT_WRITE_CHUNK:
+                digest.update(b"".join(chunk))
+                f.write(b"".join(chunk))
+                chunk = []
+        digest.update(b"".join(chunk))
+        f.write(b"".join(chunk))
+        f.seek(len(SNAPSHOT_MAGIC))
+        f.write(digest.digest()) # Now that we know it
+    os.replace(path + ".tmp", path)
+    block_id = BlockHeader.from_bytes(headers[-1]).id
+    logger.info(f"Wrote snapshot of {len(utxo_set)} utxos at {block_id[:10]} to {path}")
+    return {"block_id": block_id, "height": len(headers) - 1, "utxos": len(utxo_set), "hash": digest.hexdigest(),
+            "path": path}
+
+def load_snapshot(node, path):
+    # Moves a node holding just the genesis block to the snapshot's tip. The
+    # headers are checked like a light client would; the utxos only against
+    # the file's hash until validate_snapshot has replayed the history.
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC, "Not a utxo snapshot"
+    offset = len(SNAPSHOT_MAGIC)
+    content_hash = data[offset:offset+32]
+    header_count, utxo_count = struct.unpack_from(">II", data, offset + 32)
+    offset += 32 + struct.calcsize(">II")
+    size = struct.calcsize(HEADER_FORMAT)
+    headers = [BlockHeader.from_bytes(data[offset + i*size:offset + (i+1)*size]) for i in range(header_count)]
+    body = data[offset + header_count*size:]
+    assert hashlib.sha256(body).digest() == content_hash, "Snapshot doesn't match its hash"
+    assert headers[0].id == node.blocks.headers[0].id, "Snapshot is for another genesis block"
+    LightClient(address=None).add_headers(headers) # Linkage, difficulty and PoW
+
+    records = Unpickler(io.BytesIO(body))
+    utxo_set = UtxoSet()
+    for _ in range(utxo_count):
+        tx_id, index, amount, public_key = records.load()
+        utxo_set[(tx_id, index)] = TxOut(tx_id, index, amount, public_key)
+    node.blocks.extend(headers[1:])
+    node.utxo_set = utxo_set
+    node.snapshot = (headers[-1].id, content_hash)
+    logger.info(f"Loaded snapshot of {utxo_count} utxos at height {len(headers) - 1}")
+
+def validate_snapshot(node, peers):
+    # Downloads the blocks behind the snapshot and connects them on a
+    # scratch node with full validation. If the resulting utxo set hashes
+    # to the snapshot's, the full blocks replace the headers. Returns
+    # whether the snapshot held up.
+    block_id, content_hash = node.snapshot
+    with lock:
+        ids = [header.id for header in node.blocks.headers]
+    background = Node(address=node.address)
+    if node.tx_index is not None: # Index the history as it's replayed
+        background.tx_index = {}
+    if node.history is not None:
+        background.history = {}
+    background.connect_block(node.blocks[0])
+    height = ids.index(block_id)
+    while len(background.blocks) <= height:
+        wanted = ids[len(background.blocks):min(len(background.blocks) + GET_BLOCKS_CHUNK, height + 1)]
+        blocks = None
+        for peer in node.peers or peers:
+            try:
+                response = send_message(peer, "getblocks", wanted, response=True)
+            except Exception:
+                continue
+            if [block.id if block else None for block in response["data"]] == wanted:
+                blocks = response["data"]
+                break
+        if blocks is None:
+            time.sleep(SNAPSHOT_RETRY_INTERVAL)
+            continue
+        for block in blocks:
+            background.handle_block(block)
+    if hash_utxo_set(background.utxo_set) != content_hash:
+        return False
+    with lock:
+        node.blocks.fill(background.blocks)
+        node.filters.update(background.filters)
+        for block_id in ids[:height + 1]:
+            node.undo.put(block_id, background.undo.get(block_id))
+        if node.tx_index is not None:
+            node.tx_index.update(background.tx_index)
+        if node.history is not None: # Replayed entries, then ours since the snapshot
+            for public_key, entries in background.history.items():
+                recent = [entry for entry in node.history.get(public_key, []) if entry[0] > height]
+                node.history[public_key] = entries + recent
+        node.snapshot = None
+    return True
+
+def check_snapshot(node, peers):
+    if validate_snapshot(node, peers):
+        logger.info("Snapshot matches the full history")
+    else:
+        logger.critical("Snapshot doesn't match the full history, shutting down")
+        os._exit(1)
+
+
+#############
+# Profiling #
+#############
+
+
+def start_profiling(directory, name):
+    # Sample the node's threads and trace block handling, writing both to
+    # `directory` every PROFILE_FLUSH_INTERVAL seconds and on exit
+    os.makedirs(directory, exist_ok=True)
+    stacks_path = os.path.join(directory, f"{name}.collapsed")
+    trace_path = os.path.join(directory, f"{name}.trace.json")
+    profiler = SamplingProfiler(interval=PROFILE_SAMPLE_INTERVAL,
+                                thread_names=PROFILE_THREAD_NAMES)
+    profiler.start()
+    tracer.enabled = True
+
+    def flush():
+        profiler.write(stacks_path)
+        tracer.write(trace_path)
+
+    def flush_forever():
+        while True:
+            time.sleep(PROFILE_FLUSH_INTERVAL)
+            flush()
+
+    threading.Thread(target=flush_forever, name="profile-writer", daemon=True).start()
+    atexit.register(flush)
+    logger.info(f"Profiling to {directory}")
+
 
 #######
 # CLI #
 #######
 
+@functools.lru_cache(maxsize=None)
 def lookup_private_key(name):
+    # Deriving a key is a scalar multiplication, so each name is derived once
     exponent = {
         "alice": 1, "bob": 2, "node0": 3, "node1": 4, "node2": 5
     }[name]
@@ -570,47 +2539,169 @@ def lookup_public_key(name):
 
 def main(args):
     if args["serve"]:
+        global node, capture, sync_pool
         threading.current_thread().name = "main"
         name = os.environ["NAME"]
-        duration = 10 * ["node0", "node1", "node2"].index(name)
-        time.sleep(duration)
-        global node
+        profile_directory = args["--profile"] or os.environ.get("POWCOIN_PROFILE")
+        if profile_directory:
+            start_profiling(profile_directory, name)
+        capture_path = args["--capture"] or os.environ.get("POWCOIN_CAPTURE")
+        if capture_path:
+            capture = CaptureWriter(capture_path)
+            logger.info(f"Capturing inbound messages to {capture_path}")
         node = Node(address=(name, PORT))
-        mine_genesis_block(node, lookup_public_key("alice")) # Alice is Satoshi!
-        server_thread = threading.Thread(target=serve, name="server") # Start server thread
+        if args["--txindex"] or os.environ.get("POWCOIN_TXINDEX"):
+            node.tx_index = {}
+        if args["--addressindex"] or os.environ.get("POWCOIN_ADDRESSINDEX"):
+            node.history = {}
+        prune_depth = args["--prune"] or os.environ.get("POWCOIN_PRUNE")
+        if prune_depth:
+            assert int(prune_depth) >= STALE_BRANCH_DEPTH, f"Can't prune within {STALE_BRANCH_DEPTH} blocks of the tip"
+            node.blocks.prune_depth = int(prune_depth)
+        load_genesis_block(node, lookup_public_key("alice")) # Alice is Satoshi!
+        peers = [(p, PORT) for p in os.environ['PEERS'].split(',')]
+        if args["--snapshot"]: # Serve and mine from the snapshot's tip right away
+            load_snapshot(node, args["--snapshot"])
+            threading.Thread(target=check_snapshot, args=[node, peers], name="snapshot", daemon=True).start()
+        node.assume_valid = args["--assume-valid"] or os.environ.get("POWCOIN_ASSUME_VALID")
+        if node.assume_valid: # Headers first, so we know which blocks it covers
+            for peer in peers:
+                client = LightClient(peer)
+                try:
+                    client.sync()
+                except Exception:
+                    continue
+                node.learn_headers(client.headers)
+                if node.assumed_valid:
+                    logger.info(f"Assuming {len(node.assumed_valid)} blocks are validly signed")
+                    break
+        # Forked from a clean process, as this one has threads holding locks
+        sync_pool = concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver"))
+        server = make_server() # Accepting connections from here on
+        server_thread = threading.Thread(target=serve, args=[server], name="server") # Start server thread
         server_thread.start()
-        peers = [(p, PORT) for p in os.environ['PEERS'].split(',')]  # Join the network
-        for peer in peers:
-            node.connect(peer)
-        time.sleep(1) # Wait for peer connections
-        node.sync() # Do initial block download
-        time.sleep(1) # Wait for IBD to finish
+        if args["--metrics-port"]: # Start metrics endpoint
+            metrics_port = int(args["--metrics-port"])
+            metrics_thread = threading.Thread(target=serve_metrics, args=[registry, metrics_port], name="metrics", daemon=True)
+            metrics_thread.start()
+        # Join the network. Each handshake kicks off a sync with that peer.
+        connect_threads = [threading.Thread(target=node.connect, args=[peer], name="connect")
+                           for peer in peers]
+        for thread in connect_threads:
+            thread.start()
+        for thread in connect_threads:
+            thread.join()
+        if not node.pending_peers and not node.peers:
+            node.synced.set() # Nobody to sync with
+        # Mine once a peer says we're caught up, or give up waiting
+        if not node.synced.wait(timeout=STARTUP_SYNC_TIMEOUT):
+            logger.info("Initial sync timed out, mining anyway")
+        # Pick up where the last run's mempool left off, now the chain is current
+        mempool_path = MEMPOOL_FILE.format(name)
+        logger.info(f"Reloaded {load_mempool(node, mempool_path)} mempool txns")
+        threading.Thread(target=dump_mempool_forever, args=[node, mempool_path], name="mempool-writer", daemon=True).start()
+        atexit.register(dump_mempool, node, mempool_path)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # Run atexit on docker stop
         miner_public_key = lookup_public_key(name) # Start miner thread
         miner_thread = threading.Thread(target=mine_forever, args=[miner_public_key], name="miner")
         miner_thread.start()
     elif args["ping"]:
         address = external_address(args["--node"])
         send_message(address, "ping", "")
+    elif args["stats"]:
+        address = external_address(args["--node"])
+        response = send_message(address, "stats", None, response=True)
+        print(json.dumps(response["data"], indent=2))
+    elif args["dumptxoutset"]:
+        # The file is written by the node, into its SNAPSHOT_DIR
+        address = external_address(args["--node"])
+        response = send_message(address, "dumptxoutset", args["<file>"], response=True)
+        print(json.dumps(response["data"], indent=2))
     elif args["balance"]:
-        public_key = lookup_public_key(args["<name>"])
+        names = args["<name>"]
+        public_keys = [lookup_public_key(name) for name in names]
+        address = external_address(args["--node"])
+        if args["--spv"]:
+            client = LightClient(address, path=SPV_HEADERS_FILE)
+            client.sync()
+            balances = client.fetch_balances(public_keys)
+        else: # Batches of keys, pipelined over one connection
+            batches = [public_keys[i:i+MAX_BATCH_KEYS] for i in range(0, len(public_keys), MAX_BATCH_KEYS)]
+            with Connection(address) as connection:
+                responses = connection.pipeline([("balance", batch) for batch in batches])
+            balances = [balance for response in responses for balance in response["data"]]
+        if len(names) == 1:
+            print(balances[0])
+        else:
+            for name, balance in zip(names, balances):
+                print(f"{name} {balance}")
+    elif args["utxos"]:
+        # Streamed a page at a time, so a key with any number of utxos
+        # prints in constant memory
+        address = external_address(args["--node"])
+        request = {"public_key": lookup_public_key(args["<name>"][0]), "stream": True}
+        with Connection(address) as connection:
+            for page in connection.stream("utxos", request, last=lambda page: page["next"] is None):
+                for tx_out in page["utxos"]:
+                    print(f"{tx_out.tx_id.hex()}:{tx_out.index} {tx_out.amount}")
+    elif args["subscribe"]:
+        # Prints events as the node pushes them, one JSON object per line
+        address = external_address(args["--node"])
+        request = {"public_keys": [lookup_public_key(name) for name in args["<name>"]], "tips": args["--tips"]}
+        names = {lookup_public_key(name).to_string("compressed"): name for name in args["<name>"]}
+        with Connection(address) as connection:
+            for notification in connection.stream("subscribe", request):
+                if notification["missed"]:
+                    print(json.dumps({"event": "missed", "count": notification["missed"]}), flush=True)
+                for event in notification["events"]:
+                    if "tx_id" in event:
+                        event["tx_id"] = event["tx_id"].hex()
+                        event["outpoint"] = [event["outpoint"][0].hex(), event["outpoint"][1]]
+                        event["public_key"] = names[event["public_key"]]
+                    print(json.dumps(event), flush=True)
+    elif args["gettx"]:
         address = external_address(args["--node"])
-        response = send_message(address, "balance", public_key, response=True)
-        print(response["data"])
+        response = send_message(address, "gettx", bytes.fromhex(args["<tx_id>"]), response=True)
+        found = response["data"]
+        if found is None:
+            print("Transaction not found")
+        else:
+            tx = found.pop("tx")
+            if tx is not None: # Unless its block was pruned
+                found["coinbase"] = tx.is_coinbase
+                found["inputs"] = [] if tx.is_coinbase else [{"tx_id": tx_in.tx_id.hex(), "index": tx_in.index}
+                                                             for tx_in in tx.tx_ins]
+                found["outputs"] = [{"amount": tx_out.amount, "public_key": tx_out.public_key.hex()} for tx_out in tx.tx_outs]
+            print(json.dumps(found, indent=2))
+    elif args["history"]:
+        address = external_address(args["--node"])
+        request = {"public_key": lookup_public_key(args["<name>"][0]),
+                   "start": int(args["--start"]), "limit": int(args["--limit"])}
+        response = send_message(address, "history", request, response=True)
+        page = response["data"]
+        if page is None:
+            print("Node isn't running with --addressindex")
+        else:
+            for entry in page["entries"]:
+                entry["tx_id"] = entry["tx_id"].hex()
+                entry["outpoint"] = [entry["outpoint"][0].hex(), entry["outpoint"][1]]
+            print(json.dumps(page, indent=2))
     elif args["tx"]:
         # Grab parameters
         sender_private_key = lookup_private_key(args["<from>"])
-        sender_public_key = sender_private_key.get_verifying_key()
-        recipient_private_key = lookup_private_key(args["<to>"])
-        recipient_public_key = recipient_private_key.get_verifying_key()
-        amount = int(args["<amount>"])
+        payments = [(lookup_public_key(name), int(amount))
+                    for name, amount in zip(args["<to>"], args["<amount>"])]
+        address = external_address(args["--node"])
+        # Catch the local wallet up with the chain, then pay everyone in one tx
+        wallet = Wallet(sender_private_key, address, path=WALLET_FILE.format(args["<from>"]))
+        wallet.sync()
+        response = send_message(address, "estimatefee", int(args["--target"]), response=True)
+        fee_rate = response["data"] or DEFAULT_FEE_RATE
+        wallet.send(payments, fee=wallet.fee_for(payments, fee_rate))
+    elif args["estimatefee"]:
         address = external_address(args["--node"])
-        # Fetch utxos available to spend
-        response = send_message(address, "utxos", sender_public_key, response=True)
-        utxos = response["data"]
-        # Prepare transaction
-        tx = prepare_simple_tx(utxos, sender_private_key, recipient_public_key, amount, fee=100)
-        # send to node
-        send_message(address, "tx", tx)
+        response = send_message(address, "estimatefee", int(args["<blocks>"]), response=True)
+        print(response["data"] if response["data"] is not None else "Not enough data yet")
     else:
         print("Invalid command")
 
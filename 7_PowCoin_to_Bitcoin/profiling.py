@@ -0,0 +1,119 @@
+"""
+Opt-in sampling profiler and span tracer
+
+SamplingProfiler wakes up every few milliseconds, grabs the current stack of
+every thread and counts identical stacks. Its output is the "collapsed stacks"
+format read by flamegraph.pl, speedscope and friends: one line per stack,
+frames separated by semicolons, followed by the sample count.
+
+Tracer records named spans and writes them in the Chrome trace event format,
+which chrome://tracing and Perfetto can open. A disabled tracer hands out a
+shared no-op span, so leaving span() calls in hot code costs next to nothing.
+"""
+
+import json, os, sys, threading, time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, thread_names=None):
+        self.interval = interval
+        self.thread_names = thread_names # only sample threads whose name starts with one of these
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if ident == me or not self.wanted(name):
+                    continue
+                stack = collapse(frame)
+                with self.lock:
+                    self.samples[f"{name};{stack}"] += 1
+
+    def wanted(self, name):
+        if self.thread_names is None:
+            return True
+        return any(name.startswith(prefix) for prefix in self.thread_names)
+
+    def write(self, path):
+        with self.lock:
+            lines = [f"{stack} {count}" for stack, count in self.samples.items()]
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def collapse(frame):
+    # Root-first list of "function (file:line)"
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class Tracer:
+    def __init__(self, enabled=False, max_events=100_000):
+        self.enabled = enabled
+        self.events = deque(maxlen=max_events) # oldest spans are dropped first
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.thread_names = {}
+
+    @contextmanager
+    def _span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+                self.thread_names[thread.ident] = thread.name
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NO_SPAN
+        return self._span(name, args)
+
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+            events += [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                       for tid, name in self.thread_names.items()]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = NoSpan()
@@ -0,0 +1,97 @@
+"""
+Replay a message capture into a fresh node
+
+Feeds the messages recorded by `mybitcoin.py serve --capture` through
+handle_message on a new node, either as fast as possible or paced like the
+original, and reports where the time went as JSON. Nothing is sent back
+to the network.
+
+Usage:
+  replay.py <capture> [--speed=<factor>] [--commands=<list>]
+
+Options:
+  -h --help          Show this screen.
+  --speed=<factor>   0 replays as fast as possible, 1 at recorded speed,
+                     2 at twice recorded speed and so on [default: 0]
+  --commands=<list>  Only replay these commands, comma separated
+"""
+
+import json, logging, time
+from collections import defaultdict
+from docopt import docopt
+
+import mybitcoin
+from mybitcoin import Node, PORT
+from capture import read_capture
+
+
+class ReplayNode(Node):
+    # Anything the node would send to peers is dropped
+    def send(self, peer, command, data):
+        pass
+
+    def propagate_block(self, block):
+        pass
+
+
+def replay(path, speed=0, commands=None):
+    node = ReplayNode(address=("replay", PORT))
+    mybitcoin.load_genesis_block(node, mybitcoin.lookup_public_key("alice"))
+    mybitcoin.tracer.enabled = True
+    respond = lambda command, data: None
+
+    timings = defaultdict(lambda: {"count": 0, "secs": 0.0, "errors": 0})
+    first_recorded, started = None, time.perf_counter()
+    for timestamp, peer, raw_message in read_capture(path):
+        if first_recorded is None:
+            first_recorded = timestamp
+        if speed:
+            delay = (timestamp - first_recorded) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        start = time.perf_counter()
+        message = mybitcoin.deserialize(raw_message)
+        timings["(deserialize)"]["count"] += 1
+        timings["(deserialize)"]["secs"] += time.perf_counter() - start
+        command = message["command"]
+        if commands and command not in commands:
+            continue
+
+        start = time.perf_counter()
+        try:
+            mybitcoin.handle_message(node, command, message["data"], (peer, PORT), respond)
+        except Exception:
+            timings[command]["errors"] += 1
+        timings[command]["count"] += 1
+        timings[command]["secs"] += time.perf_counter() - start
+
+    return {
+        "wall_secs": time.perf_counter() - started,
+        "height": len(node.blocks) - 1,
+        "commands": dict(timings),
+        "phases": phase_totals(mybitcoin.tracer.events),
+        "block_validation": {
+            labels: {"count": entry["count"], "secs": entry["sum"]}
+            for labels, entry in mybitcoin.block_validation_seconds.snapshot().items()
+        },
+    }
+
+
+def phase_totals(events):
+    totals = defaultdict(lambda: {"count": 0, "secs": 0.0})
+    for event in events:
+        totals[event["name"]]["count"] += 1
+        totals[event["name"]]["secs"] += event["dur"] / 1e6
+    return dict(totals)
+
+
+def main(args):
+    logging.getLogger().setLevel("WARNING")
+    commands = args["--commands"].split(",") if args["--commands"] else None
+    report = replay(args["<capture>"], speed=float(args["--speed"]), commands=commands)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
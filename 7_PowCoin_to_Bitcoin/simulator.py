@@ -0,0 +1,256 @@
+"""
+Deterministic in-process network simulator
+
+Runs N nodes in one process on a discrete-event scheduler. Messages go
+through handle_message like they do on the wire, but are delivered by the
+scheduler after a sampled latency plus transmission time, so no sockets or
+sleeps are involved. Block discovery is a Poisson process split across
+miners. Reports block propagation, fork and orphan rates as JSON.
+
+Usage:
+  simulator.py [options] [--partition=<spec>]...
+
+Options:
+  -h --help                Show this screen.
+  --nodes=<n>              Number of nodes [default: 8]
+  --peers=<n>              Outbound connections per node [default: 3]
+  --duration=<secs>        Simulated seconds to run [default: 600]
+  --block-interval=<secs>  Mean time between blocks network-wide [default: 10]
+  --tx-rate=<n>            Transactions created per simulated second [default: 1]
+  --latency=<dist>         Link latency in seconds: fixed:S, uniform:A:B,
+                           exponential:MEAN or lognormal:MU:SIGMA
+                           [default: lognormal:-2.3:0.5]
+  --bandwidth=<n>          Link bandwidth in bytes per second [default: 1000000]
+  --loss=<p>               Probability a message is dropped [default: 0]
+  --partition=<spec>       START:END:I,J,... cuts nodes I,J,... off from the
+                           rest between START and END simulated seconds
+  --seed=<n>               Random seed [default: 0]
+"""
+
+import heapq, json, logging, random
+from docopt import docopt
+
+import mybitcoin
+from mybitcoin import Block, Node, SigningKey, SECP256k1, PORT
+
+SIMULATION_BITS = 8 # genesis difficulty; PoW is real but cheap
+GENESIS_TIMESTAMP = 1560374099.0134091
+
+
+def parse_latency(spec, rng):
+    kind, *params = spec.split(":")
+    params = [float(param) for param in params]
+    return {
+        "fixed": lambda: params[0],
+        "uniform": lambda: rng.uniform(*params),
+        "exponential": lambda: rng.expovariate(1 / params[0]),
+        "lognormal": lambda: rng.lognormvariate(*params),
+    }[kind]
+
+
+def parse_partition(spec):
+    start, end, members = spec.split(":")
+    return float(start), float(end), {int(i) for i in members.split(",")}
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f"p{p}": values[min(len(values) - 1, len(values) * p // 100)] for p in points}
+
+
+class SimNode(Node):
+    # A Node whose messages go through the simulator instead of sockets
+    def __init__(self, sim, index):
+        super().__init__(address=(f"sim{index}", PORT), clock=sim.clock)
+        self.sim = sim
+        self.index = index
+        self.private_key = SigningKey.from_secret_exponent(1000 + index, curve=SECP256k1)
+        self.public_key = self.private_key.get_verifying_key()
+        self.spent = set() # outpoints we've spent in unconfirmed txns
+
+    def send(self, peer, command, data):
+        self.sim.transmit(self.address, peer, command, data)
+
+    def propagate_block(self, block):
+        # The simulator models latency and loss itself, so skip disrupt()
+        for peer in self.peers:
+            self.send(peer, "blocks", [mybitcoin.encode_block(block)])
+
+    def handle_block(self, block, checked=None):
+        super().handle_block(block, checked)
+        self.sim.block_accepted(self, block)
+
+
+class Simulator:
+    def __init__(self, args):
+        self.rng = random.Random(args["seed"])
+        self.args = args
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+        self.latency = parse_latency(args["latency"], self.rng)
+        self.partitions = [parse_partition(spec) for spec in args["partitions"]]
+        self.link_free_at = {} # (src, dst) -> time the link finishes its current send
+        self.nodes = [SimNode(self, i) for i in range(args["nodes"])]
+        self.by_address = {node.address: node for node in self.nodes}
+        self.mined = {} # block id -> (time, miner index, parent id)
+        self.arrivals = {} # block id -> {node index: time}
+        self.stats = {"messages": 0, "bytes": 0, "dropped": 0, "partitioned": 0,
+                      "rejected": 0, "txns": 0, "invalid_templates": 0}
+
+    def clock(self):
+        return GENESIS_TIMESTAMP + self.now
+
+    def schedule(self, delay, func, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, func, args))
+
+    def setup(self):
+        # Everyone shares a genesis block paying node 0
+        coinbase = mybitcoin.prepare_coinbase(self.nodes[0].public_key, self.nodes[0].get_block_subsidy())
+        genesis = mybitcoin.mine_block(Block(txns=[coinbase], prev_id=None, nonce=0,
+                                             bits=SIMULATION_BITS, timestamp=self.clock()))
+        for node in self.nodes:
+            node.connect_block(mybitcoin.deserialize(mybitcoin.serialize(genesis)))
+            node.template = mybitcoin.BlockTemplate(node, node.public_key)
+
+        # Random topology with symmetric links
+        for node in self.nodes:
+            others = [other for other in self.nodes if other is not node]
+            for other in self.rng.sample(others, min(self.args["peers"], len(others))):
+                if other.address not in node.peers:
+                    node.peers.append(other.address)
+                    other.peers.append(node.address)
+
+        self.schedule(self.rng.expovariate(1 / self.args["block_interval"]), self.find_block)
+        if self.args["tx_rate"] > 0:
+            self.schedule(self.rng.expovariate(self.args["tx_rate"]), self.create_tx)
+
+    def partitioned(self, a, b):
+        for start, end, members in self.partitions:
+            if start <= self.now < end and ((a in members) != (b in members)):
+                return True
+        return False
+
+    def transmit(self, src, dst, command, data):
+        message = mybitcoin.prepare_message(command, data)
+        self.stats["messages"] += 1
+        self.stats["bytes"] += len(message)
+        sender, receiver = self.by_address[src], self.by_address[dst]
+        if self.partitioned(sender.index, receiver.index):
+            self.stats["partitioned"] += 1
+            return
+        if self.rng.random() < self.args["loss"]:
+            self.stats["dropped"] += 1
+            return
+        # Messages on a link queue behind each other
+        link = (src, dst)
+        start = max(self.now, self.link_free_at.get(link, 0))
+        self.link_free_at[link] = start + len(message) / self.args["bandwidth"]
+        delay = self.link_free_at[link] - self.now + self.latency()
+        self.schedule(delay, self.deliver, src, dst, message)
+
+    def deliver(self, src, dst, message):
+        message = mybitcoin.deserialize(message[4:])
+        node = self.by_address[dst]
+        respond = lambda command, data: self.transmit(dst, src, command, data)
+        try:
+            mybitcoin.handle_message(node, message["command"], message["data"], src, respond)
+        except Exception:
+            self.stats["rejected"] += 1
+
+    def find_block(self):
+        miner = self.rng.choice(self.nodes)
+        block = miner.template.block(nonce=0)
+        block.timestamp = self.clock()
+        while block.proof >= block.target: # mine_block would stop on mining_interrupt
+            block.nonce += 1
+        try:
+            miner.handle_block(block)
+            self.mined[block.id] = (self.now, miner.index, block.prev_id)
+        except Exception:
+            self.stats["invalid_templates"] += 1
+        self.schedule(self.rng.expovariate(1 / self.args["block_interval"]), self.find_block)
+
+    def create_tx(self):
+        sender, recipient = self.rng.sample(self.nodes, 2)
+        utxos = [tx_out for tx_out in sender.fetch_utxos(sender.public_key)
+                 if tx_out.outpoint not in sender.spent]
+        amount = self.rng.randint(1, 10_000)
+        if utxos and sum([tx_out.amount for tx_out in utxos]) > amount + 100:
+            tx = mybitcoin.prepare_simple_tx(utxos, sender.private_key, recipient.public_key, amount, fee=100)
+            sender.spent.update(tx_in.outpoint for tx_in in tx.tx_ins)
+            try:
+                sender.handle_tx(tx)
+                self.stats["txns"] += 1
+            except Exception:
+                self.stats["rejected"] += 1
+        self.schedule(self.rng.expovariate(self.args["tx_rate"]), self.create_tx)
+
+    def block_accepted(self, node, block):
+        self.arrivals.setdefault(block.id, {}).setdefault(node.index, self.now)
+
+    def run(self):
+        self.setup()
+        while self.events:
+            self.now, _, func, args = heapq.heappop(self.events)
+            # Past the end, stop mining but let messages in flight land
+            if self.now <= self.args["duration"] or func == self.deliver:
+                func(*args)
+        return self.report()
+
+    def report(self):
+        # Propagation delay from each block's discovery to each node accepting it
+        delays, coverage = [], []
+        for block_id, (mined_at, miner, parent) in self.mined.items():
+            arrivals = self.arrivals.get(block_id, {})
+            others = sorted(t - mined_at for i, t in arrivals.items() if i != miner)
+            delays.extend(others)
+            needed = int(0.9 * (len(self.nodes) - 1))
+            if needed and len(others) >= needed:
+                coverage.append(others[needed - 1])
+
+        # Blocks that didn't make it onto the most-work chain
+        total_work = lambda node: sum([2**header.bits for header in node.blocks.headers])
+        best = max(self.nodes, key=total_work)
+        heights = best.blocks.heights
+        stale = [block_id for block_id in self.mined if block_id not in heights]
+        # Heights on the best chain where some other block competed
+        contested = {heights[self.mined[block_id][2]] + 1 for block_id in stale
+                     if self.mined[block_id][2] in heights}
+
+        mined = len(self.mined)
+        return {
+            "params": {k: v for k, v in self.args.items()},
+            "blocks_mined": mined,
+            "best_height": len(best.blocks) - 1,
+            "nodes_in_consensus": sum(node.blocks.headers[-1] == best.blocks.headers[-1] for node in self.nodes),
+            "propagation_secs": percentiles(delays),
+            "time_to_90pct_of_nodes_secs": percentiles(coverage),
+            "fork_rate": len(contested) / max(len(best.blocks) - 1, 1),
+            "orphan_rate": len(stale) / mined if mined else 0,
+            "network": self.stats,
+        }
+
+
+def main(args):
+    logging.getLogger().setLevel("WARNING")
+    args = {
+        "nodes": int(args["--nodes"]),
+        "peers": int(args["--peers"]),
+        "duration": float(args["--duration"]),
+        "block_interval": float(args["--block-interval"]),
+        "tx_rate": float(args["--tx-rate"]),
+        "latency": args["--latency"],
+        "bandwidth": float(args["--bandwidth"]),
+        "loss": float(args["--loss"]),
+        "partitions": args["--partition"],
+        "seed": int(args["--seed"]),
+    }
+    print(json.dumps(Simulator(args).run(), indent=2))
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))